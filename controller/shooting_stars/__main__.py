@@ -1,27 +1,91 @@
-from time import sleep
+from time import sleep, perf_counter
+from importlib import import_module
 import logging
 from argparse import ArgumentParser
+from pathlib import Path
 
-from .subscription import Subscription
+from .clock import REAL_CLOCK
+from .host import HostedActivity
+from .subscription import Connection, Subscription
 from .device import Device
-from .animation import run_animation, AnimationState
-from .blocks import BlocksTrainer, run_blocks
-from .cone import run_cone
-from .presence import run_presence
+from .diagnostics import MemoryDiagnostics
+from .framebus import FrameBusDevice
+from .metrics import HandlerError, metrics
+from .profiler import DEFAULT_PROFILE_SECONDS, ProfileRunning, SamplingProfiler
+from .recorder import Recorder
+from .utils import get_max_rss_mib, parse_size
 
-ACTIVITIES = ['lights', 'blocks', 'cone', 'presence']
+# Module implementing each activity. Activity modules (and the heavy
+# libraries they use, such as OpenCV, scipy and tetris) are only
+# imported when their activity is run.
+ACTIVITY_TO_MODULE = {
+    'lights': '.animation',
+    'blocks': '.blocks',
+    'cone': '.cone',
+    'presence': '.presence',
+}
+ACTIVITIES = list(ACTIVITY_TO_MODULE)
 
 parser = ArgumentParser(prog='shooting_stars',
                         description='Christmas lights controller')
 parser.add_argument('meteor_url',
                     help='[ws|wss]://host:port of Meteor server publishing lights state')
-parser.add_argument('activity', choices=ACTIVITIES)
-parser.add_argument('twinkly_device_id', type=str)
+parser.add_argument('activity', choices=[*ACTIVITIES, 'host'],
+                    help='Activity to run, or host to run several activities in one process')
+parser.add_argument('twinkly_device_id', type=str, nargs='+',
+                    help=('Device to run the activity on, or ACTIVITY:DEVICE_ID pairs for each activity to '
+                          'run in host mode (e.g. host lights:Twinkly_ABC cone:Twinkly_DEF)'))
 parser.add_argument('--meteor-token', dest='meteor_token', type=str)
 parser.add_argument('--log-level', dest='log_level', default='info', type=str)
+parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                    help='Record stage timings and counters, and serve them in Prometheus format '
+                         'on http://127.0.0.1:PORT/metrics')
+parser.add_argument('--profile-dir', dest='profile_dir', type=str,
+                    help=('Enable on-demand profiling: sending SIGUSR1 saves a collapsed-stack profile of '
+                          'all threads to this directory (and with --metrics-port, '
+                          '/profile?seconds=N returns one)'))
+parser.add_argument('--profile-seconds', dest='profile_seconds', type=float, default=DEFAULT_PROFILE_SECONDS,
+                    help='Number of seconds to profile for when triggered by a signal')
+parser.add_argument('--memory-diagnostics-interval', dest='memory_diagnostics_interval', type=float,
+                    help=('Trace memory allocations, and log the allocation sites that have grown the most '
+                          'every this many seconds (slows down the controller)'))
+parser.add_argument('--record', type=str,
+                    help=('Append every subscription message and device frame to this recording file, '
+                          'for replaying with shooting_stars.replay'))
+parser.add_argument('--frame-bus', dest='frame_bus', action='store_true',
+                    help=('Write frames to the shared-memory frame bus of a shooting_stars.sender process '
+                          'for each device, instead of sending them to the device directly'))
+parser.add_argument('--blocks-search-depth', dest='blocks_search_depth', default=1, type=int,
+                    help='Number of upcoming pieces the blocks AI plans for (1 only considers the current piece)')
+parser.add_argument('--blocks-checkpoint', dest='blocks_checkpoint', type=str,
+                    help='.npz file to periodically save the blocks AI model to, and load it from at startup')
+parser.add_argument('--blocks-baseline', dest='blocks_baseline', type=str,
+                    help='.npz file of a pre-trained blocks AI model to start from if there is no checkpoint')
+parser.add_argument('--blocks-save-history', dest='blocks_save_history', action='store_true',
+                    help='Include recent training history in blocks AI checkpoints')
+parser.add_argument('--presence-capture-size', dest='presence_capture_size', type=parse_size,
+                    help='WIDTHxHEIGHT resolution to request from the presence camera (defaults to 320x240)')
+parser.add_argument('--presence-working-size', dest='presence_working_size', type=parse_size,
+                    help='WIDTHxHEIGHT to detect presence motion at (defaults to the presence map size)')
 
 
-def lights_activity(args):
+def load_activity(activity):
+    """Import the module implementing an activity, returning the number
+    of seconds it took."""
+    start_time = perf_counter()
+    import_module(ACTIVITY_TO_MODULE[activity], __package__)
+    return perf_counter() - start_time
+
+
+def get_device(args, *, device_id, recorder):
+    if args.frame_bus:
+        return FrameBusDevice(device_id=device_id, recorder=recorder)
+    return Device(device_id=device_id, recorder=recorder)
+
+
+def lights_activity(args, *, device_id, connection=None, recorder=None, clock=REAL_CLOCK):
+    from .animation import run_animation, AnimationState
+
     lights_sub = None
     device = None
     try:
@@ -29,10 +93,12 @@ def lights_activity(args):
             url=f'{args.meteor_url}/websocket',
             name='lights',
             token=args.meteor_token,
+            recorder=recorder,
+            connection=connection,
         )
         lights_sub.start()
 
-        device = Device(device_id=args.twinkly_device_id)
+        device = get_device(args, device_id=device_id, recorder=recorder)
         device.start_monitor()
 
         animation_state = AnimationState()
@@ -40,6 +106,7 @@ def lights_activity(args):
             device=device,
             lights=lights_sub.state,
             animation_state=animation_state,
+            clock=clock,
         )
     finally:
         # Clean up threads
@@ -49,14 +116,20 @@ def lights_activity(args):
             device.stop_monitor()
 
 
-def blocks_activity(args):
+def blocks_activity(args, *, device_id, connection=None, recorder=None, clock=REAL_CLOCK):
+    from .blocks import BlocksTrainer, run_blocks
+
     inputs_sub = None
+    pictures_sub = None
     device = None
+    trainer = None
     try:
         inputs_sub = Subscription(
             url=f'{args.meteor_url}/websocket',
             name='blocksInputs',
             token=args.meteor_token,
+            recorder=recorder,
+            connection=connection,
         )
         inputs_sub.start()
 
@@ -64,13 +137,20 @@ def blocks_activity(args):
             url=f'{args.meteor_url}/websocket',
             name='pictures',
             token=args.meteor_token,
+            recorder=recorder,
+            connection=connection,
         )
         pictures_sub.start()
 
-        device = Device(device_id=args.twinkly_device_id)
+        device = get_device(args, device_id=device_id, recorder=recorder)
         device.start_monitor()
 
-        trainer = BlocksTrainer()
+        trainer = BlocksTrainer(
+            search_depth=args.blocks_search_depth,
+            checkpoint_path=args.blocks_checkpoint,
+            baseline_path=args.blocks_baseline,
+            save_history=args.blocks_save_history,
+        )
         trainer.start()
 
         run_blocks(
@@ -78,6 +158,7 @@ def blocks_activity(args):
             inputs_sub=inputs_sub,
             pictures_sub=pictures_sub,
             trainer=trainer,
+            clock=clock,
         )
     finally:
         # Clean up threads
@@ -91,7 +172,9 @@ def blocks_activity(args):
             trainer.stop()
 
 
-def cone_activity(args):
+def cone_activity(args, *, device_id, connection=None, recorder=None, clock=REAL_CLOCK):
+    from .cone import run_cone
+
     paint_sub = None
     device = None
     try:
@@ -99,15 +182,18 @@ def cone_activity(args):
             url=f'{args.meteor_url}/websocket',
             name='paint',
             token=args.meteor_token,
+            recorder=recorder,
+            connection=connection,
         )
         paint_sub.start()
 
-        device = Device(device_id=args.twinkly_device_id)
+        device = get_device(args, device_id=device_id, recorder=recorder)
         device.start_monitor()
 
         run_cone(
             device=device,
             paint_sub=paint_sub,
+            clock=clock,
         )
     finally:
         # Clean up threads
@@ -117,25 +203,33 @@ def cone_activity(args):
             device.stop_monitor()
 
 
-def presence_activity(args):
+def presence_activity(args, *, device_id, connection=None, recorder=None, clock=REAL_CLOCK):
+    from .presence import CAPTURE_SIZE, run_presence
+
+    presence_sub = None
     device = None
     try:
         presence_sub = Subscription(
             url=f'{args.meteor_url}/websocket',
             name='presence',
             token=args.meteor_token,
+            recorder=recorder,
+            connection=connection,
             sub_param_list=[
                 args.meteor_token,
             ]
         )
         presence_sub.start()
 
-        device = Device(device_id=args.twinkly_device_id)
+        device = get_device(args, device_id=device_id, recorder=recorder)
         device.start_monitor()
 
         run_presence(
             device=device,
             presence_sub=presence_sub,
+            capture_size=(args.presence_capture_size or CAPTURE_SIZE),
+            working_size=args.presence_working_size,
+            clock=clock,
         )
     finally:
         # Clean up threads
@@ -145,6 +239,78 @@ def presence_activity(args):
             device.stop_monitor()
 
 
+ACTIVITY_TO_FUNCTION = {
+    'lights': lights_activity,
+    'blocks': blocks_activity,
+    'cone': cone_activity,
+    'presence': presence_activity,
+}
+
+
+def get_hosted_target(args, *, activity, device_id, connection, recorder):
+    def target(clock):
+        ACTIVITY_TO_FUNCTION[activity](args, device_id=device_id, connection=connection,
+                                       recorder=recorder, clock=clock)
+    return target
+
+
+def log_startup(activities):
+    """Load the modules for each activity, logging how long it took and
+    how much memory the process is using."""
+    for activity in sorted(activities):
+        seconds = load_activity(activity)
+        metrics.set_gauge('startup_seconds', seconds, activity=activity)
+        logging.info(f'Loaded {activity} in {seconds:.2f} seconds')
+    logging.info(f'Using {get_max_rss_mib():.1f} MiB after startup')
+
+
+def host_activities(args):
+    """Run several activities (each on its own device) in this process,
+    sharing one connection to the Meteor server, the loaded libraries
+    and metrics. Each activity runs in its own thread, and is restarted
+    if it crashes."""
+    activity_device_ids = []
+    for value in args.twinkly_device_id:
+        activity, _, device_id = value.partition(':')
+        if activity not in ACTIVITY_TO_FUNCTION or not device_id:
+            parser.error(f'Expected ACTIVITY:DEVICE_ID in host mode, but got: {value}')
+        activity_device_ids.append((activity, device_id))
+    log_startup({activity for activity, _ in activity_device_ids})
+
+    connection = Connection(url=f'{args.meteor_url}/websocket', name='host')
+    hosted_activities = []
+    recorders = []
+    for activity, device_id in activity_device_ids:
+        name = f'{activity}-{device_id}'
+        recorder = None
+        if args.record is not None:
+            # Record each activity to its own file, so it can be replayed
+            record_path = Path(args.record)
+            recorder = Recorder(path=record_path.with_name(f'{record_path.stem}-{name}{record_path.suffix}'))
+            recorder.record_metadata('activity', activity)
+            recorders.append(recorder)
+        hosted_activities.append(HostedActivity(
+            name=name,
+            target=get_hosted_target(args, activity=activity, device_id=device_id,
+                                     connection=connection, recorder=recorder),
+        ))
+
+    try:
+        for hosted_activity in hosted_activities:
+            hosted_activity.start()
+        while any(hosted_activity.is_alive() for hosted_activity in hosted_activities):
+            sleep(1)
+    finally:
+        # Clean up threads
+        for hosted_activity in hosted_activities:
+            hosted_activity.stop()
+        for hosted_activity in hosted_activities:
+            hosted_activity.join()
+        connection.stop()
+        for recorder in recorders:
+            recorder.close()
+
+
 def main():
     args = parser.parse_args()
 
@@ -152,16 +318,41 @@ def main():
         level=getattr(logging, args.log_level.upper()),
     )
 
-    if args.activity == 'lights':
-        lights_activity(args)
-    elif args.activity == 'blocks':
-        blocks_activity(args)
-    elif args.activity == 'cone':
-        cone_activity(args)
-    elif args.activity == 'presence':
-        presence_activity(args)
-    else:
-        logging.error(f'Unrecognised activity: {args.activity}')
+    if args.profile_dir is not None:
+        profiler = SamplingProfiler(output_dir=args.profile_dir)
+        profiler.install_signal_handler(seconds=args.profile_seconds)
+
+        def handle_profile(query):
+            try:
+                return profiler.profile(float(query.get('seconds', [args.profile_seconds])[0]))
+            except ProfileRunning:
+                raise HandlerError(409, 'Profile already running')
+        metrics.add_handler('/profile', handle_profile)
+
+    if args.metrics_port is not None:
+        metrics.start_server(args.metrics_port)
+
+    if args.memory_diagnostics_interval is not None:
+        MemoryDiagnostics(interval_seconds=args.memory_diagnostics_interval).start()
+
+    if args.activity == 'host':
+        host_activities(args)
+        return
+    if len(args.twinkly_device_id) != 1:
+        parser.error('Expected one device (run several activities with the host activity)')
+    log_startup([args.activity])
+
+    recorder = None
+    if args.record is not None:
+        recorder = Recorder(path=args.record)
+        recorder.record_metadata('activity', args.activity)
+
+    try:
+        ACTIVITY_TO_FUNCTION[args.activity](args, device_id=args.twinkly_device_id[0], recorder=recorder)
+    finally:
+        # Flush any buffered records
+        if recorder is not None:
+            recorder.close()
 
 
 if __name__ == '__main__':
@@ -1,11 +1,13 @@
 import logging
-from time import sleep, monotonic
 import numpy as np
 from itertools import cycle
 from operator import itemgetter
 
+from .clock import REAL_CLOCK
 from .utils import hsv_to_rgb, hue_to_rgb
 from .device import FRAME_DTYPE, DeviceDisconnected
+from .fixed_point import ONE, WORK_DTYPE, FrameMath, fade_factors, to_fixed
+from .metrics import metrics
 
 FRAMES_PER_SECOND = 20
 FRAME_DELAY_SECONDS = 1 / FRAMES_PER_SECOND
@@ -46,12 +48,19 @@ SEGMENT_LEDS = list(reversed([
 
 class AnimationState:
 
-    def __init__(self):
+    def __init__(self, *, rng=np.random):
+        self.rng = rng
         self.rainbow_colours = self.get_random_colours()
         self.gradual_hue = 0
-        self.twinkle_brightness = np.arange(0, LED_COUNT) % 2 == 0
-        self.rain_brightness = np.zeros(LED_COUNT)
-        self.wave_brightness = np.zeros(LED_COUNT)
+        # Brightnesses are fixed-point factors
+        self.twinkle_brightness = ((np.arange(0, LED_COUNT) % 2 == 0) * ONE).astype(WORK_DTYPE)
+        self.rain_brightness = np.zeros(LED_COUNT, dtype=WORK_DTYPE)
+        self.wave_brightness = np.zeros(LED_COUNT, dtype=WORK_DTYPE)
+
+        # Buffers reused every frame
+        self.frame = np.zeros((LED_COUNT, COMPONENT_COUNT), dtype=FRAME_DTYPE)
+        self.brightness = np.zeros(LED_COUNT, dtype=WORK_DTYPE)
+        self.frame_math = FrameMath(self.frame.shape)
 
     def tick(self, frame_idx):
         # Rainbow
@@ -62,17 +71,17 @@ class AnimationState:
         # Twinkle
         seconds_between_twinkle = 1
         if (frame_idx % (FRAMES_PER_SECOND * seconds_between_twinkle)) == 0:
-            self.twinkle_brightness = ~self.twinkle_brightness
+            np.subtract(ONE, self.twinkle_brightness, out=self.twinkle_brightness)
 
         # Rain
         seconds_between_rain = 1 / FRAMES_PER_SECOND
         rain_drops_per_second = 20
         rain_fade_seconds = 2
         rain_drops = int(round(rain_drops_per_second / FRAMES_PER_SECOND))
-        rain_fade = (1 / (FRAMES_PER_SECOND * rain_fade_seconds))
-        self.rain_brightness = np.maximum(0, self.rain_brightness - rain_fade)
+        rain_fade = to_fixed(1 / (FRAMES_PER_SECOND * rain_fade_seconds))
+        fade_factors(self.rain_brightness, rain_fade)
         if (frame_idx % (FRAMES_PER_SECOND * seconds_between_rain)) == 0:
-            self.rain_brightness[np.random.randint(LED_COUNT, size=rain_drops)] = 1
+            self.rain_brightness[self.rng.randint(LED_COUNT, size=rain_drops)] = ONE
 
         # Gradual
         gradual_cycle_seconds = 10
@@ -80,21 +89,23 @@ class AnimationState:
 
         # Wave
         wave_width = 10
-        self.wave_brightness = np.maximum(0, self.wave_brightness - (1 / wave_width))
+        fade_factors(self.wave_brightness, to_fixed(1 / wave_width))
         # Negative index switches direction of lights
         next_wave_icicle_idx = -(frame_idx % len(ICICLE_LEDS))
-        self.wave_brightness[ICICLE_LEDS[next_wave_icicle_idx]] = 1
+        self.wave_brightness[ICICLE_LEDS[next_wave_icicle_idx]] = ONE
 
     def get_random_colours(self):
-        hues = np.random.rand(LED_COUNT)
+        hues = self.rng.rand(LED_COUNT)
         return hue_to_rgb(hues)
 
 
 def render_frame(*, device, lights, animation_state, frame_idx):
     animation_state.tick(frame_idx)
 
-    frame = np.zeros((LED_COUNT, COMPONENT_COUNT), dtype=FRAME_DTYPE)
-    brightness = np.ones(LED_COUNT)
+    frame = animation_state.frame
+    frame[:] = 0
+    brightness = animation_state.brightness
+    brightness[:] = ONE
 
     for light in sorted(lights.values(), key=itemgetter('idx')):
         light_idx = light['idx']
@@ -128,30 +139,33 @@ def render_frame(*, device, lights, animation_state, frame_idx):
         elif light['animation'] == 'wave':
             brightness[light_leds] = animation_state.wave_brightness[light_leds]
 
-    frame = (frame * brightness[:, np.newaxis]).astype(FRAME_DTYPE)
+    animation_state.frame_math.scale(frame, brightness[:, np.newaxis])
     #print(frame, flush=True)
     device.set_frame_array(frame)
 
 
-def run_animation(*, device, lights, animation_state):
+def run_animation(*, device, lights, animation_state, clock=REAL_CLOCK):
     """Render frames in a continuous loop"""
-    next_time = monotonic()
+    next_time = clock.monotonic()
     frame_idx = 0
     while True:
         next_time = next_time + FRAME_DELAY_SECONDS
-        sleep(max(0, next_time - monotonic()))
+        if (clock.monotonic() - next_time) > FRAME_DELAY_SECONDS:
+            metrics.increment('dropped_frames', activity='lights')
+        clock.sleep(max(0, next_time - clock.monotonic()))
 
-        frame_start_time = monotonic()
+        frame_start_time = clock.monotonic()
         try:
-            render_frame(
-                device=device,
-                lights=lights,
-                animation_state=animation_state,
-                frame_idx=frame_idx,
-            )
+            with metrics.stage('render', activity='lights'):
+                render_frame(
+                    device=device,
+                    lights=lights,
+                    animation_state=animation_state,
+                    frame_idx=frame_idx,
+                )
         except DeviceDisconnected:
             logging.info(f'Device disconnected')
-        logging.info(f'Frame render time: {monotonic() - frame_start_time}')
+        metrics.observe('frame', clock.monotonic() - frame_start_time, activity='lights')
 
         # Prevent frame_idx from reaching infinity
         frame_idx = (frame_idx + 1) % 10_000
@@ -0,0 +1,471 @@
+from argparse import ArgumentParser
+import dataclasses
+import itertools
+import json
+from pathlib import Path
+import subprocess
+import sys
+from time import perf_counter
+import tracemalloc
+
+import numpy as np
+from tetris import MinoType
+
+from .animation import AnimationState, render_frame
+from .blocks import (
+    BlocksTrainer, GameState, PICTURE_KEYS, TrainableBlocksGame, load_picture, render_game,
+)
+from .compositor import BLEND_MODES, Compositor
+from .cone import FRAME_DELAY_SECONDS, PaintState
+from .device import CaptureDevice
+from .presence import PresenceState
+from .__main__ import ACTIVITIES
+
+LAYOUT_PATH = Path(__file__).resolve().parents[2] / 'assets' / 'cone-layout-backup.json'
+# Seconds to spend timing each benchmark at each scale (after warming up).
+DEFAULT_SECONDS_PER_BENCHMARK = 0.5
+# Number of calls to measure allocations over (tracemalloc is slow, so
+# this is kept separate from timing).
+ALLOCATION_CALLS = 5
+# Slowdown relative to the baseline that counts as a regression.
+DEFAULT_REGRESSION_TOLERANCE = 0.25
+# Number of frames of cone playback to cycle through when rendering.
+CONE_PLAYBACK_FRAMES = 300
+# Number of fresh processes to measure the startup of each activity in.
+STARTUP_RUNS = 5
+# Maximum (seconds, MiB of peak resident memory) for a fresh process to
+# import the controller and load each activity. Seconds are measured
+# on a development machine - scale them with --startup-budget-scale on
+# slower boards.
+STARTUP_BUDGETS = {
+    'lights': (1.0, 50),
+    'blocks': (1.0, 55),
+    'cone': (1.0, 50),
+    'presence': (1.0, 75),
+}
+# Run in a fresh interpreter to load an activity and report its startup
+STARTUP_SCRIPT = """
+import json, sys
+from shooting_stars.__main__ import load_activity
+from shooting_stars.utils import get_max_rss_mib
+load_activity(sys.argv[1])
+print(json.dumps({'max_rss_mib': get_max_rss_mib()}))
+"""
+
+parser = ArgumentParser(prog='shooting_stars.benchmarks',
+                        description=('Benchmarks the render hot paths of each activity at increasing input '
+                                     'sizes, optionally comparing against a saved baseline'))
+parser.add_argument('--filter', type=str,
+                    help='Only run benchmarks whose name contains this string')
+parser.add_argument('--seconds', type=float, default=DEFAULT_SECONDS_PER_BENCHMARK,
+                    help='Seconds to time each benchmark for at each scale')
+parser.add_argument('--layout', type=str, default=str(LAYOUT_PATH),
+                    help='Twinkly layout JSON for the cone and presence benchmarks')
+parser.add_argument('--save-baseline', dest='save_baseline', type=str,
+                    help='Save the results to this JSON file')
+parser.add_argument('--baseline', type=str,
+                    help='Compare against results saved with --save-baseline, exiting with an error on regressions')
+parser.add_argument('--tolerance', type=float, default=DEFAULT_REGRESSION_TOLERANCE,
+                    help='Fraction slower than the baseline median that counts as a regression')
+parser.add_argument('--startup-budget-scale', dest='startup_budget_scale', type=float, default=1,
+                    help='Multiply the startup time budgets by this (e.g. for slower boards)')
+parser.add_argument('--json', action='store_true',
+                    help='Print the results as JSON')
+
+
+def load_layout(path):
+    with open(path) as layout_file:
+        return json.load(layout_file)
+
+
+def get_lights(count, rng):
+    """Return count lights documents, as published by the lights
+    subscription, cycling through every colour mode and animation."""
+    colour_modes = ['white', 'colour', 'rainbow', 'gradual']
+    animations = ['static', 'twinkle', 'rain', 'wave']
+    return {
+        f'light{light_idx}': {
+            'idx': light_idx % 10,
+            'colourMode': colour_modes[light_idx % len(colour_modes)],
+            'colourHue': rng.random(),
+            'colourSaturation': rng.random(),
+            'animation': animations[(light_idx // len(colour_modes)) % len(animations)],
+        }
+        for light_idx in range(count)
+    }
+
+
+def fill_board(game, filled_rows, rng):
+    """Fill the bottom rows of the game's board with random minos, leaving
+    one hole in each row so that no lines are cleared."""
+    board_rows, board_cols = game.board.shape
+    for row_i in range(board_rows - filled_rows, board_rows):
+        row = rng.integers(MinoType.I, MinoType.Z + 1, size=board_cols)
+        row[rng.integers(board_cols)] = MinoType.EMPTY
+        game.board[row_i] = row
+
+
+def get_painter_movements(count, rng, timestamp, movement_count=20):
+    """Return movement_count movements for count painters, as published
+    by the paint subscription."""
+    return {
+        f'painter{painter_idx}': [
+            {
+                'timestamp': timestamp - (movement_idx * 1000),
+                'colour': {'hue': rng.random(), 'saturation': rng.random()},
+                'velocities': [
+                    dict(zip('xyz', rng.normal(scale=0.5, size=3).tolist()))
+                    for _ in range(5)
+                ],
+            }
+            for movement_idx in reversed(range(movement_count))
+        ]
+        for painter_idx in range(count)
+    }
+
+
+def bench_animation_render_frame(scale, context):
+    rng = np.random.default_rng(0)
+    device = CaptureDevice()
+    lights = get_lights(scale, rng)
+    animation_state = AnimationState()
+    frame_idx = 0
+
+    def run():
+        nonlocal frame_idx
+        render_frame(device=device, lights=lights, animation_state=animation_state, frame_idx=frame_idx)
+        frame_idx += 1
+    return run
+
+
+def bench_blocks_render_game(scale, context):
+    rng = np.random.default_rng(0)
+    device = CaptureDevice()
+    game = TrainableBlocksGame.new_game(BlocksTrainer(), seed=0)
+    fill_board(game, scale, rng)
+    return lambda: render_game(device=device, game=game)
+
+
+def bench_blocks_load_picture(scale, context):
+    picture_keys = PICTURE_KEYS[:scale]
+
+    def run():
+        for picture_key in picture_keys:
+            load_picture(picture_key)
+    return run
+
+
+def bench_blocks_trainer_test(scale, context):
+    rng = np.random.default_rng(0)
+    trainer = BlocksTrainer(search_depth=scale, search_budget_seconds=float('inf'))
+    game = TrainableBlocksGame.new_game(trainer, seed=0)
+    fill_board(game, 8, rng)
+    # Train on a few placements so that moves are scored by a model
+    for _ in range(10):
+        trainer.train(GameState(rs=game.rs, board=game.board.copy(), piece=dataclasses.replace(game.piece)))
+    state = GameState(
+        rs=game.rs,
+        board=game.board.copy(),
+        piece=dataclasses.replace(game.piece),
+        next_pieces=tuple(game.queue[:scale - 1]),
+    )
+
+    def run():
+        # Measure the search rather than cache hits
+        trainer.search_cache.clear()
+        trainer.test(state)
+    return run
+
+
+def bench_compositor_compose(scale, context):
+    rng = np.random.default_rng(0)
+    compositor = Compositor(light_count=len(context['layout']['coordinates']), component_count=3)
+    layers = [
+        compositor.add_layer(f'layer{layer_idx}', opacity=int(rng.integers(1, 255)),
+                             blend_mode=BLEND_MODES[layer_idx % len(BLEND_MODES)])
+        for layer_idx in range(scale)
+    ]
+    for layer in layers:
+        layer.set_pixels(rng.integers(0, 256, compositor.shape, dtype=np.uint8))
+
+    def run():
+        # Change the bottom layer so that every layer is re-blended
+        layers[0].draw()
+        compositor.compose()
+    return run
+
+
+def get_cone_playback(scale, context):
+    """Return a PaintState for scale painters, and a function that
+    advances its playback by a frame (as run_cone does) so that painters
+    move between frames. A movement is added for each painter every
+    second so that none run out of steps."""
+    rng = np.random.default_rng(0)
+    light_positions = np.array([
+        [point['z'], point['x'], point['y']]
+        for point in context['layout']['coordinates']
+    ])
+    paint_state = PaintState(light_positions=light_positions, max_painters=max(scale, 1))
+    paint_state.last_movement_timestamp = 0
+    playback = {'now_milliseconds': 100_000, 'movement_timestamp': 100_000}
+    paint_state.add_movements(get_painter_movements(scale, rng, playback['movement_timestamp']))
+    paint_state.tick_state(now_milliseconds=playback['now_milliseconds'])
+
+    def advance():
+        playback['now_milliseconds'] += FRAME_DELAY_SECONDS * 1000
+        if playback['now_milliseconds'] >= playback['movement_timestamp']:
+            playback['movement_timestamp'] += 1000
+            paint_state.add_movements(
+                get_painter_movements(scale, rng, playback['movement_timestamp'], movement_count=1))
+        paint_state.tick_state(now_milliseconds=playback['now_milliseconds'])
+    return paint_state, advance
+
+
+def bench_cone_tick_state(scale, context):
+    _, advance = get_cone_playback(scale, context)
+    return advance
+
+
+def bench_cone_tick_frame(scale, context):
+    paint_state, advance = get_cone_playback(scale, context)
+    # Render painters that move on every frame, without timing their
+    # playback
+    frame_states = []
+    for _ in range(CONE_PLAYBACK_FRAMES):
+        advance()
+        frame_states.append(dict(paint_state.painter_to_state))
+    frame_states = itertools.cycle(frame_states)
+
+    def run():
+        paint_state.painter_to_state = next(frame_states)
+        paint_state.tick_frame()
+    return run
+
+
+def bench_presence_tick_frame(scale, context):
+    rng = np.random.default_rng(0)
+    light_positions = np.array([
+        [point['y'], point['x']]
+        for point in context['layout']['coordinates']
+    ])
+    local_config = {
+        'colour': '#ff8800',
+        'frameDelayMilliseconds': 80,
+        'framesBetweenSend': 12,
+        'frameLingerMilliseconds': 5000,
+        'presenceMapSize': [30, 30],
+        'presenceScalingFactor': 0.02,
+        'presenceFadeoutFactor': 0.25,
+    }
+    presence_state = PresenceState(light_positions=light_positions, local_config=local_config,
+                                   max_remote_presences=max(scale, 1))
+    presence_state.local_presence_map = (rng.random((30, 30)) * 255).astype(np.uint8)
+    remote_presences = [
+        {
+            'id': f'remote{remote_idx}',
+            'config': {'colour': '#%06x' % rng.integers(0x1000000)},
+            'presenceEvents': [],
+        }
+        for remote_idx in range(scale)
+    ]
+    presence_state.update_remote_presences(remote_presences)
+    remote_maps = [(rng.random((30, 30)) * 255).astype(np.uint8) for _ in range(scale)]
+
+    def run():
+        # Keep every remote's schedule topped up so each frame
+        # composites every presence.
+        for presence, presence_map in zip(presence_state.remote_id_to_presence.values(), remote_maps):
+            if len(presence.presence_maps) == 0:
+                presence.presence_maps.append(presence_map, 10)
+        presence_state.tick_frame()
+    return run
+
+
+@dataclasses.dataclass
+class Benchmark:
+    name: str
+    # Returns a function to benchmark for a given scale of input
+    setup: callable
+    # Name of what the scale measures, and the scales to run at
+    scale_name: str
+    scales: list[int]
+
+
+BENCHMARKS = [
+    Benchmark('animation.render_frame', bench_animation_render_frame, 'lights', [10, 100, 1000]),
+    Benchmark('blocks.render_game', bench_blocks_render_game, 'filled_rows', [0, 9, 17]),
+    Benchmark('blocks.load_picture', bench_blocks_load_picture, 'pictures', [1, len(PICTURE_KEYS)]),
+    Benchmark('blocks.BlocksTrainer.test', bench_blocks_trainer_test, 'search_depth', [1, 2, 3]),
+    Benchmark('compositor.Compositor.compose', bench_compositor_compose, 'layers', [1, 4, 16]),
+    Benchmark('cone.PaintState.tick_state', bench_cone_tick_state, 'painters', [1, 10, 40]),
+    Benchmark('cone.PaintState.tick_frame', bench_cone_tick_frame, 'painters', [1, 10, 40]),
+    Benchmark('presence.PresenceState.tick_frame', bench_presence_tick_frame, 'remotes', [0, 4, 16, 64]),
+]
+
+
+def time_calls(run, seconds):
+    """Call run repeatedly for about the given number of seconds,
+    returning the duration of each call."""
+    # Warm up caches
+    run()
+    durations = []
+    end_time = perf_counter() + seconds
+    while perf_counter() < end_time or len(durations) < 3:
+        start_time = perf_counter()
+        run()
+        durations.append(perf_counter() - start_time)
+    return np.array(durations)
+
+
+def measure_allocations(run):
+    """Return the mean peak bytes allocated during a call to run, and the
+    mean bytes still allocated after it."""
+    tracemalloc.start()
+    try:
+        peak_bytes = []
+        retained_bytes = []
+        for _ in range(ALLOCATION_CALLS):
+            start_bytes, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            run()
+            end_bytes, end_peak_bytes = tracemalloc.get_traced_memory()
+            peak_bytes.append(end_peak_bytes - start_bytes)
+            retained_bytes.append(end_bytes - start_bytes)
+    finally:
+        tracemalloc.stop()
+    return np.mean(peak_bytes), np.mean(retained_bytes)
+
+
+def run_benchmark(benchmark, scale, *, context, seconds):
+    run = benchmark.setup(scale, context)
+    durations = time_calls(run, seconds)
+    peak_bytes, retained_bytes = measure_allocations(run)
+    return {
+        'benchmark': benchmark.name,
+        'scale_name': benchmark.scale_name,
+        'scale': scale,
+        'calls': len(durations),
+        'median_ms': np.median(durations) * 1000,
+        'p90_ms': np.percentile(durations, 90) * 1000,
+        'peak_alloc_kb': peak_bytes / 1024,
+        'retained_alloc_kb': retained_bytes / 1024,
+    }
+
+
+def measure_startup(activity):
+    """Start STARTUP_RUNS fresh processes that each load an activity,
+    returning a result with their startup times and peak memory."""
+    package_dir = Path(__file__).resolve().parents[1]
+    durations = []
+    max_rss_mib = []
+    for _ in range(STARTUP_RUNS):
+        start_time = perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, activity],
+            cwd=package_dir, capture_output=True, check=True, text=True,
+        ).stdout
+        durations.append(perf_counter() - start_time)
+        max_rss_mib.append(json.loads(output.splitlines()[-1])['max_rss_mib'])
+    return {
+        'benchmark': 'startup',
+        'scale_name': 'activity',
+        'scale': activity,
+        'calls': STARTUP_RUNS,
+        'median_ms': np.median(durations) * 1000,
+        'p90_ms': np.percentile(durations, 90) * 1000,
+        'max_rss_mib': max(max_rss_mib),
+    }
+
+
+def find_over_budget(results, budget_scale):
+    """Return a message for each startup result over its budget."""
+    over_budget = []
+    for result in results:
+        if result['benchmark'] != 'startup':
+            continue
+        budget_seconds, budget_mib = STARTUP_BUDGETS[result['scale']]
+        budget_ms = budget_seconds * budget_scale * 1000
+        if result['median_ms'] > budget_ms:
+            over_budget.append(f'startup ({result["scale"]}): {result["median_ms"]:.0f}ms > {budget_ms:.0f}ms')
+        if result['max_rss_mib'] > budget_mib:
+            over_budget.append(f'startup ({result["scale"]}): {result["max_rss_mib"]:.1f}MiB > {budget_mib}MiB')
+    return over_budget
+
+
+def find_regressions(results, baseline_results, tolerance):
+    """Return a message for each result more than tolerance slower than
+    the same benchmark and scale in the baseline."""
+    key_to_baseline = {
+        (result['benchmark'], result['scale']): result
+        for result in baseline_results
+    }
+    regressions = []
+    for result in results:
+        baseline = key_to_baseline.get((result['benchmark'], result['scale']))
+        if baseline is None:
+            continue
+        ratio = result['median_ms'] / baseline['median_ms']
+        if ratio > (1 + tolerance):
+            regressions.append(
+                f'{result["benchmark"]} ({result["scale_name"]}={result["scale"]}): '
+                f'{baseline["median_ms"]:.3f}ms -> {result["median_ms"]:.3f}ms ({ratio:.2f}x)'
+            )
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    context = {'layout': load_layout(args.layout)}
+
+    results = []
+    for benchmark in BENCHMARKS:
+        if args.filter and args.filter not in benchmark.name:
+            continue
+        for scale in benchmark.scales:
+            result = run_benchmark(benchmark, scale, context=context, seconds=args.seconds)
+            result = {key: (value.item() if isinstance(value, np.generic) else value)
+                      for key, value in result.items()}
+            results.append(result)
+            if not args.json:
+                print(f'{result["benchmark"]} {result["scale_name"]}={result["scale"]}: '
+                      f'median {result["median_ms"]:.3f}ms, p90 {result["p90_ms"]:.3f}ms, '
+                      f'peak alloc {result["peak_alloc_kb"]:.1f}KiB, '
+                      f'retained {result["retained_alloc_kb"]:.1f}KiB ({result["calls"]} calls)',
+                      flush=True)
+
+    if not args.filter or args.filter in 'startup':
+        for activity in ACTIVITIES:
+            result = measure_startup(activity)
+            result = {key: (value.item() if isinstance(value, np.generic) else value)
+                      for key, value in result.items()}
+            results.append(result)
+            if not args.json:
+                print(f'startup activity={activity}: median {result["median_ms"]:.0f}ms, '
+                      f'p90 {result["p90_ms"]:.0f}ms, peak RSS {result["max_rss_mib"]:.1f}MiB',
+                      flush=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    over_budget = find_over_budget(results, args.startup_budget_scale)
+    if over_budget:
+        print('Over budget:\n' + '\n'.join(f'  {message}' for message in over_budget), file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(f'  {regression}' for regression in regressions),
+                  file=sys.stderr)
+
+    if over_budget or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
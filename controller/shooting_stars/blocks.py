@@ -1,27 +1,36 @@
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 import dataclasses
 import logging
 from pathlib import Path
 from queue import SimpleQueue, Empty
 from threading import Thread, Lock
-from time import sleep, monotonic
-from typing import Iterator
+from typing import Iterator, Optional
 
 import numpy as np
-from PIL import Image
-import river.naive_bayes
 import tetris
-from tetris import MinoType, Piece
+from tetris import MinoType, Piece, PieceType
 from tetris.board import Board
-from tetris.engine import RotationSystem
-from tetris.types import Minos
+from tetris.engine import Gravity, RotationSystem
+from tetris.impl.gravity import SECOND
+from tetris.impl.presets import Modern
+from tetris.types import Move as GameMove, MoveKind
 
+from .clock import REAL_CLOCK
+from .compositor import Compositor, get_fade_opacity
 from .device import FRAME_DTYPE, DeviceDisconnected
+from .metrics import metrics
+from .naive_bayes import GaussianNB
+from .utils import save_npz_atomic
 
 DEBUG = False
 
 FRAMES_PER_SECOND = 5
 FRAME_DELAY_SECONDS = 1 / FRAMES_PER_SECOND
+# Maximum number of inputs to apply between two game ticks - any
+# further inputs wait for the next frame so that floods of inputs
+# can't starve regular rendering.
+MAX_INPUTS_PER_FRAME = 6
 
 LED_COUNT = 200
 COMPONENT_COUNT = 3
@@ -55,10 +64,45 @@ AI_TIMEOUT_SECONDS = 15
 # Number of seconds to wait between AI moves
 AI_MOVE_WAIT_SECONDS = 0.75
 
+# Features the AI model uses to represent a possible move, and the
+# labels it learns to assign to them.
+MOVE_FEATURES = ['height_diff', 'hole_diff', 'lines_cleared']
+MOVE_LABELS = ['CHOSEN', 'NOT_CHOSEN']
+CHOSEN_LABEL_INDEX = MOVE_LABELS.index('CHOSEN')
+
+# Number of pieces the current player must place before their own
+# model is weighted equally with the baseline model.
+AI_BASELINE_BLEND_PIECES = 20
+# Number of seconds between checkpoints of the baseline model.
+AI_CHECKPOINT_INTERVAL_SECONDS = 60
+# Maximum number of placed pieces to keep in the training history.
+AI_HISTORY_PIECES = 1000
+
+# Number of pieces (the current piece plus pieces from the game's
+# queue) the AI plans placements for. A depth of 1 only scores the
+# current piece's placements.
+AI_SEARCH_DEPTH = 1
+# Number of the best-scoring placements to look ahead from at each
+# level of the search.
+AI_SEARCH_BEAM_WIDTH = 4
+# Maximum number of seconds to spend looking ahead when choosing a
+# move - if this runs out, only the moves whose search completed are
+# chosen between. Matches the measured time the AI used to take to
+# choose a move with single-piece scoring alone (about 13ms), so
+# choosing a move is no slower than it was.
+AI_SEARCH_BUDGET_SECONDS = 0.013
+# Maximum number of (board, piece) move scores to remember between
+# searches. Scores don't depend on the pieces that follow, so they are
+# reused by the searches for later moves.
+AI_SEARCH_CACHE_SIZE = 4096
+
 PICTURE_DURATION_SECONDS = 6
 PICTURE_STEP_SECONDS = 1.2
 PICTURE_DURATION_FRAMES = PICTURE_DURATION_SECONDS * FRAMES_PER_SECOND
 PICTURE_STEP_FRAMES = PICTURE_STEP_SECONDS * FRAMES_PER_SECOND
+# Pictures fade in over the game at the start, and out at the end.
+PICTURE_FADE_SECONDS = 0.6
+PICTURE_FADE_FRAMES = round(PICTURE_FADE_SECONDS * FRAMES_PER_SECOND)
 
 PICTURE_DIR = Path(__file__).resolve().parent / 'pixel_art'
 PICTURE_KEYS = [
@@ -90,9 +134,9 @@ def get_frame_index(row_i, col_i):
     # logging.info(f'({row_i}, {col_i}), {col_min_frame_i}, {frame_i_within_col}, {frame_i}')
     return frame_i
 
-def render_game(*, device, game):
-    # The frame
-    frame = np.zeros((LED_COUNT, COMPONENT_COUNT), dtype=FRAME_DTYPE)
+def draw_game(*, frame, game):
+    """Draw the game into frame, replacing its contents."""
+    frame[:] = 0
 
     # The playfield is GAME_ROWS x COLS, with the first row being the top
     # and the first col being the left.
@@ -115,11 +159,17 @@ def render_game(*, device, game):
     # frame[100, RGB] = (0, 0, 255)
     # frame[199, RGB] = (255, 255, 0)
 
+
+def render_game(*, device, game):
+    frame = np.zeros((LED_COUNT, COMPONENT_COUNT), dtype=FRAME_DTYPE)
+    draw_game(frame=frame, game=game)
     device.set_frame_array(frame)
 
 
 def load_picture(picture_key):
     gif_path = Path(PICTURE_DIR / f'{picture_key}.gif')
+    # Imported here so that only loading pictures needs Pillow
+    from PIL import Image
     gif = Image.open(gif_path)
     picture = []
     for i in range(gif.n_frames):
@@ -133,9 +183,34 @@ def load_picture(picture_key):
     return picture
 
 
-def render_picture(*, device, picture, frame):
+def get_picture_frame(*, picture, frame):
     step = int((frame // PICTURE_STEP_FRAMES) % len(picture))
-    device.set_frame_array(picture[step])
+    return picture[step]
+
+
+def render_layers(*, device, compositor, game_layer, game_frame, game):
+    """Draw the game into game_frame and update its layer (so that
+    layers are only re-blended if the game changed), then send the
+    composite of every layer to the device."""
+    draw_game(frame=game_frame, game=game)
+    game_layer.set_pixels(game_frame)
+    device.set_frame_array(compositor.compose())
+
+
+def get_board_hash(board) -> bytes:
+    """Compact hash of the filled cells of a board, packing each
+    column into a bitboard."""
+    return np.packbits(np.asarray(board) > 0, axis=0).tobytes()
+
+
+def clear_lines(board: np.ndarray) -> np.ndarray:
+    """Return a copy of the board with full rows removed and the rows
+    above them shifted down."""
+    full_rows = np.all(board, axis=1)
+    cleared_board = np.zeros_like(board)
+    kept_rows = board[~full_rows]
+    cleared_board[board.shape[0] - kept_rows.shape[0]:] = kept_rows
+    return cleared_board
 
 
 @dataclasses.dataclass(frozen=True)
@@ -144,6 +219,8 @@ class GameState:
     rs: RotationSystem
     board: Board
     piece: Piece
+    # Types of the pieces that will follow the current piece
+    next_pieces: tuple[PieceType, ...] = ()
 
 
 @dataclasses.dataclass(frozen=True)
@@ -154,30 +231,159 @@ class Move:
     r: int
 
 
+class ClockGravity(Gravity):
+    """The same as tetris' InfinityGravity (Marathon gravity with Infinity
+    lock delay), but reading the time from the game's clock, so that
+    pieces drop in step with simulated time."""
+
+    # Nanoseconds a piece can rest on the stack before it locks
+    IDLE_LOCK_NANOSECONDS = 500_000_000
+    # Number of moves that can reset the idle lock
+    MAX_LOCK_RESETS = 15
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.idle_lock_started = None
+        self.lock_resets = 0
+        self.last_drop = game.clock.monotonic_ns()
+
+    def is_resting(self):
+        piece = self.game.piece
+        return self.game.rs.overlaps(minos=piece.minos, px=piece.x + 1, py=piece.y)
+
+    def calculate(self, delta=None):
+        level = self.game.level
+        drop_delay = (0.8 - ((level - 1) * 0.007)) ** (level - 1) * SECOND
+        now = self.game.clock.monotonic_ns()
+
+        if delta is not None:
+            if delta.kind == MoveKind.HARD_DROP or delta.kind == MoveKind.SWAP or not self.is_resting():
+                self.idle_lock_started = None
+                self.lock_resets = 0
+
+            if self.idle_lock_started is not None and (delta.x or delta.y or delta.r):
+                self.idle_lock_started = now
+                self.lock_resets += 1
+
+            if self.idle_lock_started is None and self.is_resting():
+                self.idle_lock_started = now
+
+        idle_lock_done = (
+            self.idle_lock_started is not None
+            and (self.idle_lock_started + self.IDLE_LOCK_NANOSECONDS) <= now
+        )
+        if idle_lock_done or self.lock_resets >= self.MAX_LOCK_RESETS:
+            self.game.push(GameMove(kind=MoveKind.HARD_DROP, auto=True))
+            self.idle_lock_started = None
+            self.lock_resets = 0
+
+        since_drop = now - self.last_drop
+        if since_drop >= drop_delay:
+            self.game.push(GameMove(kind=MoveKind.SOFT_DROP, x=int(since_drop / drop_delay), auto=True))
+            self.last_drop = now
+            if self.idle_lock_started is None and self.is_resting():
+                self.idle_lock_started = now
+
+
+# Modern guideline rules, with gravity driven by the game's clock
+ENGINE = dataclasses.replace(Modern, gravity=ClockGravity)
+
+
 class BlocksTrainer:
     """Runs a separate thread for training and applying the AI model.
 
+    Moves are scored by blending two models: a model of the current
+    player (reset whenever a new player takes over), and a baseline
+    model that learns from every player. The baseline model is loaded
+    at startup from checkpoint_path (or baseline_path if there is no
+    checkpoint yet), and periodically checkpointed back to
+    checkpoint_path.
+
     Note that a board's 0/x dimension is vertical/rows going
     top-to-bottom, and the 1/y dimension is horizontal/columns going
     right-to-left.
     """
 
-    def __init__(self):
+    def __init__(self, *, search_depth=AI_SEARCH_DEPTH,
+                 search_beam_width=AI_SEARCH_BEAM_WIDTH,
+                 search_budget_seconds=AI_SEARCH_BUDGET_SECONDS,
+                 search_cache_size=AI_SEARCH_CACHE_SIZE,
+                 baseline_blend_pieces=AI_BASELINE_BLEND_PIECES,
+                 checkpoint_path=None, baseline_path=None, save_history=False,
+                 clock=REAL_CLOCK, rng=np.random):
+        self.clock = clock
+        # Breaks ties between equally-scored moves
+        self.rng = rng
         self.train_queue = SimpleQueue()
         self.test_queue = SimpleQueue()
         self.stopped = False
         self.move = None
         self.move_lock = Lock()
         self.reset_flag = False
-        self.reset_model()
+        self.search_depth = search_depth
+        self.search_beam_width = search_beam_width
+        self.search_budget_seconds = search_budget_seconds
+        self.search_cache_size = search_cache_size
+        # LRU cache of (board hash, piece type) -> (moves, scores)
+        self.search_cache = OrderedDict()
+        self.model = GaussianNB(classes=MOVE_LABELS, n_features=len(MOVE_FEATURES))
+        self.baseline_model = GaussianNB(classes=MOVE_LABELS, n_features=len(MOVE_FEATURES))
+        self.baseline_blend_pieces = baseline_blend_pieces
+        # (features, labels) for each recently placed piece
+        self.history = deque(maxlen=AI_HISTORY_PIECES)
+        self.save_history = save_history
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_dirty = False
+        self.last_checkpoint_time = self.clock.monotonic()
+        self.load_baseline(baseline_path)
 
     def reset_model(self):
+        """Reset the model of the current player (the baseline model is
+        kept)."""
         logging.info('Model reset')
-        self.model = river.naive_bayes.GaussianNB()
+        self.model.reset()
+        # Cached scores are only valid for the model that produced them.
+        self.search_cache.clear()
+
+    def load_baseline(self, baseline_path):
+        """Load the baseline model (and any saved history) from the
+        checkpoint, or from baseline_path if there is no checkpoint."""
+        for path in [self.checkpoint_path, baseline_path]:
+            if path is None or not Path(path).exists():
+                continue
+            try:
+                with np.load(path) as checkpoint:
+                    self.baseline_model.restore(checkpoint)
+                    if 'history_features' in checkpoint:
+                        split_indexes = np.cumsum(checkpoint['history_lengths'])[:-1]
+                        self.history.extend(zip(
+                            np.split(checkpoint['history_features'], split_indexes),
+                            np.split(checkpoint['history_labels'], split_indexes),
+                        ))
+            except Exception:
+                logging.exception(f'Failed to load model from: {path}')
+                self.baseline_model.reset()
+                self.history.clear()
+                continue
+            logging.info(f'Loaded model from: {path}')
+            return
+
+    def save_checkpoint(self):
+        """Atomically save the baseline model (and optionally the history)
+        to checkpoint_path."""
+        arrays = self.baseline_model.snapshot()
+        if self.save_history and self.history:
+            arrays['history_features'] = np.concatenate([features for features, _ in self.history])
+            arrays['history_labels'] = np.concatenate([labels for _, labels in self.history])
+            arrays['history_lengths'] = np.array([len(labels) for _, labels in self.history])
+        save_npz_atomic(self.checkpoint_path, **arrays)
+        self.checkpoint_dirty = False
+        self.last_checkpoint_time = self.clock.monotonic()
+        logging.info(f'Saved model checkpoint to: {self.checkpoint_path}')
 
     def start(self):
         """Run the trainer in a new thread"""
-        monitor_thread = Thread(target=self.run)
+        monitor_thread = Thread(target=self.run, name='blocks-trainer')
         monitor_thread.start()
 
     def stop(self):
@@ -186,27 +392,63 @@ class BlocksTrainer:
 
     def run(self):
         while not self.stopped:
-            # Reset the model if the main thread set the reset_flag
-            if self.reset_flag:
-                try:
-                    self.reset_model()
-                    self.reset_flag = False
-                except:
-                    logging.exception('Reset failed')
-            # Process the next training record
+            self.step()
+
+        if self.checkpoint_path is not None and self.checkpoint_dirty:
+            try:
+                self.save_checkpoint()
+            except:
+                logging.exception('Checkpoint failed')
+
+    def drain(self):
+        """Process queued records until both queues are empty - used in
+        place of the trainer thread when simulating."""
+        self.step()
+        while not (self.train_queue.empty() and self.test_queue.empty()):
+            self.step()
+
+    def step(self):
+        """Process the next record from each queue."""
+        # Reset the model if the main thread set the reset_flag
+        if self.reset_flag:
             try:
-                self.train(self.train_queue.get_nowait())
-            except Empty:
-                pass
+                self.reset_model()
+                self.reset_flag = False
             except:
-                logging.exception('Train failed')
-            # Process the next test record
+                logging.exception('Reset failed')
+        metrics.set_gauge('queue_depth', self.train_queue.qsize(), queue='blocks_train')
+        metrics.set_gauge('queue_depth', self.test_queue.qsize(), queue='blocks_test')
+        metrics.set_gauge('container_size', len(self.search_cache), container='blocks_search_cache')
+        metrics.set_gauge('container_size', len(self.history), container='blocks_history')
+        # Process the next training record
+        try:
+            train_state = self.train_queue.get_nowait()
+            with metrics.stage('train', activity='blocks'):
+                self.train(train_state)
+        except Empty:
+            pass
+        except:
+            logging.exception('Train failed')
+        # Process the next test record
+        try:
+            test_state = self.test_queue.get_nowait()
+            with metrics.stage('ai', activity='blocks'):
+                self.test(test_state)
+        except Empty:
+            pass
+        except:
+            logging.exception('Test failed')
+        # Periodically checkpoint the baseline model
+        if (
+                self.checkpoint_path is not None
+                and self.checkpoint_dirty
+                and (self.clock.monotonic() - self.last_checkpoint_time) > AI_CHECKPOINT_INTERVAL_SECONDS
+        ):
             try:
-                self.test(self.test_queue.get_nowait())
-            except Empty:
-                pass
+                self.save_checkpoint()
             except:
-                logging.exception('Test failed')
+                logging.exception('Checkpoint failed')
+                self.last_checkpoint_time = self.clock.monotonic()
 
     def get_possible_moves(self, state: GameState) -> Iterator[Move]:
         """For a given state, return the list of possible moves that could be
@@ -221,106 +463,199 @@ class BlocksTrainer:
             for y in range(min_y, max_y + 1):
                 yield Move(y=y, r=r)
 
-    def overlaps(self, *, board: Board, minos: Minos, x: int, y: int) -> bool:
-        """Checks whether a piece with the given minos, x, and y overlaps the
-        top/bottom edges of the board or another piece.
-
-        No need to check y-axis currently because we do not suggest
-        moves that could be out of bounds.
-
-        """
-        for mx, my in minos:
-            if (x + mx) not in range(board.shape[0]):
-                return True
-            if board[x + mx, y + my] != 0:
-                return True
-        return False
-
-    def get_board_stats(self, board: Board) -> dict[str, float]:
+    def get_board_stats(self, boards: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
         """
-        Get stats about the current board state.
+        Get the max height and hole count of a board, or of each board
+        in an array of boards (with shape (..., rows, cols)).
         """
-        max_height = 0
-        hole_count = 0
-
         # Convert piece numbers to Boolean
-        for col in (np.array(board) > 0).T:
-            # Skip empty columns
-            if not any(col):
-                continue
-
-            # First non-zero index in column
-            highest_filled_idx = np.argmax(col)
-            # Indexes start at the top, so height is (board height - index)
-            height = board.shape[0] - highest_filled_idx
-            if height > max_height:
-                max_height = height
-            # Count zero values after highest_filled_index
-            hole_count += np.sum(~col[highest_filled_idx:])
-
-        return {
-            'max_height': max_height,
-            'hole_count': hole_count,
-        }
-
-    def get_move_features(self, state: GameState, move: Move,
-                          pre_move_stats: dict[str, float]) -> dict[str, float]:
-        """
-        Get a dictionary of features to represent a possible move in the AI model.
-
-        Features inspired by: https://levelup.gitconnected.com/tetris-ai-in-python-bd194d6326ae
-        """
-        y = move.y
+        filled = np.asarray(boards) > 0
+        # Indexes start at the top, so a column's height is (board
+        # height - index of its first filled cell), or 0 if it is empty
+        heights = np.where(filled.any(axis=-2), filled.shape[-2] - filled.argmax(axis=-2), 0)
+        # Holes are the empty cells below the first filled cell
+        hole_counts = heights - filled.sum(axis=-2)
+        return heights.max(axis=-1), hole_counts.sum(axis=-1)
+
+    def get_drop_row(self, state: GameState, move: Move, tops: np.ndarray) -> int:
+        """Return the row the state's piece comes to rest at when dropped
+        for the given move, given the index of the highest filled cell in
+        each column of the board (or the board height for empty
+        columns)."""
         minos = state.rs.shapes[state.piece.type][move.r]
         # Start at the top of the board to avoid initial check for illegal moves.
         start_x = 0 - min([x for x, _ in minos])
-        # Find the x after dropping
-        x = start_x
-        for possible_x in range(start_x + 1, state.board.shape[0]):
-            if self.overlaps(board=state.board, minos=minos, x=possible_x, y=y):
-                break
-            x = possible_x
-
-        post_move_board = state.board.copy()
-        for mx, my in minos:
-            post_move_board[x + mx, y + my] = state.piece.type
+        # Dropping from the top, the piece stops just above the first
+        # filled cell it would overlap.
+        return max(start_x, min(tops[move.y + my] - mx for mx, my in minos) - 1)
+
+    def get_column_tops(self, board: np.ndarray) -> np.ndarray:
+        """Return the index of the highest filled cell in each column of
+        the board, or the board height for empty columns."""
+        filled = board > 0
+        return np.where(filled.any(axis=0), filled.argmax(axis=0), board.shape[0])
+
+    def get_post_move_board(self, state: GameState, move: Move) -> np.ndarray:
+        """Return a copy of the state's board (as a NumPy array) with the
+        state's piece dropped into place for the given move."""
+        board = np.array(state.board)
+        x = self.get_drop_row(state, move, self.get_column_tops(board))
+        for mx, my in state.rs.shapes[state.piece.type][move.r]:
+            board[x + mx, move.y + my] = state.piece.type
+        return board
+
+    def get_features_matrix(self, state: GameState, moves: list[Move]) -> np.ndarray:
+        """
+        Get a matrix with a row of MOVE_FEATURES to represent each of the
+        possible moves in the AI model.
 
-        post_move_stats = self.get_board_stats(post_move_board)
-        return {
-            'height_diff': post_move_stats['max_height'] - pre_move_stats['max_height'],
-            'hole_diff': post_move_stats['hole_count'] - pre_move_stats['hole_count'],
-            # Count rows that are completely full.
-            'lines_cleared': np.sum(np.all(post_move_board, axis=1)),
-        }
+        Features inspired by: https://levelup.gitconnected.com/tetris-ai-in-python-bd194d6326ae
+        """
+        board = np.asarray(state.board)
+        tops = self.get_column_tops(board)
+        # Drop the piece for every move into its own copy of the board
+        post_move_boards = np.repeat((board > 0)[np.newaxis], len(moves), axis=0)
+        move_indexes, xs, ys = [], [], []
+        for move_index, move in enumerate(moves):
+            x = self.get_drop_row(state, move, tops)
+            for mx, my in state.rs.shapes[state.piece.type][move.r]:
+                move_indexes.append(move_index)
+                xs.append(x + mx)
+                ys.append(move.y + my)
+        post_move_boards[move_indexes, xs, ys] = True
+
+        pre_move_max_height, pre_move_hole_count = self.get_board_stats(board)
+        post_move_max_heights, post_move_hole_counts = self.get_board_stats(post_move_boards)
+        return np.column_stack([
+            # height_diff
+            post_move_max_heights - pre_move_max_height,
+            # hole_diff
+            post_move_hole_counts - pre_move_hole_count,
+            # lines_cleared: Count rows that are completely full.
+            np.sum(np.all(post_move_boards, axis=2), axis=1),
+        ])
 
     def train(self, state: GameState) -> None:
         """Taking a state that represents a piece positioned just before it
         locks, train the AI that the piece's current position represents the
         user-chosen move, against all other possible moves not chosen being
         chosen."""
-        pre_move_stats = self.get_board_stats(state.board)
-        for move in self.get_possible_moves(state):
-            features = self.get_move_features(state, move, pre_move_stats)
-            chosen = (move.y == state.piece.y) and (move.r == state.piece.r)
-            label = ('CHOSEN' if chosen else 'NOT_CHOSEN')
-            logging.info(f'TRAIN: {features}, {label}')
-            self.model.learn_one(x=features, y=label)
+        moves = list(self.get_possible_moves(state))
+        features = self.get_features_matrix(state, moves)
+        labels = np.array([
+            ('CHOSEN' if (move.y == state.piece.y) and (move.r == state.piece.r) else 'NOT_CHOSEN')
+            for move in moves
+        ])
+        logging.info(f'TRAIN: {features.tolist()}, {labels.tolist()}')
+        self.model.learn_many(features, labels)
+        self.baseline_model.learn_many(features, labels)
+        self.history.append((features, labels))
+        self.checkpoint_dirty = True
+        self.search_cache.clear()
+
+    def score_moves(self, state: GameState) -> tuple[list[Move], np.ndarray]:
+        """Return the possible moves for the state's piece, and the model's
+        probability of each being the CHOSEN move."""
+        moves = list(self.get_possible_moves(state))
+        features = self.get_features_matrix(state, moves)
+        # Weight the current player's model more heavily the more
+        # pieces they have placed.
+        player_pieces = self.model.counts[CHOSEN_LABEL_INDEX]
+        player_weight = (
+            player_pieces / (player_pieces + self.baseline_blend_pieces)
+            if player_pieces > 0 else 0
+        )
+        scores = (
+            player_weight * self.model.predict_proba_many(features)[:, CHOSEN_LABEL_INDEX]
+            + (1 - player_weight) * self.baseline_model.predict_proba_many(features)[:, CHOSEN_LABEL_INDEX]
+        )
+        return moves, scores
+
+    def get_next_state(self, state: GameState, move: Move) -> GameState:
+        """Return the state after making the move and clearing any full
+        lines, with the first of the next_pieces as the new piece."""
+        return GameState(
+            rs=state.rs,
+            board=clear_lines(self.get_post_move_board(state, move)),
+            piece=state.rs.spawn(state.next_pieces[0]),
+            next_pieces=state.next_pieces[1:],
+        )
+
+    def get_beam_indexes(self, scores: np.ndarray) -> np.ndarray:
+        """Indexes of the best scores to look ahead from."""
+        return np.argsort(-scores, kind='stable')[:self.search_beam_width]
+
+    def get_cached_scores(self, state: GameState,
+                          deadline: float) -> Optional[tuple[list[Move], np.ndarray]]:
+        """Return score_moves() for the state, remembering the result for
+        later searches, or None if it isn't cached and the deadline has
+        passed."""
+        key = (get_board_hash(state.board), state.piece.type)
+        if key in self.search_cache:
+            self.search_cache.move_to_end(key)
+            return self.search_cache[key]
+        if self.clock.monotonic() > deadline:
+            return None
+
+        self.search_cache[key] = self.score_moves(state)
+        if len(self.search_cache) > self.search_cache_size:
+            self.search_cache.popitem(last=False)
+        return self.search_cache[key]
+
+    def get_search_value(self, state: GameState, deadline: float) -> Optional[float]:
+        """Return the best total score achievable by placing the state's
+        piece followed by each of its next_pieces, or None if the
+        deadline passed before it could be computed."""
+        cached_scores = self.get_cached_scores(state, deadline)
+        if cached_scores is None:
+            return None
+        moves, scores = cached_scores
+        if not state.next_pieces:
+            return np.max(scores)
+
+        value = -np.inf
+        for move_index in self.get_beam_indexes(scores):
+            next_value = self.get_search_value(
+                self.get_next_state(state, moves[move_index]), deadline)
+            if next_value is None:
+                return None
+            value = max(value, scores[move_index] + next_value)
+        return value
 
     def test(self, state: GameState) -> Move:
         """Use the AI to select the best Move to make given the current game
         state."""
-        pre_move_stats = self.get_board_stats(state.board)
-        moves = list(self.get_possible_moves(state))
-        scores = []
-        for move in moves:
-            features = self.get_move_features(state, move, pre_move_stats)
-            prediction = self.model.predict_proba_one(features)
-            score = prediction.get('CHOSEN', 0)
-            scores.append(score)
-        logging.info(f'TEST: {scores}')
-        scores = np.array(scores)
+        next_pieces = state.next_pieces[:self.search_depth - 1]
+        if not next_pieces:
+            moves, scores = self.score_moves(state)
+            logging.info(f'TEST: {scores}')
+        else:
+            # Look ahead from the best moves for the current piece, in
+            # order of their single-piece scores. If we run out of time,
+            # only choose between the moves whose search completed
+            # (falling back to the single-piece scores if none did).
+            deadline = self.clock.monotonic() + self.search_budget_seconds
+            search_state = dataclasses.replace(state, next_pieces=next_pieces)
+            moves, scores = self.get_cached_scores(search_state, deadline=np.inf)
+            logging.info(f'TEST: {scores}')
+            search_scores = np.full(scores.shape, -np.inf)
+            beam_indexes = self.get_beam_indexes(scores)
+            searched_count = 0
+            for move_index in beam_indexes:
+                next_value = self.get_search_value(
+                    self.get_next_state(search_state, moves[move_index]), deadline)
+                if next_value is None:
+                    break
+                search_scores[move_index] = scores[move_index] + next_value
+                searched_count += 1
+            if searched_count < len(beam_indexes):
+                logging.info(f'Search budget exceeded after {searched_count} of {len(beam_indexes)} moves')
+                metrics.increment('search_budget_exceeded', activity='blocks')
+            if searched_count > 0:
+                scores = search_scores
+
         best_indexes = np.argwhere(scores == np.amax(scores)).flatten()
-        selected_move_index = np.random.choice(best_indexes)
+        selected_move_index = self.rng.choice(best_indexes)
         self.set_move(moves[selected_move_index])
 
     def set_move(self, move):
@@ -334,11 +669,16 @@ class TrainableBlocksGame(tetris.BaseGame):
     position of each locked piece is passed to the given trainer."""
 
     @classmethod
-    def new_game(cls, trainer):
-        return cls(board_size=(GAME_ROWS, COLS),
-                   trainer=trainer)
-
-    def __init__(self, *args, trainer: BlocksTrainer, **kwargs) -> None:
+    def new_game(cls, trainer, seed=None, clock=REAL_CLOCK):
+        return cls(ENGINE,
+                   board_size=(GAME_ROWS, COLS),
+                   seed=seed,
+                   trainer=trainer,
+                   clock=clock)
+
+    def __init__(self, *args, trainer: BlocksTrainer, clock=REAL_CLOCK, **kwargs) -> None:
+        # Set before initialising the game, as the gravity reads it
+        self.clock = clock
         super().__init__(*args, **kwargs)
         self.trainer = trainer
         self.ai_mode = False
@@ -368,6 +708,62 @@ def get_inputs(inputs_sub):
     return []
 
 
+def get_new_inputs(inputs_sub, input_watermark, limit):
+    """Utility to get up to limit of the oldest inputs from inputs_sub
+    that come after input_watermark, along with the watermark after
+    handling them.
+
+    The watermark is the timestamp of the last handled input and the
+    number of inputs handled with that timestamp, so that inputs sharing
+    a timestamp are not lost when limit splits them across frames."""
+    last_timestamp, handled_count = input_watermark
+    pending_inputs = []
+    # Inputs are ordered by timestamp, so only scan back from the end
+    # until we reach inputs that have already been handled.
+    for game_input in reversed(get_inputs(inputs_sub)):
+        if game_input['timestamp'] < last_timestamp:
+            break
+        pending_inputs.append(game_input)
+    pending_inputs.reverse()
+    # Skip inputs at the last timestamp that have already been handled.
+    new_inputs = pending_inputs[handled_count:][:limit]
+    if not new_inputs:
+        return new_inputs, input_watermark
+    new_timestamp = new_inputs[-1]['timestamp']
+    new_count = sum(game_input['timestamp'] == new_timestamp for game_input in new_inputs)
+    if new_timestamp == last_timestamp:
+        new_count += handled_count
+    return new_inputs, (new_timestamp, new_count)
+
+
+def new_game(*, trainer, clock, rng):
+    """Start a new game, seeded from rng."""
+    return TrainableBlocksGame.new_game(trainer, seed=int(rng.randint(2**31)), clock=clock)
+
+
+def handle_inputs(*, game, game_inputs, trainer, clock=REAL_CLOCK, rng=np.random):
+    """Apply game_inputs to the game, returning the game to continue
+    playing (which will be a new game if a player has just taken over
+    from the AI)."""
+    for game_input in game_inputs:
+        if game.ai_mode:
+            # If coming out of ai mode, start a new game
+            # and model, and ignore the first input.
+            game = new_game(trainer=trainer, clock=clock, rng=rng)
+            # The trainer thread resets the model, as it may be using
+            # the model (and search cache) right now.
+            trainer.reset_flag = True
+        elif game_input['type'] == 'left':
+            game.left()
+        elif game_input['type'] == 'right':
+            game.right()
+        elif game_input['type'] == 'rotate':
+            game.rotate()
+        elif game_input['type'] == 'drop':
+            game.hard_drop()
+    return game
+
+
 def get_picture_state(pictures_sub):
     """Utility to get the current picture state from pictures_sub."""
     picture_states = list(pictures_sub.state.values())
@@ -376,15 +772,15 @@ def get_picture_state(pictures_sub):
     return None
 
 
-def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
+def run_blocks(*, device, inputs_sub, pictures_sub, trainer, clock=REAL_CLOCK, rng=np.random):
     """Render frames in a continuous loop"""
     # Ignore any initial inputs
-    last_input_timestamp = None
+    input_watermark = None
     last_picture_timestamp = None
 
-    next_time = monotonic()
-    last_input_time = monotonic()
-    last_ai_time = monotonic()
+    next_time = clock.monotonic()
+    last_input_time = clock.monotonic()
+    last_ai_time = clock.monotonic()
 
     picture_key = None
     picture_frame_counter = 0
@@ -395,48 +791,77 @@ def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
         for picture_key in PICTURE_KEYS
     }
 
+    # Pictures are shown over the game, fading in and out
+    compositor = Compositor(light_count=LED_COUNT, component_count=COMPONENT_COUNT)
+    game_layer = compositor.add_layer('game')
+    picture_layer = compositor.add_layer('picture', opacity=0)
+    game_frame = np.zeros((LED_COUNT, COMPONENT_COUNT), dtype=FRAME_DTYPE)
+
     while True:
-        game = TrainableBlocksGame.new_game(trainer)
+        game = new_game(trainer=trainer, clock=clock, rng=rng)
         update_promises = []
 
         while True:
             next_time = next_time + FRAME_DELAY_SECONDS
-            sleep(max(0, next_time - monotonic()))
-
-            frame_start_time = monotonic()
-
-            # Handle inputs
+            if (clock.monotonic() - next_time) > FRAME_DELAY_SECONDS:
+                metrics.increment('dropped_frames', activity='blocks')
+            frame_inputs_count = 0
+
+            # Apply inputs as soon as they arrive while waiting for the
+            # next frame, rendering the game immediately so that
+            # players don't wait for the next frame to see the result.
+            while True:
+                wait_seconds = next_time - clock.monotonic()
+                if wait_seconds <= 0:
+                    break
+                if frame_inputs_count >= MAX_INPUTS_PER_FRAME:
+                    clock.sleep(wait_seconds)
+                    break
+                if not clock.wait(inputs_sub.updated, wait_seconds):
+                    break
+                inputs_sub.updated.clear()
+                if input_watermark is None:
+                    # Inputs are checked at the start of the frame below
+                    continue
+
+                game_inputs, input_watermark = get_new_inputs(
+                    inputs_sub, input_watermark, MAX_INPUTS_PER_FRAME - frame_inputs_count)
+                if not game_inputs:
+                    continue
+                frame_inputs_count += len(game_inputs)
+                last_input_time = clock.monotonic()
+                web_updates_enabled = True
+                with metrics.stage('ingest', activity='blocks'):
+                    game = handle_inputs(game=game, game_inputs=game_inputs, trainer=trainer,
+                                         clock=clock, rng=rng)
+                if picture_key is None and (device.connected or DEBUG):
+                    try:
+                        with metrics.stage('render', activity='blocks'):
+                            render_layers(device=device, compositor=compositor, game_layer=game_layer,
+                                          game_frame=game_frame, game=game)
+                    except DeviceDisconnected:
+                        logging.info('Device disconnected')
+
+            frame_start_time = clock.monotonic()
+
+            # Handle any inputs that weren't handled as they arrived
             if inputs_sub.state:
-                if last_input_timestamp is None:
+                if input_watermark is None:
                     # Ignore the first inputs on start - as they are probably stale
-                    last_input_timestamp = max(game_input['timestamp'] for game_input in get_inputs(inputs_sub))
-                latest_input_timestamp = last_input_timestamp
-                for game_input in get_inputs(inputs_sub):
-                    # Ignore previously handled inputs.
-                    if game_input['timestamp'] <= last_input_timestamp:
-                        continue
-
-                    last_input_time = monotonic()
+                    initial_timestamps = [game_input['timestamp'] for game_input in get_inputs(inputs_sub)]
+                    last_timestamp = max(initial_timestamps, default=0)
+                    input_watermark = (last_timestamp, initial_timestamps.count(last_timestamp))
+                game_inputs, input_watermark = get_new_inputs(
+                    inputs_sub, input_watermark, MAX_INPUTS_PER_FRAME - frame_inputs_count)
+                if game_inputs:
+                    last_input_time = clock.monotonic()
                     web_updates_enabled = True
-                    if game.ai_mode:
-                        # If coming out of ai mode, start a new game
-                        # and model, and ignore the first input.
-                        game = TrainableBlocksGame.new_game(trainer)
-                        trainer.reset_model()
-                    elif game_input['type'] == 'left':
-                        game.left()
-                    elif game_input['type'] == 'right':
-                        game.right()
-                    elif game_input['type'] == 'rotate':
-                        game.rotate()
-                    elif game_input['type'] == 'drop':
-                        game.hard_drop()
-
-                latest_input_timestamp = max(latest_input_timestamp, game_input['timestamp'])
-                last_input_timestamp = latest_input_timestamp
+                    with metrics.stage('ingest', activity='blocks'):
+                        game = handle_inputs(game=game, game_inputs=game_inputs, trainer=trainer,
+                                             clock=clock, rng=rng)
 
             # Update game mode based on user activity
-            if (monotonic() - last_input_time) > AI_TIMEOUT_SECONDS:
+            if (clock.monotonic() - last_input_time) > AI_TIMEOUT_SECONDS:
                 game.ai_mode = True
 
             # Only run the game if the device is connected or someone is playing
@@ -444,8 +869,8 @@ def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
                 # If in ai_mode, and the trainer has a move ready,
                 # then move toward that move state every
                 # AI_MOVE_WAIT_SECONDS.
-                if game.ai_mode and trainer.move is not None and ((monotonic() - last_ai_time) > AI_MOVE_WAIT_SECONDS):
-                    last_ai_time = monotonic()
+                if game.ai_mode and trainer.move is not None and ((clock.monotonic() - last_ai_time) > AI_MOVE_WAIT_SECONDS):
+                    last_ai_time = clock.monotonic()
                     # Move towards the chosen move, one step at a time.
                     move = trainer.move
                     if game.piece.r != move.r:
@@ -457,7 +882,8 @@ def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
                     else:
                         game.hard_drop()
 
-                game.tick()
+                with metrics.stage('simulate', activity='blocks'):
+                    game.tick()
 
                 if game.ai_mode and trainer.move is None:
                     # Start choosing the next move
@@ -465,6 +891,7 @@ def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
                         rs=game.rs,
                         board=game.board.copy(),
                         piece=dataclasses.replace(game.piece),
+                        next_pieces=tuple(game.queue[:trainer.search_depth - 1]),
                     ))
 
             # Handle picture state
@@ -485,22 +912,26 @@ def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
                     picture_key = None
                 else:
                     picture_frame_counter += 1
+            if picture_key is not None:
+                picture_layer.set_pixels(get_picture_frame(
+                    picture=pictures[picture_key],
+                    frame=picture_frame_counter,
+                ))
+                picture_layer.set_opacity(get_fade_opacity(
+                    frame=picture_frame_counter,
+                    frame_count=(PICTURE_DURATION_FRAMES + 1),
+                    fade_frames=PICTURE_FADE_FRAMES,
+                ))
+            else:
+                picture_layer.set_opacity(0)
 
             # Only render if the device is connected
             if device.connected or DEBUG:
                 try:
-                    if picture_key is not None:
-                        render_picture(
-                            device=device,
-                            picture=pictures[picture_key],
-                            frame=picture_frame_counter,
-                        )
-                    else:
-                        # Send game to device
-                        render_game(
-                            device=device,
-                            game=game,
-                        )
+                    with metrics.stage('render', activity='blocks'):
+                        # Send the game (and any picture over it) to device
+                        render_layers(device=device, compositor=compositor, game_layer=game_layer,
+                                      game_frame=game_frame, game=game)
                 except DeviceDisconnected:
                     logging.info('Device disconnected')
 
@@ -511,23 +942,25 @@ def run_blocks(*, device, inputs_sub, pictures_sub, trainer):
                 if (
                         not promise.completed
                         # Discard a promise if it isn't fulfilled in 5 seconds.
-                        and (frame_start_time - promise.started) < 5_000
+                        and (frame_start_time - promise.started) < 5
                 )
             ]
             if (web_updates_enabled or DEBUG) and len(update_promises) < 2:
                 try:
-                    update_promise = inputs_sub.call('blocks.updateState', [inputs_sub.token, {
-                        'score': game.score,
-                        'playfield': np.array(game.playfield).tolist(),
-                        'aiMode': game.ai_mode,
-                    }])
+                    with metrics.stage('publish', activity='blocks'):
+                        update_promise = inputs_sub.call('blocks.updateState', [inputs_sub.token, {
+                            'score': game.score,
+                            'playfield': np.array(game.playfield).tolist(),
+                            'aiMode': game.ai_mode,
+                        }])
                     update_promises.append(update_promise)
                     if game.ai_mode:
                         web_updates_enabled = False
                 except Exception as ex:
                     logging.info(f'updateState failed: {ex}')
 
-            logging.info(f'Frame render time: {monotonic() - frame_start_time}')
+            metrics.set_gauge('queue_depth', len(update_promises), queue='blocks_updates')
+            metrics.observe('frame', clock.monotonic() - frame_start_time, activity='blocks')
 
             if game.lost:
                 break
@@ -0,0 +1,197 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+import json
+import resource
+from time import perf_counter
+
+import numpy as np
+
+from .blocks import BlocksTrainer, GameState, TrainableBlocksGame
+
+# Maximum number of inputs to spend moving a piece towards the AI's
+# chosen move before dropping it anyway (e.g. if a rotation is
+# blocked).
+MAX_AI_INPUTS_PER_PIECE = 20
+# Types of input that can be played from --inputs.
+INPUT_TYPES = ['left', 'right', 'rotate', 'drop']
+
+parser = ArgumentParser(prog='shooting_stars.blocks_sim',
+                        description=('Plays blocks games back to back without a device or delays, '
+                                     'and reports AI move latency and throughput'))
+parser.add_argument('--games', type=int, default=10,
+                    help='Number of games to play')
+parser.add_argument('--processes', type=int, default=1,
+                    help='Number of games to play in parallel')
+parser.add_argument('--max-pieces', dest='max_pieces', type=int, default=500,
+                    help='Stop each game after this many pieces have been placed')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for the first game (each following game adds 1)')
+parser.add_argument('--inputs', type=str,
+                    help=('JSON file containing a list of inputs to play instead of the AI, either as '
+                          'input types (left/right/rotate/drop) or recorded blocksInputs objects'))
+parser.add_argument('--search-depth', dest='search_depth', type=int, default=1)
+parser.add_argument('--baseline', type=str,
+                    help='.npz file of a pre-trained blocks AI model to play with')
+parser.add_argument('--json', action='store_true',
+                    help='Print the report as JSON')
+
+
+def load_inputs(path):
+    """Load a list of input types from a JSON file."""
+    with open(path) as inputs_file:
+        inputs = json.load(inputs_file)
+    return [
+        (game_input['type'] if isinstance(game_input, dict) else game_input)
+        for game_input in inputs
+    ]
+
+
+def apply_input(game, input_type):
+    """Apply an input to the game, returning the number of lines cleared."""
+    if input_type == 'left':
+        game.left()
+    elif input_type == 'right':
+        game.right()
+    elif input_type == 'rotate':
+        game.rotate()
+    elif input_type == 'drop':
+        game.hard_drop()
+        return len(game.delta.clears)
+    else:
+        raise ValueError(f'Unrecognised input: {input_type}')
+    return 0
+
+
+def get_ai_inputs(game, move):
+    """Yield the inputs to move the game's piece towards the move, in the
+    same order run_blocks applies them."""
+    for _ in range(MAX_AI_INPUTS_PER_PIECE):
+        if game.piece.r != move.r:
+            yield 'rotate'
+        elif game.piece.y > move.y:
+            yield 'left'
+        elif game.piece.y < move.y:
+            yield 'right'
+        else:
+            break
+    yield 'drop'
+
+
+def simulate_game(*, seed, max_pieces, inputs=None, search_depth=1, baseline_path=None):
+    """Play a single game without any delays, returning stats about it.
+
+    If inputs are given, they are played in a loop (training the AI on
+    each placed piece as in human play), otherwise the AI plays."""
+    np.random.seed(seed)
+    trainer = BlocksTrainer(search_depth=search_depth, baseline_path=baseline_path)
+    game = TrainableBlocksGame.new_game(trainer, seed=seed)
+    game.ai_mode = inputs is None
+
+    pieces = 0
+    lines_cleared = 0
+    move_latencies = []
+    input_idx = 0
+    start_time = perf_counter()
+
+    while not game.lost and pieces < max_pieces:
+        if game.ai_mode:
+            test_start_time = perf_counter()
+            trainer.test(GameState(
+                rs=game.rs,
+                board=game.board.copy(),
+                piece=dataclasses.replace(game.piece),
+                next_pieces=tuple(game.queue[:trainer.search_depth - 1]),
+            ))
+            move_latencies.append(perf_counter() - test_start_time)
+            for input_type in get_ai_inputs(game, trainer.move):
+                lines_cleared += apply_input(game, input_type)
+            pieces += 1
+        else:
+            input_type = inputs[input_idx % len(inputs)]
+            input_idx += 1
+            lines_cleared += apply_input(game, input_type)
+            if input_type == 'drop':
+                pieces += 1
+            # Train on pieces as they are locked, as the trainer
+            # thread would.
+            while not trainer.train_queue.empty():
+                trainer.train(trainer.train_queue.get())
+
+    return {
+        'seed': seed,
+        'pieces': pieces,
+        'lines_cleared': lines_cleared,
+        'score': game.score,
+        'seconds': perf_counter() - start_time,
+        'move_latencies': move_latencies,
+        # Kilobytes on Linux
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def summarise(results, wall_seconds):
+    """Combine the stats of each simulated game into a single report."""
+    pieces = sum(result['pieces'] for result in results)
+    move_latencies = np.array([
+        latency
+        for result in results
+        for latency in result['move_latencies']
+    ])
+    report = {
+        'games': len(results),
+        'pieces': pieces,
+        'wall_seconds': wall_seconds,
+        'pieces_per_second': pieces / wall_seconds,
+        'pieces_per_game_second': pieces / sum(result['seconds'] for result in results),
+        'lines_cleared': sum(result['lines_cleared'] for result in results),
+        'mean_lines_cleared': np.mean([result['lines_cleared'] for result in results]),
+        'mean_pieces': np.mean([result['pieces'] for result in results]),
+        'mean_score': np.mean([result['score'] for result in results]),
+        'max_rss_mb': max(result['max_rss_kb'] for result in results) / 1024,
+    }
+    if move_latencies.size > 0:
+        for percentile in [50, 90, 99]:
+            report[f'move_latency_p{percentile}_ms'] = np.percentile(move_latencies, percentile) * 1000
+        report['move_latency_max_ms'] = move_latencies.max() * 1000
+    return {key: (value.item() if isinstance(value, np.generic) else value)
+            for key, value in report.items()}
+
+
+def main():
+    args = parser.parse_args()
+    inputs = load_inputs(args.inputs) if args.inputs else None
+    if inputs is not None:
+        unrecognised_inputs = sorted(set(inputs) - set(INPUT_TYPES))
+        if unrecognised_inputs:
+            parser.error(f'Unrecognised inputs in {args.inputs}: {", ".join(unrecognised_inputs)}')
+        # Pieces are only counted as they are dropped, so games would
+        # never end without a drop
+        if 'drop' not in inputs:
+            parser.error(f'Expected at least one drop input in {args.inputs}')
+
+    start_time = perf_counter()
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = [
+            executor.submit(
+                simulate_game,
+                seed=(args.seed + game_idx),
+                max_pieces=args.max_pieces,
+                inputs=inputs,
+                search_depth=args.search_depth,
+                baseline_path=args.baseline,
+            )
+            for game_idx in range(args.games)
+        ]
+        results = [future.result() for future in futures]
+    report = summarise(results, perf_counter() - start_time)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import heapq
+from itertools import count
+import time
+
+
+class SimulationFinished(Exception):
+    pass
+
+
+class Clock:
+    """The real clock. Activity loops take a clock so that they can be run
+    against a SimulatedClock instead."""
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def monotonic_ns(self) -> int:
+        return time.monotonic_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout) -> bool:
+        """Wait up to timeout seconds for a threading.Event to be set,
+        returning whether it is set."""
+        return event.wait(timeout=timeout)
+
+
+class SimulatedClock(Clock):
+    """A clock that only advances when it is slept on, and does so
+    instantly, so that activity loops run as fast as they can compute
+    frames and always see the same times.
+
+    Callbacks scheduled with call_at() (such as delivering recorded
+    subscription messages) and background tasks added with
+    add_background_task() (standing in for background threads) are run
+    on the sleeping thread as the clock advances, so everything happens
+    in a deterministic order.
+
+    Once end_seconds is reached, sleeping raises SimulationFinished.
+
+    If speed is given, the clock is slowed down to that multiple of real
+    time (e.g. 1 to replay a recording in real time).
+    """
+
+    def __init__(self, *, start_seconds=0.0, end_seconds=None, speed=None):
+        self.now = start_seconds
+        self.start_seconds = start_seconds
+        self.end_seconds = end_seconds
+        self.speed = speed
+        self.real_start_time = time.monotonic()
+        # Heap of (seconds, sequence, callback), where the sequence
+        # keeps callbacks at the same time in the order they were added
+        self.scheduled = []
+        self.sequence = count()
+        self.background_tasks = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def monotonic_ns(self) -> int:
+        return int(self.now * 1_000_000_000)
+
+    def call_at(self, seconds, callback):
+        """Call callback once the clock reaches seconds."""
+        heapq.heappush(self.scheduled, (seconds, next(self.sequence), callback))
+
+    def add_background_task(self, task):
+        """Call task every time the clock is slept on."""
+        self.background_tasks.append(task)
+
+    def advance_to(self, seconds):
+        if self.end_seconds is not None and seconds >= self.end_seconds:
+            raise SimulationFinished()
+        if self.speed is not None:
+            real_time = self.real_start_time + ((seconds - self.start_seconds) / self.speed)
+            time.sleep(max(0, real_time - time.monotonic()))
+        while self.scheduled and self.scheduled[0][0] <= seconds:
+            callback_seconds, _, callback = heapq.heappop(self.scheduled)
+            self.now = max(self.now, callback_seconds)
+            callback()
+        self.now = max(self.now, seconds)
+        for task in self.background_tasks:
+            task()
+
+    def sleep(self, seconds):
+        self.advance_to(self.now + max(0, seconds))
+
+    def wait(self, event, timeout) -> bool:
+        deadline = self.now + max(0, timeout)
+        # Only advance as far as the next callback that could set the
+        # event.
+        while not event.is_set() and self.scheduled and self.scheduled[0][0] <= deadline:
+            self.advance_to(self.scheduled[0][0])
+        if not event.is_set():
+            self.advance_to(deadline)
+        return event.is_set()
+
+
+# Used by default wherever a clock can be injected
+REAL_CLOCK = Clock()
@@ -0,0 +1,179 @@
+from typing import Optional
+
+import numpy as np
+
+from .device import FRAME_DTYPE
+from .fixed_point import WORK_DTYPE
+
+# Opacity of a fully opaque layer (and maximum component value).
+OPAQUE = 255
+
+# Blend modes
+NORMAL = 'normal'
+ADD = 'add'
+MULTIPLY = 'multiply'
+SCREEN = 'screen'
+LIGHTEN = 'lighten'
+BLEND_MODES = [NORMAL, ADD, MULTIPLY, SCREEN, LIGHTEN]
+
+
+def get_fade_opacity(*, frame, frame_count, fade_frames) -> int:
+    """Opacity for frame (counting from 1) of something shown for
+    frame_count frames, fading in over the first fade_frames and out over
+    the last fade_frames."""
+    if fade_frames <= 0:
+        return OPAQUE if 1 <= frame <= frame_count else 0
+    steps = max(0, min(frame, frame_count + 1 - frame, fade_frames))
+    return (OPAQUE * steps) // fade_frames
+
+
+class Layer:
+    """A frame-sized buffer of pixels that is blended over the layers
+    below it with an opacity (0 to OPAQUE) and blend mode.
+
+    A layer keeps its pixels until they are replaced with set_pixels()
+    (or drawn into with draw() and marked dirty), so that a layer that
+    hasn't changed costs nothing to composite again.
+    """
+
+    def __init__(self, *, name, shape, opacity=OPAQUE, blend_mode=NORMAL):
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(f'Unrecognised blend mode: {blend_mode}')
+        self.name = name
+        self.pixels = np.zeros(shape, dtype=FRAME_DTYPE)
+        self.opacity = opacity
+        self.blend_mode = blend_mode
+        self.dirty = True
+
+    def set_pixels(self, pixels: np.ndarray):
+        """Replace the layer's pixels, only marking it dirty if they
+        changed."""
+        if not np.array_equal(self.pixels, pixels):
+            np.copyto(self.pixels, pixels)
+            self.dirty = True
+
+    def draw(self) -> np.ndarray:
+        """Return the layer's pixels to draw into in place, marking it
+        dirty."""
+        self.dirty = True
+        return self.pixels
+
+    def set_opacity(self, opacity: int):
+        opacity = min(max(int(opacity), 0), OPAQUE)
+        if opacity != self.opacity:
+            self.opacity = opacity
+            self.dirty = True
+
+    def set_blend_mode(self, blend_mode):
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(f'Unrecognised blend mode: {blend_mode}')
+        if blend_mode != self.blend_mode:
+            self.blend_mode = blend_mode
+            self.dirty = True
+
+
+class Compositor:
+    """Blends a stack of layers (the first layer at the bottom) over a
+    black background into a device frame.
+
+    Blending is done in integer arithmetic over buffers allocated up
+    front, and the result of blending each layer is cached, so that
+    compose() only re-blends from the lowest layer that changed (and
+    does nothing if no layer changed).
+    """
+
+    def __init__(self, *, light_count, component_count):
+        self.shape = (light_count, component_count)
+        self.layers: list[Layer] = []
+        # Composite of the background and each layer up to and including
+        # the layer at the same index
+        self.composites: list[np.ndarray] = []
+        self.background = np.zeros(self.shape, dtype=FRAME_DTYPE)
+        self.source = np.zeros(self.shape, dtype=WORK_DTYPE)
+        self.destination = np.zeros(self.shape, dtype=WORK_DTYPE)
+        self.scratch = np.zeros(self.shape, dtype=WORK_DTYPE)
+
+    def add_layer(self, name, *, opacity=OPAQUE, blend_mode=NORMAL) -> Layer:
+        """Add a layer on top of the existing layers."""
+        layer = Layer(name=name, shape=self.shape, opacity=opacity, blend_mode=blend_mode)
+        self.layers.append(layer)
+        self.composites.append(np.zeros(self.shape, dtype=FRAME_DTYPE))
+        return layer
+
+    def remove_layer(self, layer: Layer):
+        layer_idx = self.layers.index(layer)
+        del self.layers[layer_idx]
+        del self.composites[layer_idx]
+        # The layer above (if any) now blends over a different composite
+        if layer_idx < len(self.layers):
+            self.layers[layer_idx].dirty = True
+
+    def get_layer(self, name) -> Optional[Layer]:
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        return None
+
+    def divide_by_opaque(self, values: np.ndarray):
+        """Divide values (at most OPAQUE * OPAQUE) by OPAQUE in place,
+        rounding to the nearest integer, without integer division."""
+        values += 128
+        np.right_shift(values, 8, out=self.scratch)
+        values += self.scratch
+        values >>= 8
+
+    def blend(self, layer: Layer, below: np.ndarray, out: np.ndarray):
+        """Blend layer over below into out."""
+        if layer.opacity == 0:
+            np.copyto(out, below)
+            return
+        if layer.blend_mode == NORMAL and layer.opacity == OPAQUE:
+            np.copyto(out, layer.pixels)
+            return
+
+        source = self.source
+        destination = self.destination
+        np.copyto(source, layer.pixels)
+        np.copyto(destination, below)
+
+        # Blend the layer's pixels with the pixels below into source
+        if layer.blend_mode == ADD:
+            source += destination
+            np.minimum(source, OPAQUE, out=source)
+        elif layer.blend_mode == MULTIPLY:
+            source *= destination
+            self.divide_by_opaque(source)
+        elif layer.blend_mode == SCREEN:
+            np.subtract(OPAQUE, source, out=source)
+            np.subtract(OPAQUE, destination, out=self.scratch)
+            source *= self.scratch
+            self.divide_by_opaque(source)
+            np.subtract(OPAQUE, source, out=source)
+        elif layer.blend_mode == LIGHTEN:
+            np.maximum(source, destination, out=source)
+
+        # Mix the blended pixels with the pixels below by opacity
+        if layer.opacity != OPAQUE:
+            source *= layer.opacity
+            destination *= (OPAQUE - layer.opacity)
+            source += destination
+            self.divide_by_opaque(source)
+
+        np.copyto(out, source, casting='unsafe')
+
+    def compose(self) -> np.ndarray:
+        """Return the frame of every layer blended together. The frame is
+        reused by later calls, so it must be copied to be kept."""
+        if not self.layers:
+            return self.background
+
+        first_dirty_idx = next(
+            (layer_idx for layer_idx, layer in enumerate(self.layers) if layer.dirty),
+            None,
+        )
+        if first_dirty_idx is not None:
+            for layer_idx in range(first_dirty_idx, len(self.layers)):
+                below = self.composites[layer_idx - 1] if layer_idx > 0 else self.background
+                self.blend(self.layers[layer_idx], below, self.composites[layer_idx])
+                self.layers[layer_idx].dirty = False
+        return self.composites[-1]
@@ -1,26 +1,51 @@
-from collections import deque
 from dataclasses import dataclass
 import logging
-from time import sleep, monotonic
 from typing import Optional
 
 import numpy as np
 
-from .utils import hsv_to_rgb, indexes_to_mask
+from .clock import REAL_CLOCK
+from .utils import hue_saturation_to_rgb, indexes_to_mask
 from .device import FRAME_DTYPE, DeviceDisconnected
+from .fixed_point import FRACTION_BITS, to_fixed
+from .metrics import metrics
 
 COMPONENT_COUNT = 3
 RGB = slice(0, 3)
 
+# Painters send a direction for each step of this duration
 STEP_DURATION_MILLISECONDS = 200
-STEP_DURATION_SECONDS = STEP_DURATION_MILLISECONDS / 1000
-FRAME_DELAY_SECONDS = STEP_DURATION_SECONDS
+# Painter directions and colours are interpolated between steps, so
+# frames can be rendered more often than steps arrive.
+FRAMES_PER_SECOND = 30
+FRAME_DELAY_SECONDS = 1 / FRAMES_PER_SECOND
+# If a painter's next step should have been played more than this
+# long ago (e.g. because it arrived late), restart that painter's
+# playback from the step instead of skipping to catch up.
+MAX_PLAYBACK_LAG_MILLISECONDS = STEP_DURATION_MILLISECONDS
 
 EXCLUDED_LIGHT_INDEXES = [
     *range(0, 14),
     *range(200, 211),
 ]
 MAX_ILLUMINATION_DISTANCE = 0.3
+# For unit vectors a and b, |a - b|^2 = 2 - 2(a . b), so a light is
+# within MAX_ILLUMINATION_DISTANCE of a painter's direction when the
+# dot product of their directions exceeds this. (This only differs from
+# comparing the distance for lights within floating point rounding of
+# MAX_ILLUMINATION_DISTANCE.)
+MIN_ILLUMINATION_DOT = 1 - (MAX_ILLUMINATION_DISTANCE ** 2) / 2
+# Maximum number of steps to queue for each painter. If a painter
+# sends steps faster than they are played back, the oldest steps are
+# dropped so that playback catches up.
+MAX_PAINTER_STEPS = 25
+# Maximum number of painters to play back at once. The server only
+# keeps movements for a handful of painters, so this only guards
+# against unbounded growth.
+MAX_PAINTERS = 20
+# Lights not currently illuminated by a painter keep their last colour
+# at a quarter brightness. Lookup table from full to dimmed values.
+INACTIVE_VALUE_LOOKUP = ((np.arange(256) * to_fixed(0.25)) >> FRACTION_BITS).astype(FRAME_DTYPE)
 
 
 @dataclass(frozen=True)
@@ -35,23 +60,63 @@ class Colour:
             saturation=movement['colour']['saturation'],
         )
 
-    @classmethod
-    def interpolate(cls, *, from_colour, to_colour, n_steps):
-        return [
-            cls(hue=hue, saturation=saturation)
-            for hue, saturation
-            in zip(
-                np.linspace(from_colour.hue, to_colour.hue, n_steps),
-                np.linspace(from_colour.saturation, to_colour.saturation, n_steps),
-            )
-        ]
 
-
-@dataclass(frozen=True)
-class PainterStep:
-    colour: Colour
-    direction: np.ndarray
-    timestamp: int
+STEP_DTYPE = np.dtype([
+    ('direction', float, (3,)),
+    ('hue', float),
+    ('saturation', float),
+    ('timestamp', np.int64),
+])
+
+
+class PainterSteps:
+    """Fixed-capacity queue of a painter's steps (each a record of
+    STEP_DTYPE), stored in a ring buffer. Adding steps to a full queue
+    drops the oldest steps."""
+
+    def __init__(self, capacity=MAX_PAINTER_STEPS):
+        self.steps = np.zeros(capacity, dtype=STEP_DTYPE)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, steps):
+        """Add an array of steps to the end of the queue."""
+        capacity = self.steps.shape[0]
+        steps = steps[-capacity:]
+        dropped_count = max(0, self.count + steps.shape[0] - capacity)
+        if dropped_count > 0:
+            logging.info(f'Dropping {dropped_count} steps to catch up')
+            self.start = (self.start + dropped_count) % capacity
+            self.count -= dropped_count
+        end = (self.start + self.count) % capacity
+        first_count = min(steps.shape[0], capacity - end)
+        self.steps[end:end + first_count] = steps[:first_count]
+        self.steps[:steps.shape[0] - first_count] = steps[first_count:]
+        self.count += steps.shape[0]
+
+    def first(self):
+        """Return (a copy of) the oldest step."""
+        if self.count == 0:
+            raise IndexError('No steps')
+        return self.steps[self.start].copy()
+
+    def last(self):
+        """Return (a copy of) the most recently added step."""
+        if self.count == 0:
+            raise IndexError('No steps')
+        return self.steps[(self.start + self.count - 1) % self.steps.shape[0]].copy()
+
+    def popleft(self):
+        """Remove and return (a copy of) the oldest step."""
+        if self.count == 0:
+            raise IndexError('No steps')
+        step = self.steps[self.start].copy()
+        self.start = (self.start + 1) % self.steps.shape[0]
+        self.count -= 1
+        return step
 
 
 @dataclass(frozen=True)
@@ -62,7 +127,7 @@ class PainterState:
     def update(self, *, step):
         # Never allow the direction to point downward by clipping the
         # z value to zero.
-        direction = step.direction
+        direction = step['direction']
         direction[2] = np.max([0, direction[2]])
         direction_magnitude = np.linalg.norm(direction)
         direction = (
@@ -72,10 +137,49 @@ class PainterState:
         )
 
         return PainterState(
-            colour=step.colour,
+            colour=Colour(hue=float(step['hue']), saturation=float(step['saturation'])),
             direction=direction,
         )
 
+    def interpolate(self, *, to_state, fraction):
+        """Return the state the given fraction of the way between this state
+        and to_state, moving along the unit sphere between their
+        directions."""
+        return PainterState(
+            colour=Colour(
+                hue=self.colour.hue + (to_state.colour.hue - self.colour.hue) * fraction,
+                saturation=self.colour.saturation + (to_state.colour.saturation - self.colour.saturation) * fraction,
+            ),
+            direction=slerp(self.direction, to_state.direction, fraction),
+        )
+
+
+def slerp(from_direction, to_direction, fraction):
+    """Spherical linear interpolation between two unit vectors."""
+    angle = np.arccos(np.clip(np.dot(from_direction, to_direction), -1, 1))
+    sin_angle = np.sin(angle)
+    if sin_angle < 1e-6:
+        # Identical (or opposite) directions have no unique path
+        # between them.
+        return to_direction if fraction >= 0.5 else from_direction
+    return (
+        (np.sin((1 - fraction) * angle) / sin_angle) * from_direction
+        + (np.sin(fraction * angle) / sin_angle) * to_direction
+    )
+
+
+@dataclass
+class PainterPlayback:
+    """Tracks a painter's position in the playback of their steps."""
+    # Added to step timestamps to get their playback time.
+    time_offset: float
+    # States of the last played step and the next step to play, with
+    # their playback times.
+    from_state: PainterState
+    from_time: float
+    to_state: PainterState
+    to_time: float
+
 
 INITIAL_STATE = PainterState(
     colour=Colour(hue=0, saturation=0),
@@ -85,7 +189,7 @@ INITIAL_STATE = PainterState(
 
 class PaintState:
 
-    def __init__(self, *, light_positions):
+    def __init__(self, *, light_positions, max_painters=MAX_PAINTERS):
         # Get the positions of lights that aren't excluded
         included_lights_mask = ~indexes_to_mask(EXCLUDED_LIGHT_INDEXES, light_positions.shape[0])
         included_light_positions = light_positions[included_lights_mask, :]
@@ -102,10 +206,27 @@ class PaintState:
         self.light_directions = light_directions
         self.last_movement_timestamp = None
         self.painter_to_steps = {}
+        self.painter_to_playback = {}
         self.painter_to_state = {}
+        self.max_painters = max_painters
 
         self.full_value_frame = np.full((light_positions.shape[0], COMPONENT_COUNT), 255, dtype=FRAME_DTYPE)
-        self.frame = np.zeros((light_positions.shape[0], COMPONENT_COUNT), dtype=FRAME_DTYPE)
+        self.frame = INACTIVE_VALUE_LOOKUP[self.full_value_frame]
+        # Indexes of the lights illuminated in the last frame
+        self.active_indexes = np.empty(0, dtype=int)
+        # Buffers reused by tick_frame, with a row for each painter
+        # (grown as more painters appear).
+        self.dots = np.empty((0, light_positions.shape[0]))
+        self.illuminated = np.empty((0, light_positions.shape[0]), dtype=bool)
+        self.active_frame_mask = np.empty(light_positions.shape[0], dtype=bool)
+        self.active_painter_indexes = np.empty(light_positions.shape[0], dtype=int)
+
+    def get_painter_buffers(self, painter_count):
+        """Return views of the tick_frame buffers for painter_count painters."""
+        if self.dots.shape[0] < painter_count:
+            self.dots = np.empty((painter_count, self.light_directions.shape[0]))
+            self.illuminated = np.empty((painter_count, self.light_directions.shape[0]), dtype=bool)
+        return self.dots[:painter_count], self.illuminated[:painter_count]
 
     def add_movements(self, painter_movements):
         # Ignore the first movements on start - as they are probably stale
@@ -116,95 +237,170 @@ class PaintState:
                 for movement in movements
             ], default=0)
 
+        latest_timestamp = self.last_movement_timestamp
         for painter_id, movements in painter_movements.items():
-            painter_steps = self.painter_to_steps.get(painter_id, deque())
             new_movements = [m for m in movements if m['timestamp'] > self.last_movement_timestamp]
+            if not new_movements:
+                continue
+            painter_steps = self.painter_to_steps.get(painter_id)
+            if painter_steps is None:
+                painter_steps = PainterSteps()
             for movement in new_movements:
-                step_count = len(movement['velocities'])
+                velocities = movement['velocities']
+                if len(velocities) == 0:
+                    continue
+                latest_timestamp = max(latest_timestamp, movement['timestamp'])
                 movement_colour = Colour.from_movement(movement)
                 if len(painter_steps) == 0:
-                    painter_steps.append(PainterStep(
-                        colour=movement_colour,
-                        direction=np.array([0, 0, 0]),
-                        timestamp=movement['timestamp'],
+                    first_step_timestamp = movement['timestamp'] - STEP_DURATION_MILLISECONDS * len(velocities)
+                    painter_steps.extend(np.array(
+                        [((0, 0, 0), movement_colour.hue, movement_colour.saturation, first_step_timestamp)],
+                        dtype=STEP_DTYPE,
                     ))
-                current_step = painter_steps[-1]
+                current_step = painter_steps.last()
 
+                steps = np.zeros(len(velocities), dtype=STEP_DTYPE)
+                steps['direction'] = [
+                    (velocity['x'], velocity['y'], velocity['z'])
+                    for velocity in velocities
+                ]
                 # When the colour changes in a movement, make the
                 # colour change gradual over the steps within that
                 # movement.
-                if movement_colour != current_step.colour:
-                    step_colours = Colour.interpolate(
-                        from_colour=current_step.colour,
-                        to_colour=movement_colour,
-                        n_steps=step_count,
-                    )
-                else:
-                    step_colours = [movement_colour for _ in range(step_count)]
-
-                for step_direction, step_colour in zip(movement['velocities'], step_colours):
-                    direction_vector = np.array([
-                        step_direction['x'],
-                        step_direction['y'],
-                        step_direction['z'],
-                    ])
-                    painter_steps.append(PainterStep(
-                        colour=step_colour,
-                        direction=direction_vector,
-                        timestamp=movement['timestamp'],
-                    ))
+                steps['hue'] = np.linspace(current_step['hue'], movement_colour.hue, len(velocities))
+                steps['saturation'] = np.linspace(current_step['saturation'], movement_colour.saturation, len(velocities))
+                # The movement's timestamp is for when its last step
+                # was sent, and earlier steps were each sent a step
+                # duration before the next.
+                steps['timestamp'] = (
+                    movement['timestamp']
+                    - STEP_DURATION_MILLISECONDS * np.arange(len(velocities) - 1, -1, -1)
+                )
+                painter_steps.extend(steps)
             self.painter_to_steps[painter_id] = painter_steps
 
-        self.last_movement_timestamp = max([
-            step.timestamp
-            for steps in self.painter_to_steps.values()
-            for step in steps
-        ], default=self.last_movement_timestamp)
-
-    def tick_state(self):
-        painter_ids = set([*self.painter_to_steps.keys(), *self.painter_to_state.keys()])
+        self.last_movement_timestamp = latest_timestamp
+        self.evict_painters()
+
+    def remove_painter(self, painter_id):
+        self.painter_to_steps.pop(painter_id, None)
+        self.painter_to_playback.pop(painter_id, None)
+        self.painter_to_state.pop(painter_id, None)
+
+    def evict_painters(self):
+        """Remove the painters with the oldest steps while there are more
+        than max_painters."""
+        painter_ids = list(dict.fromkeys([*self.painter_to_steps.keys(), *self.painter_to_playback.keys()]))
+        if len(painter_ids) <= self.max_painters:
+            return
+
+        def get_last_timestamp(painter_id):
+            steps = self.painter_to_steps.get(painter_id)
+            # Painters without steps left are only holding their
+            # last state, so are evicted first.
+            return steps.last()['timestamp'] if steps else -np.inf
+
+        evicted_ids = sorted(painter_ids, key=get_last_timestamp)[:len(painter_ids) - self.max_painters]
+        logging.warning(f'Evicting {len(evicted_ids)} painters')
+        for painter_id in evicted_ids:
+            self.remove_painter(painter_id)
+
+    def tick_state(self, now_milliseconds):
+        """Update the state of each painter to its position in the playback
+        of its steps at the given time."""
+        # De-duplicated in insertion order (rather than with a set), so
+        # that where painters overlap the same painter wins on every run
+        painter_ids = list(dict.fromkeys([*self.painter_to_steps.keys(), *self.painter_to_playback.keys()]))
         for painter_id in painter_ids:
-            try:
-                step = self.painter_to_steps.get(painter_id, deque()).popleft()
-            except IndexError:
-                # Remove the painter if there are no steps left for it
+            steps = self.painter_to_steps.get(painter_id)
+            playback = self.painter_to_playback.get(painter_id)
+
+            # Start playing back from the next step if it is overdue
+            # (including for new painters).
+            if steps and (
+                    playback is None
+                    or (steps.first()['timestamp'] + playback.time_offset) < (now_milliseconds - MAX_PLAYBACK_LAG_MILLISECONDS)
+            ):
+                step = steps.popleft()
+                time_offset = now_milliseconds - step['timestamp']
+                from_state = (INITIAL_STATE if playback is None else playback.to_state).update(step=step)
+                playback = PainterPlayback(
+                    time_offset=time_offset,
+                    from_state=from_state,
+                    from_time=now_milliseconds,
+                    to_state=from_state,
+                    to_time=now_milliseconds,
+                )
+                self.painter_to_playback[painter_id] = playback
+
+            if playback is None:
                 self.painter_to_steps.pop(painter_id, None)
-                self.painter_to_state.pop(painter_id, None)
                 continue
-            painter_state = self.painter_to_state.get(painter_id, INITIAL_STATE)
-            painter_state = painter_state.update(step=step)
-            self.painter_to_state[painter_id] = painter_state
+
+            # Advance to the steps either side of the current time
+            while steps and playback.to_time <= now_milliseconds:
+                step = steps.popleft()
+                playback.from_state, playback.from_time = playback.to_state, playback.to_time
+                playback.to_state = playback.from_state.update(step=step)
+                playback.to_time = step['timestamp'] + playback.time_offset
+
+            if playback.to_time > now_milliseconds:
+                self.painter_to_state[painter_id] = playback.from_state.interpolate(
+                    to_state=playback.to_state,
+                    fraction=((now_milliseconds - playback.from_time) / (playback.to_time - playback.from_time)),
+                )
+            elif now_milliseconds < (playback.to_time + STEP_DURATION_MILLISECONDS):
+                # Hold the last step for a step's duration
+                self.painter_to_state[painter_id] = playback.to_state
+            else:
+                # Remove the painter if there are no steps left for it
+                self.remove_painter(painter_id)
 
     def tick_frame(self):
-        active_frame_mask = np.full(self.light_directions.shape[0], False)
-        active_frame = np.zeros((self.light_directions.shape[0], COMPONENT_COUNT))
-        for painter_id, painter_state in self.painter_to_state.items():
-            distances = np.linalg.norm(self.light_directions - painter_state.direction, axis=1)
-            # Linearly scale from weight 1 to 0 between distance 0 and MAX_ILLUMINATION_DISTANCE
-            weights = 1 - (distances / MAX_ILLUMINATION_DISTANCE)
-            mask = weights > 0
-            active_frame[mask, RGB] = hsv_to_rgb(h=painter_state.colour.hue, s=painter_state.colour.saturation, v=1)
-            active_frame_mask = active_frame_mask | mask
-        self.full_value_frame[active_frame_mask, RGB] = np.clip(active_frame[active_frame_mask, RGB], 0, 255)
-        self.frame = self.full_value_frame.copy()
-        self.frame[~active_frame_mask] = self.frame[~active_frame_mask] * 0.25
-        self.frame = self.frame.round().astype(FRAME_DTYPE)
+        # Only lights illuminated in this or the last frame change, so
+        # start by dimming the lights illuminated in the last frame.
+        self.frame[self.active_indexes] = INACTIVE_VALUE_LOOKUP[self.full_value_frame[self.active_indexes]]
+
+        painter_states = list(self.painter_to_state.values())
+        if not painter_states:
+            self.active_indexes = np.empty(0, dtype=int)
+            return
+
+        painter_directions = np.array([painter_state.direction for painter_state in painter_states])
+        painter_colours = hue_saturation_to_rgb(
+            np.array([painter_state.colour.hue for painter_state in painter_states]),
+            np.array([painter_state.colour.saturation for painter_state in painter_states]),
+        )
+        dots, illuminated = self.get_painter_buffers(len(painter_states))
+        # Compare every painter's direction to every light's direction at
+        # once.
+        np.matmul(painter_directions, self.light_directions.T, out=dots)
+        np.greater(dots, MIN_ILLUMINATION_DOT, out=illuminated)
+        np.any(illuminated, axis=0, out=self.active_frame_mask)
+        self.active_indexes = np.flatnonzero(self.active_frame_mask)
+        # Where painters overlap, the last painter's colour is used: find
+        # the last illuminating painter for each light.
+        np.argmax(illuminated[::-1], axis=0, out=self.active_painter_indexes)
+        self.full_value_frame[self.active_indexes, RGB] = painter_colours[
+            (len(painter_states) - 1) - self.active_painter_indexes[self.active_indexes]
+        ]
+        self.frame[self.active_indexes] = self.full_value_frame[self.active_indexes]
 
 
 def render_cone(*, device, paint_state):
     device.set_frame_array(paint_state.frame)
 
 
-def run_cone(*, device, paint_sub):
+def run_cone(*, device, paint_sub, clock=REAL_CLOCK):
     """Render frames in a continuous loop"""
-    next_time = monotonic()
+    next_time = clock.monotonic()
 
     while True:
         if device.connected:
             layout = device.get_layout()
             break
         logging.info('Waiting for layout')
-        sleep(1)
+        clock.sleep(1)
 
     # Re-orient dimensions so that axis z/2 is up/down
     light_positions = np.array([
@@ -214,17 +410,29 @@ def run_cone(*, device, paint_sub):
     paint_state = PaintState(light_positions=light_positions)
 
     while True:
+        # Skip frames rather than rendering a burst of frames if we
+        # have fallen behind (playback is based on the time, so
+        # skipping frames won't slow it down).
         next_time = next_time + FRAME_DELAY_SECONDS
-        sleep(max(0, next_time - monotonic()))
-        frame_start_time = monotonic()
-
-        if paint_sub.state:
-            paint_records = list(paint_sub.state.values())
-            if len(paint_records) > 0:
-                paint_state.add_movements(paint_records[0]['painterMovements'])
-
-        paint_state.tick_state()
-        paint_state.tick_frame()
+        if next_time < (clock.monotonic() - FRAME_DELAY_SECONDS):
+            metrics.increment('dropped_frames', activity='cone')
+            next_time = clock.monotonic() - FRAME_DELAY_SECONDS
+        clock.sleep(max(0, next_time - clock.monotonic()))
+        frame_start_time = clock.monotonic()
+
+        # Only check for new movements when the paint state changes
+        if paint_sub.updated.is_set():
+            paint_sub.updated.clear()
+            with metrics.stage('ingest', activity='cone'):
+                paint_records = list(paint_sub.state.values())
+                if len(paint_records) > 0:
+                    paint_state.add_movements(paint_records[0]['painterMovements'])
+
+        with metrics.stage('simulate', activity='cone'):
+            paint_state.tick_state(now_milliseconds=(frame_start_time * 1000))
+        metrics.set_gauge('container_size', len(paint_state.painter_to_playback), container='cone_painters')
+        with metrics.stage('render', activity='cone'):
+            paint_state.tick_frame()
 
         try:
             render_cone(
@@ -233,4 +441,4 @@ def run_cone(*, device, paint_sub):
             )
         except DeviceDisconnected:
             logging.info(f'Device disconnected')
-        logging.info(f'Frame render time: {monotonic() - frame_start_time}')
+        metrics.observe('frame', clock.monotonic() - frame_start_time, activity='cone')
@@ -1,13 +1,12 @@
 from io import BytesIO
-import sys
 from time import sleep
 from threading import Thread
 import logging
+from urllib.parse import urljoin
 import numpy as np
-import xled
-from requests.compat import urljoin
-import zmq
-from xled.response import ApplicationResponse
+
+from .clock import REAL_CLOCK
+from .metrics import metrics
 
 FRAME_DTYPE = np.ubyte
 TIMEOUT_SECONDS = 20
@@ -18,6 +17,7 @@ TIMEOUT_SECONDS = 20
 # unclosed file handles that would necessitate periodic restarting of
 # the process.
 
+# import zmq
 # orig_pipe = xled.discover.pipe
 
 # def pipe_with_timeout(ctx):
@@ -35,21 +35,27 @@ class DeviceDisconnected(Exception):
 
 class Device:
 
-    def __init__(self, *, device_id):
+    def __init__(self, *, device_id, recorder=None):
         self.device_id = device_id
+        # Optional Recorder of every frame sent
+        self.recorder = recorder
         self.monitor_stopped = False
         self.connected = False
         self.control = None
 
     def start_monitor(self):
         """Run the subscription in a new thread"""
-        monitor_thread = Thread(target=self.run_monitor)
+        monitor_thread = Thread(target=self.run_monitor, name=f'device-monitor-{self.device_id}')
         monitor_thread.start()
 
     def stop_monitor(self):
         self.monitor_stopped = True
 
     def reconnect(self):
+        # xled (along with requests and zmq) is slow to import, so it is
+        # only imported once a device needs it, on the monitor thread.
+        import xled
+
         # Clear anything that may exist from a previous connection
         try:
             self.control._udpclient.close()
@@ -61,6 +67,8 @@ class Device:
         self.control.set_mode('rt')
 
     def run_monitor(self, interval_seconds=5):
+        from xled.response import ApplicationResponse
+
         while not self.monitor_stopped:
             sleep(interval_seconds)
             if self.connected:
@@ -83,6 +91,7 @@ class Device:
                 try:
                     self.reconnect()
                     self.connected = True
+                    metrics.increment('reconnects', source='device')
                 except:
                     logging.exception('Device connect failed')
 
@@ -96,11 +105,57 @@ class Device:
             raise ValueError('Invalid frame array')
 
         with BytesIO() as frame:
-            # C-order writes each row sequentially
-            array_bytes = array.tobytes(order='C')
-            frame.write(array_bytes)
-            frame.seek(0)
-            self.control.set_rt_frame_socket(frame, version=3)
+            with metrics.stage('encode', device=self.device_id):
+                # C-order writes each row sequentially
+                array_bytes = array.tobytes(order='C')
+                frame.write(array_bytes)
+                frame.seek(0)
+            with metrics.stage('send', device=self.device_id):
+                self.control.set_rt_frame_socket(frame, version=3)
+
+        if self.recorder is not None:
+            self.recorder.record_frame(array)
+
+    def get_layout(self):
+        layout = self.control.get_led_layout().data
+        if self.recorder is not None:
+            self.recorder.record_metadata('layout', layout)
+        return layout
+
+
+class CaptureDevice:
+    """Stands in for a Device without any hardware (e.g. for benchmarks
+    and simulations), keeping a copy of the last frame set, and
+    optionally every frame (and the clock time it was set at)."""
+
+    def __init__(self, *, layout=None, keep_frames=False, clock=REAL_CLOCK):
+        self.layout = layout
+        self.keep_frames = keep_frames
+        self.clock = clock
+        self.connected = True
+        self.frames = []
+        self.frame_seconds = []
+        self.frame_count = 0
+        self.last_frame = None
+
+    def start_monitor(self):
+        pass
+
+    def stop_monitor(self):
+        pass
+
+    def set_frame_array(self, array: np.ndarray):
+        if not self.connected:
+            raise DeviceDisconnected()
+
+        if array.dtype != FRAME_DTYPE:
+            raise ValueError('Invalid frame array')
+
+        self.last_frame = array.copy()
+        self.frame_count += 1
+        if self.keep_frames:
+            self.frames.append(self.last_frame)
+            self.frame_seconds.append(self.clock.monotonic())
 
     def get_layout(self):
-        return self.control.get_led_layout().data
+        return self.layout
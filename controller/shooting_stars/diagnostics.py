@@ -0,0 +1,80 @@
+from threading import Thread
+from time import sleep, monotonic
+import logging
+import tracemalloc
+
+from .metrics import metrics
+
+# Number of frames of each allocation's traceback to record. More
+# frames make allocation sites easier to trace, but use more memory.
+TRACEMALLOC_FRAMES = 5
+# Number of allocation sites to report in each snapshot comparison.
+TOP_ALLOCATION_COUNT = 10
+
+
+class MemoryDiagnostics:
+    """Periodically takes tracemalloc snapshots in a separate thread, and
+    logs the allocation sites that have grown the most since the
+    first snapshot (as well as since the previous one), to find slow
+    leaks in long-running controllers.
+
+    tracemalloc slows down every allocation, so this should only be
+    enabled while investigating memory growth.
+    """
+
+    def __init__(self, *, interval_seconds, top_count=TOP_ALLOCATION_COUNT):
+        self.interval_seconds = interval_seconds
+        self.top_count = top_count
+        self.stopped = False
+
+    def start(self):
+        """Run the diagnostics in a new thread"""
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        diagnostics_thread = Thread(target=self.run, name='memory-diagnostics', daemon=True)
+        diagnostics_thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+
+    def log_growth(self, snapshot, since_snapshot, description):
+        stats = [
+            stat for stat in snapshot.compare_to(since_snapshot, 'traceback')
+            if stat.size_diff > 0
+        ][:self.top_count]
+        lines = [f'Top growing allocation sites since {description}:']
+        for stat in stats:
+            frame = stat.traceback[-1]
+            lines.append(f'  +{stat.size_diff / 1024:.1f} KiB ({stat.count_diff:+d} blocks) '
+                         f'{frame.filename}:{frame.lineno}')
+        logging.warning('\n'.join(lines))
+
+    def run(self):
+        first_snapshot = self.take_snapshot()
+        previous_snapshot = first_snapshot
+        next_time = monotonic() + self.interval_seconds
+        while not self.stopped:
+            # Sleep in short intervals so that stopping isn't delayed
+            if monotonic() < next_time:
+                sleep(min(1, next_time - monotonic()))
+                continue
+            next_time = monotonic() + self.interval_seconds
+
+            try:
+                snapshot = self.take_snapshot()
+                traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+                metrics.set_gauge('traced_memory_bytes', traced_bytes)
+                metrics.set_gauge('peak_traced_memory_bytes', peak_traced_bytes)
+                logging.warning(f'Traced memory: {traced_bytes / 1024 / 1024:.1f} MiB '
+                                f'(peak {peak_traced_bytes / 1024 / 1024:.1f} MiB)')
+                self.log_growth(snapshot, first_snapshot, 'start')
+                self.log_growth(snapshot, previous_snapshot, 'last snapshot')
+                previous_snapshot = snapshot
+            except:
+                logging.exception('Memory diagnostics failed')
@@ -0,0 +1,59 @@
+import numpy as np
+
+from .device import FRAME_DTYPE
+
+# Number of fractional bits in fixed-point brightness factors.
+FRACTION_BITS = 8
+# The fixed-point factor for full brightness (1.0).
+ONE = 1 << FRACTION_BITS
+# Maximum value of a frame component.
+MAX_VALUE = np.iinfo(FRAME_DTYPE).max
+# Integer type for fixed-point factors, and wide enough to hold a frame
+# component multiplied by a factor.
+WORK_DTYPE = np.uint16
+
+
+def to_fixed(factor):
+    """Convert a brightness factor (or array of factors) between 0 and 1
+    to fixed point. Only meant for converting constants and
+    configuration, not for every frame."""
+    if np.ndim(factor) == 0:
+        return int(round(min(max(factor, 0), 1) * ONE))
+    return np.round(np.clip(factor, 0, 1) * ONE).astype(WORK_DTYPE)
+
+
+def fade_factors(factors: np.ndarray, step: int):
+    """Subtract step from fixed-point factors in place, stopping at
+    zero."""
+    np.maximum(factors, step, out=factors)
+    factors -= step
+
+
+class FrameMath:
+    """Scales and adds frames (or views of frames) of one shape in place,
+    in fixed point with uint16 intermediates held in buffers allocated up
+    front - so that fading a frame needs no floats and no allocations.
+
+    Like casting from floats, fractions are dropped rather than rounded.
+    """
+
+    def __init__(self, shape):
+        self.work = np.zeros(shape, dtype=WORK_DTYPE)
+
+    def scale(self, frame: np.ndarray, factor, *, where=True):
+        """Multiply frame by a fixed-point factor no greater than ONE (or
+        an array of factors broadcastable to frame, e.g. one per light
+        with shape (light_count, 1)). Only components where where is True
+        change."""
+        np.copyto(self.work, frame)
+        self.work *= factor
+        self.work >>= FRACTION_BITS
+        np.copyto(frame, self.work, casting='unsafe', where=where)
+
+    def add(self, frame: np.ndarray, values, *, where=True):
+        """Add values (no greater than ONE * MAX_VALUE) to frame, saturating
+        at MAX_VALUE. Only components where where is True change."""
+        np.copyto(self.work, frame)
+        self.work += values
+        np.minimum(self.work, MAX_VALUE, out=self.work)
+        np.copyto(frame, self.work, casting='unsafe', where=where)
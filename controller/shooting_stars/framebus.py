@@ -0,0 +1,288 @@
+from contextlib import contextmanager
+import json
+import logging
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import struct
+from threading import Thread
+from time import monotonic, sleep
+from typing import Optional
+
+import numpy as np
+
+from .device import FRAME_DTYPE, DeviceDisconnected
+
+# Identifies frame buses (and the version of their layout).
+BUS_MAGIC = b'SSBUS001'
+# Written once by the sender: magic, slot count, maximum lights and
+# components per frame, and bytes reserved for the device layout.
+BUS_HEADER = struct.Struct('<8sIIII')
+# Written by the renderer: sequence number of the latest frame (0
+# before any frame is written).
+BUS_SEQUENCE = struct.Struct('<Q')
+# Written by the sender: time of its last heartbeat, whether any of its
+# devices are connected, and the length of the device layout JSON.
+BUS_STATUS = struct.Struct('<dII')
+BUS_SEQUENCE_OFFSET = BUS_HEADER.size
+BUS_STATUS_OFFSET = BUS_SEQUENCE_OFFSET + BUS_SEQUENCE.size
+BUS_LAYOUT_OFFSET = BUS_STATUS_OFFSET + BUS_STATUS.size
+# Each slot starts with the sequence number of its frame (0 while it is
+# being written), the time it was written, and its shape.
+SLOT_HEADER = struct.Struct('<QdII')
+# Slots (and the layout) are padded to a multiple of this many bytes.
+BUS_ALIGNMENT = 8
+# Default number of frames in the ring. Readers only ever want the
+# latest frame, so this only needs to be enough that the renderer can't
+# lap a reader part way through copying a frame.
+DEFAULT_SLOT_COUNT = 4
+# Default maximum number of lights and components in a frame.
+DEFAULT_MAX_LIGHT_COUNT = 2000
+DEFAULT_MAX_COMPONENT_COUNT = 4
+# Default bytes reserved for the device layout JSON.
+DEFAULT_LAYOUT_CAPACITY = 256 * 1024
+# Number of times to retry reading a frame that was overwritten while
+# it was being copied.
+READ_ATTEMPTS = 3
+# Seconds without a heartbeat from the sender after which a renderer
+# treats the device as disconnected.
+SENDER_TIMEOUT_SECONDS = 2
+
+
+def get_bus_name(device_id) -> str:
+    """Name of the shared memory of the frame bus for a device."""
+    return f'shooting_stars_{device_id}'
+
+
+def align(size) -> int:
+    return size + (-size % BUS_ALIGNMENT)
+
+
+def attach_shared_memory(name) -> SharedMemory:
+    """Attach to existing shared memory without this process unlinking it
+    on exit (which Python does for any shared memory it has opened,
+    unless told not to track it)."""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13
+        shared_memory = SharedMemory(name=name)
+        resource_tracker.unregister(shared_memory._name, 'shared_memory')
+        return shared_memory
+
+
+class FrameBus:
+    """A ring buffer of frames in shared memory, written by one renderer
+    process and read by a sender process that drives the device.
+
+    The renderer writes each frame into the next slot of the ring and
+    then publishes its sequence number, and readers copy the latest
+    frame without any locks: a slot's sequence number is cleared while
+    it is written, so a reader checks the sequence number is unchanged
+    after copying (retrying if the renderer overwrote the slot).
+
+    The sender creates the bus (see create()), and shares the device
+    layout and its connection status through it.
+    """
+
+    def __init__(self, *, shared_memory: SharedMemory, owner=False):
+        self.shared_memory = shared_memory
+        self.owner = owner
+        buffer = shared_memory.buf
+        magic, self.slot_count, self.max_light_count, self.max_component_count, self.layout_capacity = (
+            BUS_HEADER.unpack_from(buffer, 0))
+        if magic != BUS_MAGIC:
+            raise ValueError(f'Not a frame bus: {shared_memory.name}')
+        self.frame_capacity = self.max_light_count * self.max_component_count * np.dtype(FRAME_DTYPE).itemsize
+        self.slot_size = align(SLOT_HEADER.size + self.frame_capacity)
+        self.slots_offset = BUS_LAYOUT_OFFSET + self.layout_capacity
+        # Only the renderer writes frames, so it can keep the sequence
+        self.sequence = BUS_SEQUENCE.unpack_from(buffer, BUS_SEQUENCE_OFFSET)[0]
+
+    @classmethod
+    def create(cls, name, *, slot_count=DEFAULT_SLOT_COUNT, max_light_count=DEFAULT_MAX_LIGHT_COUNT,
+               max_component_count=DEFAULT_MAX_COMPONENT_COUNT, layout_capacity=DEFAULT_LAYOUT_CAPACITY):
+        """Create a bus, replacing any left behind by a previous
+        sender."""
+        layout_capacity = align(layout_capacity)
+        frame_capacity = max_light_count * max_component_count * np.dtype(FRAME_DTYPE).itemsize
+        size = BUS_LAYOUT_OFFSET + layout_capacity + (slot_count * align(SLOT_HEADER.size + frame_capacity))
+        try:
+            shared_memory = SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            logging.warning(f'Replacing existing frame bus: {name}')
+            stale_shared_memory = SharedMemory(name=name)
+            stale_shared_memory.close()
+            stale_shared_memory.unlink()
+            shared_memory = SharedMemory(name=name, create=True, size=size)
+        BUS_HEADER.pack_into(shared_memory.buf, 0, BUS_MAGIC, slot_count, max_light_count,
+                             max_component_count, layout_capacity)
+        return cls(shared_memory=shared_memory, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a bus created by a sender, raising
+        FileNotFoundError if there isn't one."""
+        return cls(shared_memory=attach_shared_memory(name))
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    def close(self):
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
+
+    def get_slot_offset(self, sequence) -> int:
+        return self.slots_offset + ((sequence % self.slot_count) * self.slot_size)
+
+    def get_slot_frame(self, slot_offset, light_count, component_count) -> np.ndarray:
+        return np.ndarray((light_count, component_count), dtype=FRAME_DTYPE, buffer=self.shared_memory.buf,
+                          offset=(slot_offset + SLOT_HEADER.size))
+
+    # Renderer
+
+    @contextmanager
+    def writing(self, shape):
+        """Yield the next frame of the ring to draw into in place,
+        publishing it as the latest frame once the block exits."""
+        light_count, component_count = shape
+        if light_count > self.max_light_count or component_count > self.max_component_count:
+            raise ValueError(f'Frame of shape {shape} is too large for frame bus {self.name}')
+        sequence = self.sequence + 1
+        slot_offset = self.get_slot_offset(sequence)
+        buffer = self.shared_memory.buf
+        # Mark the slot as being written
+        SLOT_HEADER.pack_into(buffer, slot_offset, 0, 0.0, 0, 0)
+        yield self.get_slot_frame(slot_offset, light_count, component_count)
+        SLOT_HEADER.pack_into(buffer, slot_offset, sequence, monotonic(), light_count, component_count)
+        BUS_SEQUENCE.pack_into(buffer, BUS_SEQUENCE_OFFSET, sequence)
+        self.sequence = sequence
+
+    def write(self, array: np.ndarray):
+        """Publish a copy of array as the latest frame."""
+        with self.writing(array.shape) as frame:
+            np.copyto(frame, array)
+
+    def is_sender_alive(self) -> bool:
+        heartbeat_seconds, devices_connected, _ = BUS_STATUS.unpack_from(self.shared_memory.buf, BUS_STATUS_OFFSET)
+        return bool(devices_connected) and (monotonic() - heartbeat_seconds) < SENDER_TIMEOUT_SECONDS
+
+    def get_layout(self) -> Optional[dict]:
+        """The device layout shared by the sender, or None if it doesn't
+        have it yet."""
+        _, _, layout_length = BUS_STATUS.unpack_from(self.shared_memory.buf, BUS_STATUS_OFFSET)
+        if layout_length == 0:
+            return None
+        return json.loads(bytes(self.shared_memory.buf[BUS_LAYOUT_OFFSET:(BUS_LAYOUT_OFFSET + layout_length)]))
+
+    # Sender
+
+    def read_latest(self, out: Optional[np.ndarray] = None):
+        """Copy the latest frame, returning (sequence, seconds it was
+        written, frame), or None if no frame has been written (or it was
+        overwritten on every attempt to read it). The frame is copied
+        into out if it has the right shape."""
+        buffer = self.shared_memory.buf
+        for _ in range(READ_ATTEMPTS):
+            sequence = BUS_SEQUENCE.unpack_from(buffer, BUS_SEQUENCE_OFFSET)[0]
+            if sequence == 0:
+                return None
+            slot_offset = self.get_slot_offset(sequence)
+            slot_sequence, seconds, light_count, component_count = SLOT_HEADER.unpack_from(buffer, slot_offset)
+            if slot_sequence != sequence:
+                continue
+            if out is None or out.shape != (light_count, component_count):
+                out = np.empty((light_count, component_count), dtype=FRAME_DTYPE)
+            np.copyto(out, self.get_slot_frame(slot_offset, light_count, component_count))
+            if SLOT_HEADER.unpack_from(buffer, slot_offset)[0] == sequence:
+                return sequence, seconds, out
+        return None
+
+    def set_status(self, *, devices_connected):
+        """Record a heartbeat from the sender."""
+        _, _, layout_length = BUS_STATUS.unpack_from(self.shared_memory.buf, BUS_STATUS_OFFSET)
+        BUS_STATUS.pack_into(self.shared_memory.buf, BUS_STATUS_OFFSET, monotonic(), int(devices_connected),
+                             layout_length)
+
+    def set_layout(self, layout: dict):
+        layout_bytes = json.dumps(layout).encode()
+        if len(layout_bytes) > self.layout_capacity:
+            raise ValueError(f'Layout of {len(layout_bytes)} bytes is too large for frame bus {self.name}')
+        buffer = self.shared_memory.buf
+        buffer[BUS_LAYOUT_OFFSET:(BUS_LAYOUT_OFFSET + len(layout_bytes))] = layout_bytes
+        heartbeat_seconds, devices_connected, _ = BUS_STATUS.unpack_from(buffer, BUS_STATUS_OFFSET)
+        BUS_STATUS.pack_into(buffer, BUS_STATUS_OFFSET, heartbeat_seconds, devices_connected, len(layout_bytes))
+
+
+class FrameBusDevice:
+    """Stands in for a Device in a renderer process, writing frames to the
+    frame bus of a sender process (see shooting_stars.sender) that sends
+    them to the device. The device counts as connected while the sender
+    is running and connected to it.
+
+    set_frame_array() copies each frame into a slot of the bus once.
+    The activities update their frame in place from the previous frame,
+    while a slot holds the frame from slot_count frames ago, so they
+    can't draw straight into the bus with FrameBus.writing().
+    """
+
+    def __init__(self, *, device_id, recorder=None):
+        self.device_id = device_id
+        self.bus_name = get_bus_name(device_id)
+        # Optional Recorder of every frame sent
+        self.recorder = recorder
+        self.monitor_stopped = False
+        self.bus = None
+
+    @property
+    def connected(self):
+        return self.bus is not None and self.bus.is_sender_alive()
+
+    def start_monitor(self):
+        """Attach to the bus (and re-attach if the sender is restarted) in
+        a new thread"""
+        monitor_thread = Thread(target=self.run_monitor, name=f'frame-bus-monitor-{self.device_id}')
+        monitor_thread.start()
+
+    def stop_monitor(self):
+        self.monitor_stopped = True
+
+    def run_monitor(self, interval_seconds=1):
+        while not self.monitor_stopped:
+            if not self.connected:
+                try:
+                    # A restarted sender replaces the bus, so always
+                    # attach to the current one. The old bus isn't
+                    # closed, as a frame may be being written to it.
+                    self.bus = FrameBus.attach(self.bus_name)
+                except FileNotFoundError:
+                    logging.info(f'Waiting for frame bus: {self.bus_name}')
+                except:
+                    logging.exception('Frame bus attach failed')
+            sleep(interval_seconds)
+
+    def set_frame_array(self, array: np.ndarray):
+        bus = self.bus
+        if bus is None or not bus.is_sender_alive():
+            raise DeviceDisconnected()
+
+        if array.dtype != FRAME_DTYPE:
+            raise ValueError('Invalid frame array')
+
+        bus.write(array)
+
+        if self.recorder is not None:
+            self.recorder.record_frame(array)
+
+    def get_layout(self):
+        bus = self.bus
+        if bus is None or not bus.is_sender_alive():
+            raise DeviceDisconnected()
+
+        layout = bus.get_layout()
+        if layout is None:
+            raise DeviceDisconnected()
+        if self.recorder is not None:
+            self.recorder.record_metadata('layout', layout)
+        return layout
@@ -0,0 +1,108 @@
+from threading import Thread, Event
+from time import monotonic
+import logging
+
+from .clock import Clock
+from .metrics import metrics
+
+# Seconds an activity must run for before a crash restarts it without
+# backing off.
+IMMEDIATE_FAILURE_SECONDS = 10
+# Maximum seconds to wait before restarting a crashed activity.
+MAX_RESTART_DELAY_SECONDS = 60
+# Maximum seconds before a stopped activity notices while it waits for
+# a subscription update.
+STOP_POLL_SECONDS = 0.1
+
+
+class ActivityStopped(Exception):
+    pass
+
+
+class StoppableClock(Clock):
+    """The real clock, except that once stop() is called, sleeping or
+    waiting raises ActivityStopped - so that an activity loop running
+    in a thread exits (running its clean up) the next time it waits for
+    a frame."""
+
+    def __init__(self):
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def sleep(self, seconds):
+        if self.stopped.wait(timeout=max(0, seconds)):
+            raise ActivityStopped()
+
+    def wait(self, event, timeout) -> bool:
+        deadline = monotonic() + timeout
+        while True:
+            if self.stopped.is_set():
+                raise ActivityStopped()
+            remaining_seconds = deadline - monotonic()
+            if event.wait(timeout=max(0, min(remaining_seconds, STOP_POLL_SECONDS))):
+                return True
+            if remaining_seconds <= STOP_POLL_SECONDS:
+                return event.is_set()
+
+
+class HostedActivity:
+    """Runs an activity in its own thread alongside other activities in
+    the same process, restarting it with exponential backoff if it
+    crashes so that one failing activity doesn't take the others down.
+
+    target is called with a StoppableClock, and should run the activity
+    (creating and cleaning up its own device and subscriptions) until
+    the clock raises ActivityStopped.
+    """
+
+    def __init__(self, *, name, target):
+        self.name = name
+        self.target = target
+        self.stopped = Event()
+        self.clock = None
+        self.thread = None
+
+    def start(self):
+        """Run the activity in a new thread"""
+        self.thread = Thread(target=self.run, name=f'activity-{self.name}')
+        self.thread.start()
+
+    def stop(self):
+        """Called from the main thread to tell the activity to stop."""
+        self.stopped.set()
+        if self.clock is not None:
+            self.clock.stop()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout=timeout)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        retry_delay_seconds = 1
+        while not self.stopped.is_set():
+            attempt_start = monotonic()
+            self.clock = StoppableClock()
+            # In case stop() was called before the clock was replaced
+            if self.stopped.is_set():
+                break
+            try:
+                self.target(self.clock)
+                logging.warning(f'Activity {self.name} finished')
+            except ActivityStopped:
+                break
+            except:
+                logging.exception(f'Activity {self.name} crashed')
+
+            # Exponential backoff for immediate failures.
+            if (monotonic() - attempt_start) < IMMEDIATE_FAILURE_SECONDS:
+                retry_delay_seconds = min(retry_delay_seconds * 2, MAX_RESTART_DELAY_SECONDS)
+            else:
+                retry_delay_seconds = 1
+            logging.warning(f'Restarting activity {self.name} in {retry_delay_seconds} seconds')
+            if self.stopped.wait(timeout=retry_delay_seconds):
+                break
+            metrics.increment('activity_restarts', activity=self.name)
@@ -0,0 +1,221 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import perf_counter
+from urllib.parse import urlsplit, parse_qs
+import logging
+
+import numpy as np
+
+# Prefix of every exported metric name.
+METRIC_PREFIX = 'shooting_stars'
+# Upper bounds (in seconds) of stage duration histogram buckets.
+STAGE_BUCKET_SECONDS = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+]
+# Number of recent durations of each stage to calculate rolling
+# quantiles from.
+STAGE_WINDOW_SIZE = 1000
+# Rolling quantiles reported for each stage.
+STAGE_QUANTILES = [0.5, 0.9, 0.99]
+
+
+class HandlerError(Exception):
+    """Raised by a handler added with add_handler() to respond with an
+    HTTP error status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class StageHistogram:
+    """Histogram of stage durations since startup, plus a window of recent
+    durations for rolling quantiles."""
+
+    def __init__(self):
+        self.bucket_counts = np.zeros(len(STAGE_BUCKET_SECONDS) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.window = np.zeros(STAGE_WINDOW_SIZE)
+        self.window_idx = 0
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect_left(STAGE_BUCKET_SECONDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.window[self.window_idx % STAGE_WINDOW_SIZE] = seconds
+        self.window_idx += 1
+
+    def get_quantiles(self) -> list[float]:
+        window = self.window[:min(self.window_idx, STAGE_WINDOW_SIZE)]
+        if window.size == 0:
+            return [0.0] * len(STAGE_QUANTILES)
+        return np.quantile(window, STAGE_QUANTILES).tolist()
+
+
+class Metrics:
+    """Records stage timings, counters and gauges, and exposes them in
+    Prometheus text format.
+
+    Disabled by default, in which case every method returns immediately
+    without recording anything, so instrumented code costs close to
+    nothing unless metrics are enabled with enable().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+        # Keyed by (stage, sorted label tuples), like counters and gauges
+        self.stage_to_histogram = {}
+        # Keyed by (name, sorted label tuples)
+        self.counters = {}
+        self.gauges = {}
+        self.server = None
+        # Functions that take a dict of query parameters and return the
+        # text body for each path served by start_server()
+        self.path_to_handler = {
+            '/metrics': (lambda query: self.render()),
+        }
+
+    def enable(self):
+        self.enabled = True
+
+    def observe(self, stage, seconds, **labels):
+        """Record a duration for a named stage (e.g. ingest, simulate,
+        render, encode, send, camera, ai), labelled with the activity or
+        device it is for."""
+        if not self.enabled:
+            return
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.stage_to_histogram.get(key)
+            if histogram is None:
+                histogram = self.stage_to_histogram[key] = StageHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def _time_stage(self, stage, labels):
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start_time, **labels)
+
+    def stage(self, stage, **labels):
+        """Return a context manager that records the duration of its body
+        for the named stage."""
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self._time_stage(stage, labels)
+
+    def increment(self, name, amount=1, **labels):
+        """Add to a counter, such as dropped_frames or reconnects."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge, such as a queue depth."""
+        if not self.enabled:
+            return
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self) -> str:
+        """Return all metrics in Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            stage_name = f'{METRIC_PREFIX}_stage_seconds'
+            if self.stage_to_histogram:
+                lines.append(f'# TYPE {stage_name} histogram')
+            for (stage, labels), histogram in sorted(self.stage_to_histogram.items()):
+                stage_labels = (('stage', stage), *labels)
+                cumulative_counts = np.cumsum(histogram.bucket_counts)
+                for bound, count in zip(STAGE_BUCKET_SECONDS, cumulative_counts):
+                    lines.append(f'{stage_name}_bucket{format_labels((*stage_labels, ("le", bound)))} {count}')
+                lines.append(f'{stage_name}_bucket{format_labels((*stage_labels, ("le", "+Inf")))} {histogram.count}')
+                lines.append(f'{stage_name}_sum{format_labels(stage_labels)} {histogram.sum}')
+                lines.append(f'{stage_name}_count{format_labels(stage_labels)} {histogram.count}')
+            if self.stage_to_histogram:
+                lines.append(f'# TYPE {stage_name}_recent gauge')
+            for (stage, labels), histogram in sorted(self.stage_to_histogram.items()):
+                for quantile, value in zip(STAGE_QUANTILES, histogram.get_quantiles()):
+                    lines.append(f'{stage_name}_recent{format_labels((("stage", stage), *labels, ("quantile", quantile)))} {value}')
+
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{METRIC_PREFIX}_{name}_total{format_labels(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'{METRIC_PREFIX}_{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def add_handler(self, path, handler):
+        """Serve the text returned by handler(query) at path. The handler
+        can raise ValueError for a bad request, or HandlerError for any
+        other error status."""
+        self.path_to_handler[path] = handler
+
+    def start_server(self, port, host='127.0.0.1'):
+        """Enable metrics and serve them at http://host:port/metrics (along
+        with any other handlers) in a new thread."""
+        self.enable()
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                handler = metrics.path_to_handler.get(url.path)
+                if handler is None:
+                    self.send_error(404)
+                    return
+                try:
+                    body = handler(parse_qs(url.query)).encode()
+                except ValueError as ex:
+                    self.send_error(400, str(ex))
+                    return
+                except HandlerError as ex:
+                    self.send_error(ex.status, str(ex))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't log every scrape
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server_thread = Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        server_thread.start()
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+class NullContext:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_CONTEXT = NullContext()
+
+# Shared by all activities, and enabled by --metrics-port
+metrics = Metrics()
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class GaussianNB:
+    """Incremental Gaussian naive Bayes classifier that learns from and
+    predicts for whole matrices of features at a time.
+
+    Each row of a feature matrix is one example, and each column is a
+    feature. Per-class feature means and variances are updated in a
+    single pass over each batch (Chan et al.'s parallel variance
+    algorithm), so learning is numerically stable regardless of batch
+    size.
+    """
+
+    def __init__(self, *, classes, n_features, var_smoothing=1e-3):
+        self.classes = list(classes)
+        self.n_features = n_features
+        # Added to every variance so that constant features (such as
+        # a count that is always zero) don't produce zero variances.
+        self.var_smoothing = var_smoothing
+        self.counts = np.zeros(len(self.classes))
+        self.means = np.zeros((len(self.classes), n_features))
+        self.sq_diffs = np.zeros((len(self.classes), n_features))
+
+    def reset(self):
+        """Forget everything learned so far."""
+        self.counts[:] = 0
+        self.means[:] = 0
+        self.sq_diffs[:] = 0
+
+    def snapshot(self) -> dict[str, np.ndarray]:
+        """Return a copy of the model's learned parameters."""
+        return {
+            'counts': self.counts.copy(),
+            'means': self.means.copy(),
+            'sq_diffs': self.sq_diffs.copy(),
+        }
+
+    def restore(self, snapshot: dict[str, np.ndarray]):
+        """Replace the model's learned parameters with a snapshot."""
+        for key, value in self.snapshot().items():
+            if snapshot[key].shape != value.shape:
+                raise ValueError(f'Snapshot {key} has shape {snapshot[key].shape}, expected {value.shape}')
+        self.counts[:] = snapshot['counts']
+        self.means[:] = snapshot['means']
+        self.sq_diffs[:] = snapshot['sq_diffs']
+
+    def learn_many(self, X: np.ndarray, y: np.ndarray):
+        """Update the model with a matrix of examples X with class labels
+        y."""
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y)
+        for class_index, label in enumerate(self.classes):
+            class_X = X[y == label]
+            batch_count = class_X.shape[0]
+            if batch_count == 0:
+                continue
+            batch_mean = class_X.mean(axis=0)
+            batch_sq_diffs = ((class_X - batch_mean) ** 2).sum(axis=0)
+
+            count = self.counts[class_index]
+            total_count = count + batch_count
+            delta = batch_mean - self.means[class_index]
+            self.means[class_index] += delta * (batch_count / total_count)
+            self.sq_diffs[class_index] += batch_sq_diffs + (delta ** 2) * (count * batch_count / total_count)
+            self.counts[class_index] = total_count
+
+    def joint_log_likelihood_many(self, X: np.ndarray) -> np.ndarray:
+        """Return a matrix with a row for each example in X and a column for
+        each class, containing log(P(class) * P(X | class)). Classes
+        that have not been learned have a value of -inf."""
+        X = np.asarray(X, dtype=float)
+        # Unbiased variance, as for a single running Gaussian.
+        variances = np.divide(
+            self.sq_diffs,
+            (self.counts - 1)[:, np.newaxis],
+            out=np.zeros_like(self.sq_diffs),
+            where=(self.counts > 1)[:, np.newaxis],
+        ) + self.var_smoothing
+        with np.errstate(divide='ignore'):
+            log_priors = np.log(self.counts / max(self.counts.sum(), 1))
+        # (examples, classes, features)
+        deviations = X[:, np.newaxis, :] - self.means[np.newaxis, :, :]
+        log_likelihoods = -0.5 * (
+            np.log(2 * np.pi * variances)[np.newaxis, :, :]
+            + (deviations ** 2) / variances[np.newaxis, :, :]
+        ).sum(axis=2)
+        return log_priors[np.newaxis, :] + log_likelihoods
+
+    def predict_proba_many(self, X: np.ndarray) -> np.ndarray:
+        """Return a matrix with a row for each example in X and a column for
+        each class, containing the probability of the example
+        belonging to that class. All probabilities are zero when
+        nothing has been learned."""
+        X = np.asarray(X, dtype=float)
+        if self.counts.sum() == 0:
+            return np.zeros((X.shape[0], len(self.classes)))
+        jll = self.joint_log_likelihood_many(X)
+        # Normalise in log-space to avoid underflow
+        jll = jll - jll.max(axis=1, keepdims=True)
+        likelihoods = np.exp(jll)
+        return likelihoods / likelihoods.sum(axis=1, keepdims=True)
+
+    def predict_many(self, X: np.ndarray) -> np.ndarray:
+        """Return the most likely class label for each example in X."""
+        return np.array(self.classes)[self.joint_log_likelihood_many(X).argmax(axis=1)]
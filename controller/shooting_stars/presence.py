@@ -1,14 +1,17 @@
 from collections import deque
 from dataclasses import dataclass
-from functools import cache
-from time import sleep, monotonic
+from threading import Thread, Lock
+from time import sleep, monotonic, perf_counter
 import logging
-from typing import Any, Sequence
+from typing import Any, Optional, Sequence
 
 import cv2 as cv
 import numpy as np
 
+from .clock import REAL_CLOCK
 from .device import FRAME_DTYPE, DeviceDisconnected
+from .fixed_point import MAX_VALUE, WORK_DTYPE, FrameMath, to_fixed
+from .metrics import metrics
 from .utils import hexstring_to_rgb
 
 COMPONENT_COUNT = 4
@@ -16,18 +19,296 @@ W = slice(0, 1)
 RGBW = slice(0, 4)
 RGB = slice(1, 4)
 
+# Maximum number of seconds to wait between attempts to reopen the
+# camera.
+MAX_CAPTURE_RETRY_SECONDS = 30
+# Resolution (width, height) to request from the camera. Motion is
+# detected at a much lower resolution, so capturing more pixels only
+# costs time. The camera may choose a different resolution.
+CAPTURE_SIZE = (320, 240)
+# Minimum change in grey level for a pixel to count as motion.
+MOTION_THRESHOLD = 10
+# Number of times to dilate motion at the presence map size.
+MOTION_DILATE_ITERATIONS = 2
+# Size of the blur applied to motion at the presence map size.
+MOTION_BLUR_SIZE = 21
+# Number of seconds between logging the mean time of each motion
+# detection stage.
+STAGE_LOG_INTERVAL_SECONDS = 60
+# Number of frames each twinkle takes to grow to max brightness.
+TWINKLE_STEPS = 15
+# Fixed-point brightness kept by fading twinkles each frame, and value
+# added to a growing twinkle each step.
+TWINKLE_FADE_BRIGHTNESS = to_fixed(0.85)
+TWINKLE_STEP_VALUE = int((1.1 / TWINKLE_STEPS) * 255)
+# Maximum number of upcoming frames of presence maps to keep for each
+# remote.
+MAX_SCHEDULED_PRESENCE_MAPS = 10
+# Maximum number of remote presences to keep track of, beyond which
+# the least recently active are forgotten.
+MAX_REMOTE_PRESENCES = 50
+# Initial number of presences to allocate frame buffers for (grown as
+# more remotes appear).
+INITIAL_PRESENCE_CAPACITY = 4
+
+
+class PresenceSchedule:
+    """Queue of presence maps to show, one per frame. Maps shown for
+    several frames are stored once with a frame count, and when more
+    than maxlen frames are queued the oldest are dropped."""
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        # [presence_map, frame_count] entries, oldest first
+        self.entries = deque()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, presence_map, frame_count=1):
+        self.entries.append([presence_map, frame_count])
+        self.length += frame_count
+        while self.length > self.maxlen:
+            oldest = self.entries[0]
+            dropped = min(oldest[1], self.length - self.maxlen)
+            oldest[1] -= dropped
+            self.length -= dropped
+            if oldest[1] == 0:
+                self.entries.popleft()
+
+    def popleft(self):
+        """Remove and return the map for the next frame, raising
+        IndexError if there are none."""
+        entry = self.entries[0]
+        entry[1] -= 1
+        self.length -= 1
+        if entry[1] == 0:
+            self.entries.popleft()
+        return entry[0]
+
 
 @dataclass
 class Presence:
     colour: np.ndarray
+    # Colour hexstring that colour was decoded from
+    colour_hexstring: str
     last_timestamp: int
-    presence_maps: deque[np.ndarray]
+    presence_maps: PresenceSchedule
+    # Newest event seen and its decoded map, to linger on when there
+    # are no new events
+    latest_timestamp: Optional[int] = None
+    latest_presence_map: Optional[np.ndarray] = None
+
+
+class MotionPipeline:
+    """Detects motion between camera images, producing presence maps.
+
+    Each image is downscaled straight to the working size with area
+    interpolation (which also smooths away sensor noise), and motion is
+    thresholded, dilated and blurred at that size. The working size
+    defaults to the presence map size, otherwise the result is resized
+    to the presence map size at the end.
+
+    Frames where no pixel changed by more than the motion threshold
+    skip the threshold, dilate and blur stages and return an empty map.
+
+    The time spent in each stage is accumulated in stage_seconds.
+    """
+
+    STAGES = ['downscale', 'delta', 'threshold', 'dilate', 'blur', 'resize']
+
+    def __init__(self, *, presence_map_size, working_size=None):
+        self.presence_map_size = tuple(presence_map_size)
+        self.working_size = tuple(working_size or presence_map_size)
+        # Kernel sizes are specified at the presence map size, so scale
+        # them to the working size.
+        scale = max(self.working_size) / max(self.presence_map_size)
+        self.dilate_iterations = max(1, round(MOTION_DILATE_ITERATIONS * scale))
+        blur_size = round(MOTION_BLUR_SIZE * scale)
+        # Gaussian kernel sizes must be odd
+        self.blur_size = blur_size + (1 - blur_size % 2)
+        self.last_image = None
+        # Shared by every frame without motion, so must not be modified
+        self.still_map = np.zeros(self.presence_map_size[::-1], dtype=np.uint8)
+        self.still_map.flags.writeable = False
+        self.reset_timings()
+
+    def reset_timings(self):
+        self.frame_count = 0
+        self.still_frame_count = 0
+        self.stage_seconds = {stage: 0.0 for stage in self.STAGES}
+
+    def get_mean_stage_seconds(self) -> dict[str, float]:
+        return {
+            stage: seconds / max(self.frame_count, 1)
+            for stage, seconds in self.stage_seconds.items()
+        }
+
+    def time_stage(self, stage, start_time):
+        """Add the time since start_time to the stage, returning the
+        current time to start the next stage from."""
+        now = perf_counter()
+        self.stage_seconds[stage] += now - start_time
+        metrics.observe(f'motion_{stage}', now - start_time, activity='presence')
+        return now
+
+    def process(self, image):
+        """Return the presence map for motion between the previous images
+        and this image, or None for the first image."""
+        self.frame_count += 1
+        stage_time = perf_counter()
+
+        image = cv.resize(image, self.working_size, interpolation=cv.INTER_AREA)
+        # Flip along both axes so that 0,0 is bottom left
+        image = cv.flip(image, -1)
+        stage_time = self.time_stage('downscale', stage_time)
+
+        if self.last_image is None:
+            self.last_image = image
+            return None
+
+        image_delta = cv.absdiff(self.last_image, image)
+        image_delta = cv.cvtColor(image_delta, cv.COLOR_BGR2GRAY)
+        self.last_image = cv.addWeighted(self.last_image, 0.5, image, 0.5, 0)
+        # If no pixel changed enough to pass the threshold, the rest of
+        # the pipeline can only produce an empty map.
+        _, max_delta, _, _ = cv.minMaxLoc(image_delta)
+        self.time_stage('delta', stage_time)
+        if max_delta <= MOTION_THRESHOLD:
+            self.still_frame_count += 1
+            return self.still_map
+        stage_time = perf_counter()
+
+        _, image_delta = cv.threshold(image_delta, MOTION_THRESHOLD, 255, cv.THRESH_BINARY)
+        stage_time = self.time_stage('threshold', stage_time)
+        image_delta = cv.dilate(image_delta, None, iterations=self.dilate_iterations)
+        stage_time = self.time_stage('dilate', stage_time)
+        image_delta = cv.GaussianBlur(image_delta, (self.blur_size, self.blur_size), 0)
+        stage_time = self.time_stage('blur', stage_time)
+
+        if self.working_size != self.presence_map_size:
+            image_delta = cv.resize(image_delta, self.presence_map_size, interpolation=cv.INTER_AREA)
+        self.time_stage('resize', stage_time)
+
+        return image_delta
+
+
+class PresenceCapture:
+    """Captures camera images and computes presence maps from them in a
+    separate thread, so that slow or failing camera reads never delay
+    rendering.
+
+    Each new presence map is a new array that is never modified after
+    it is published, so the render loop can safely use the latest
+    completed map while the next one is being computed.
+    """
+
+    def __init__(self, *, presence_map_size, frame_delay_seconds, capture_size=CAPTURE_SIZE, working_size=None):
+        self.presence_map_size = presence_map_size
+        self.frame_delay_seconds = frame_delay_seconds
+        self.capture_size = capture_size
+        self.pipeline = MotionPipeline(presence_map_size=presence_map_size, working_size=working_size)
+        self.presence_map = np.zeros(presence_map_size)
+        self.presence_map_lock = Lock()
+        self.cap = None
+        self.stopped = False
+
+    def start(self):
+        """Run the capture in a new thread"""
+        capture_thread = Thread(target=self.run, name='presence-capture')
+        capture_thread.start()
+
+    def stop(self):
+        """Called from the main thread to tell the capture thread to stop."""
+        self.stopped = True
+
+    def get_presence_map(self):
+        """Return the latest completed presence map."""
+        with self.presence_map_lock:
+            return self.presence_map
+
+    def open(self):
+        """Try to open the camera, returning True if successful."""
+        logging.info('Opening video capture')
+        self.cap = cv.VideoCapture(-1)
+        if not self.cap.isOpened():
+            return False
+        if self.capture_size is not None:
+            width, height = self.capture_size
+            self.cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
+            self.cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+        logging.info(f'Capturing at {self.cap.get(cv.CAP_PROP_FRAME_WIDTH):.0f}x'
+                     f'{self.cap.get(cv.CAP_PROP_FRAME_HEIGHT):.0f}')
+        return True
+
+    def close(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    def log_stage_timings(self):
+        mean_stage_seconds = self.pipeline.get_mean_stage_seconds()
+        logging.info(f'Motion detection stage times ({self.pipeline.still_frame_count}/'
+                     f'{self.pipeline.frame_count} frames still): ' + ', '.join(
+            f'{stage} {seconds * 1000:.2f}ms'
+            for stage, seconds in mean_stage_seconds.items()
+        ))
+        self.pipeline.reset_timings()
+
+    def run(self):
+        retry_delay_seconds = 1
+        next_time = monotonic()
+        next_log_time = next_time + STAGE_LOG_INTERVAL_SECONDS
+        try:
+            while not self.stopped:
+                if self.cap is None:
+                    if not self.open():
+                        self.close()
+                        # Exponential backoff for repeated failures
+                        logging.warning(f'Failed to open video capture, retrying in {retry_delay_seconds} seconds')
+                        sleep(retry_delay_seconds)
+                        retry_delay_seconds = min(retry_delay_seconds * 2, MAX_CAPTURE_RETRY_SECONDS)
+                        continue
+                    retry_delay_seconds = 1
+                    metrics.increment('reconnects', source='camera')
+
+                next_time = next_time + self.frame_delay_seconds
+                sleep(max(0, next_time - monotonic()))
+                # Don't try to catch up on missed captures
+                next_time = max(next_time, monotonic())
+
+                capture_start_time = monotonic()
+                ret, image = self.cap.read()
+                if not ret:
+                    logging.warning('Failed to capture image, reconnecting')
+                    self.close()
+                    continue
+
+                try:
+                    presence_map = self.pipeline.process(image)
+                except:
+                    logging.exception('Presence map failed')
+                    continue
+                metrics.observe('camera', monotonic() - capture_start_time, activity='presence')
+                if presence_map is not None:
+                    with self.presence_map_lock:
+                        self.presence_map = presence_map
+
+                if monotonic() >= next_log_time:
+                    next_log_time = monotonic() + STAGE_LOG_INTERVAL_SECONDS
+                    self.log_stage_timings()
+        finally:
+            self.close()
 
 
 class PresenceState:
 
-    def __init__(self, *, light_positions: np.ndarray, local_config: dict[str, Any]):
+    def __init__(self, *, light_positions: np.ndarray, local_config: dict[str, Any],
+                 capture_size=CAPTURE_SIZE, working_size=None, max_remote_presences=MAX_REMOTE_PRESENCES,
+                 capture=None, rng=np.random):
         self.light_positions = light_positions
+        self.rng = rng
         self.local_colour = hexstring_to_rgb(local_config['colour'])
         self.frame_delay_milliseconds = local_config['frameDelayMilliseconds']
         self.frames_between_send = local_config['framesBetweenSend']
@@ -35,100 +316,143 @@ class PresenceState:
         self.frame_linger_milliseconds = local_config['frameLingerMilliseconds']
         self.presence_scaling_factor = local_config['presenceScalingFactor']
         self.presence_fadeout_factor = local_config['presenceFadeoutFactor']
+        # Fixed-point brightness kept by fading lights each frame
+        self.presence_fadeout_brightness = to_fixed(1 - self.presence_fadeout_factor)
 
         self.local_presence_map = np.zeros(self.local_presence_map_size)
         self.remote_id_to_presence = {}
-        self.last_image = None
-        self.cap = None
-        self.frame = np.zeros((len(self.light_positions), COMPONENT_COUNT), dtype=FRAME_DTYPE)
-        self.twinkles = {}
+        self.max_remote_presences = max_remote_presences
+        self.map_shape_to_light_indexes = {}
+        self.map_shape_to_flat_light_indexes = {}
+        # Anything with start(), stop() and get_presence_map() can stand
+        # in for the camera (e.g. in simulations).
+        self.capture = capture or PresenceCapture(
+            presence_map_size=self.local_presence_map_size,
+            frame_delay_seconds=(self.frame_delay_milliseconds / 1000),
+            capture_size=capture_size,
+            working_size=working_size,
+        )
+        light_count = len(self.light_positions)
+        self.frame = np.zeros((light_count, COMPONENT_COUNT), dtype=FRAME_DTYPE)
+        # Whether any light has presence colour left to fade out
+        self.rgb_lit = False
+
+        # Buffers reused every frame. The frame is faded and added to in
+        # fixed point, with added_values holding the whole values of
+        # added_rgb.
+        self.rgb_math = FrameMath((light_count, 3))
+        self.white_math = FrameMath(light_count)
+        self.added_rgb = np.zeros((light_count, 3))
+        self.added_values = np.zeros((light_count, 3), dtype=WORK_DTYPE)
+        self.fadeout_mask = np.zeros((light_count, 3), dtype=bool)
+        self.presence_capacity = 0
+        self.grow_presence_buffers(INITIAL_PRESENCE_CAPACITY)
+        self.shape_to_map_stack = {}
+        # The step of the twinkle on each light, or -1 for no twinkle
+        self.twinkle_steps = np.full(light_count, -1)
+        self.twinkle_mask = np.zeros(light_count, dtype=bool)
+        self.twinkle_buffer_mask = np.zeros(light_count, dtype=bool)
 
     def __enter__(self):
-        cap_opened = False
-        while not cap_opened:
-            logging.info('Opening video capture')
-            self.cap = cv.VideoCapture(-1)
-            cap_opened = self.cap.isOpened()
+        self.capture.start()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.cap.release()
+        self.capture.stop()
 
     def update_local_presence_map(self):
-        ret, image = self.cap.read()
-        if not ret:
-            logging.warning('Failed to capture image, reconnecting')
-            self.__exit__(None, None, None)
-            self.__enter__()
-            return None
-
-        image = cv.resize(image, (500, 500))
-        image = cv.GaussianBlur(image, (19, 19), 0)
-        image = cv.resize(image, self.local_presence_map_size)
-        # Flip along both axes so that 0,0 is bottom left
-        image = cv.flip(image, -1)
-
-        if self.last_image is not None:
-            image_delta = cv.absdiff(self.last_image, image)
-            image_delta = cv.cvtColor(image_delta, cv.COLOR_BGR2GRAY)
-            _, image_delta = cv.threshold(image_delta, 10, 255, cv.THRESH_BINARY)
-            image_delta = cv.dilate(image_delta, None, iterations=2)
-            image_delta = cv.GaussianBlur(image_delta, (21, 21), 0)
-            self.local_presence_map = image_delta
-
-        if self.last_image is None:
-            self.last_image = image
-        else:
-            self.last_image = cv.addWeighted(self.last_image, 0.5, image, 0.5, 0)
-
+        """Pick up the latest presence map from the capture thread."""
+        self.local_presence_map = self.capture.get_presence_map()
         return self.local_presence_map
 
     def update_remote_presences(self, remote_presences: Sequence[dict]):
         for remote_presence in remote_presences:
             remote_id = remote_presence['id']
+            colour_hexstring = remote_presence['config']['colour']
+            events = remote_presence['presenceEvents']
             if remote_id not in self.remote_id_to_presence:
                 # If no previous data for this remote, ignore all
                 # existing events by setting last_timestamp to their
                 # max timestamp
-                prev_timestamps = [event['timestamp'] for event in remote_presence['presenceEvents']]
+                prev_timestamps = [event['timestamp'] for event in events]
                 self.remote_id_to_presence[remote_id] = Presence(
-                    colour=hexstring_to_rgb(remote_presence['config']['colour']),
+                    colour=hexstring_to_rgb(colour_hexstring),
+                    colour_hexstring=colour_hexstring,
                     last_timestamp=(max(prev_timestamps) if prev_timestamps else 0),
-                    # Only keep a fixed number of recent maps
-                    presence_maps=deque(maxlen=10)
+                    presence_maps=PresenceSchedule(maxlen=MAX_SCHEDULED_PRESENCE_MAPS),
                 )
             presence = self.remote_id_to_presence[remote_id]
-            presence.colour = hexstring_to_rgb(remote_presence['config']['colour'])
-
-            events = list(sorted(
-                remote_presence['presenceEvents'],
-                key=(lambda event: event['timestamp']),
-            ))
+            if colour_hexstring != presence.colour_hexstring:
+                presence.colour = hexstring_to_rgb(colour_hexstring)
+                presence.colour_hexstring = colour_hexstring
+
+            # Only look at events that are more recent than all
+            # previous events, and decode each map once.
+            latest_event = None
+            new_events = []
             for event in events:
-                # Only add an event if it is more recent than all
-                # previous events
+                if latest_event is None or event['timestamp'] >= latest_event['timestamp']:
+                    latest_event = event
+                if event['timestamp'] > presence.last_timestamp:
+                    new_events.append(event)
+            new_events.sort(key=(lambda event: event['timestamp']))
+            latest_presence_map = None
+            for event in new_events:
                 if event['timestamp'] <= presence.last_timestamp:
                     continue
                 presence.last_timestamp = event['timestamp']
-                # Duplicate presence_maps to account for delay between
-                # remote sends
-                presence_map = np.array(event['presenceMap'])
-                for _ in range(self.frames_between_send):
-                    presence.presence_maps.append(presence_map)
+                presence_map = self.decode_presence_map(event)
+                if event is latest_event:
+                    latest_presence_map = presence_map
+                # Show each map until the remote's next send
+                presence.presence_maps.append(presence_map, self.frames_between_send)
+            if latest_event is None:
+                presence.latest_timestamp = None
+                presence.latest_presence_map = None
+            elif latest_event['timestamp'] != presence.latest_timestamp or latest_presence_map is not None:
+                presence.latest_timestamp = latest_event['timestamp']
+                presence.latest_presence_map = (
+                    latest_presence_map if latest_presence_map is not None
+                    else self.decode_presence_map(latest_event)
+                )
 
             # If we have no presence_maps, then include the latest if
             # it is no more than a few seconds old.
             if (
                     (len(presence.presence_maps) == 0) and
-                    (len(events) > 0) and
-                    (events[-1]['timestamp'] >= (presence.last_timestamp - self.frame_linger_milliseconds))
+                    (presence.latest_timestamp is not None) and
+                    (presence.latest_timestamp >= (presence.last_timestamp - self.frame_linger_milliseconds))
             ):
                 presence.last_timestamp += self.frame_delay_milliseconds
-                presence.presence_maps.append(np.array(events[-1]['presenceMap']))
-
+                presence.presence_maps.append(presence.latest_presence_map)
+
+        self.evict_remote_presences(set(remote_presence['id'] for remote_presence in remote_presences))
+
+    def evict_remote_presences(self, remote_ids):
+        """Forget remotes that aren't in remote_ids, and the least recently
+        active remotes while there are more than max_remote_presences."""
+        for remote_id in list(self.remote_id_to_presence.keys()):
+            if remote_id not in remote_ids:
+                del self.remote_id_to_presence[remote_id]
+        excess_count = len(self.remote_id_to_presence) - self.max_remote_presences
+        if excess_count > 0:
+            logging.warning(f'Evicting {excess_count} remote presences')
+            evicted_ids = sorted(
+                self.remote_id_to_presence.keys(),
+                key=(lambda remote_id: self.remote_id_to_presence[remote_id].last_timestamp),
+            )[:excess_count]
+            for remote_id in evicted_ids:
+                del self.remote_id_to_presence[remote_id]
+
+    @staticmethod
+    def decode_presence_map(event):
+        return np.array(event['presenceMap'], dtype=np.uint8)
 
-    @cache
     def get_light_map_indexes(self, map_shape: tuple[int, int]) -> np.ndarray:
+        """Return the (row, col) index of each light in a map of
+        map_shape."""
+        if map_shape in self.map_shape_to_light_indexes:
+            return self.map_shape_to_light_indexes[map_shape]
         position_range = (self.light_positions.max(axis=0) - self.light_positions.min(axis=0))
         zero_one_indexes = np.divide(
             (self.light_positions - self.light_positions.min(axis=0)),
@@ -138,79 +462,123 @@ class PresenceState:
         )
         max_indexes = np.array(map_shape) - 1
         indexes = np.floor(zero_one_indexes * max_indexes).astype(int)
+        self.map_shape_to_light_indexes[map_shape] = indexes
         return indexes
 
-    def get_frame_component(self, *, presence_map, colour):
-        light_indexes = self.get_light_map_indexes(presence_map.shape)
-        scaled_presence_map = (presence_map / 255) * self.presence_scaling_factor
-        light_brightness = scaled_presence_map[light_indexes[:, 0], light_indexes[:, 1]]
-        return (
-            np.broadcast_to(
-                light_brightness,
-                (colour.shape[0], light_brightness.shape[0]),
-            ).T
-            *
-            np.broadcast_to(
-                colour,
-                (light_brightness.shape[0], colour.shape[0]),
+    def get_flat_light_map_indexes(self, map_shape: tuple[int, int]) -> np.ndarray:
+        """Return the index of each light in a flattened map of
+        map_shape."""
+        if map_shape not in self.map_shape_to_flat_light_indexes:
+            light_indexes = self.get_light_map_indexes(map_shape)
+            self.map_shape_to_flat_light_indexes[map_shape] = np.ravel_multi_index(
+                (light_indexes[:, 0], light_indexes[:, 1]),
+                map_shape,
             )
-        )
+        return self.map_shape_to_flat_light_indexes[map_shape]
+
+    def grow_presence_buffers(self, presence_count):
+        """Make sure per-presence buffers have room for presence_count
+        presences."""
+        if presence_count <= self.presence_capacity:
+            return
+        self.presence_capacity = max(presence_count, self.presence_capacity * 2)
+        self.light_brightness = np.zeros((self.presence_capacity, len(self.light_positions)))
+        self.colour_matrix = np.zeros((self.presence_capacity, 3))
+
+    def get_map_stack(self, map_shape, presence_count):
+        """Return a reusable array with room for presence_count flattened
+        maps of map_shape."""
+        map_stack = self.shape_to_map_stack.get(map_shape)
+        if map_stack is None or map_stack.shape[0] < presence_count:
+            map_stack = np.zeros((max(presence_count, self.presence_capacity), np.prod(map_shape)), dtype=np.uint8)
+            self.shape_to_map_stack[map_shape] = map_stack
+        return map_stack
+
+    def add_presences(self, *, presence_maps, colours):
+        """Fill added_rgb with the colour each light gets from the
+        presence maps."""
+        presence_count = len(presence_maps)
+        self.grow_presence_buffers(presence_count)
+        light_brightness = self.light_brightness[:presence_count]
+
+        # Maps are normally all the same shape, so this is one gather
+        map_shape_to_rows = {}
+        for row, presence_map in enumerate(presence_maps):
+            map_shape_to_rows.setdefault(presence_map.shape, []).append(row)
+        for map_shape, rows in map_shape_to_rows.items():
+            map_stack = self.get_map_stack(map_shape, len(rows))
+            for stack_row, row in enumerate(rows):
+                map_stack[stack_row] = presence_maps[row].reshape(-1)
+            light_brightness[rows] = map_stack[:len(rows), self.get_flat_light_map_indexes(map_shape)]
+        np.divide(light_brightness, 255, out=light_brightness)
+        np.multiply(light_brightness, self.presence_scaling_factor, out=light_brightness)
+
+        colour_matrix = self.colour_matrix[:presence_count]
+        for row, colour in enumerate(colours):
+            colour_matrix[row] = colour
+        np.matmul(light_brightness.T, colour_matrix, out=self.added_rgb)
+
+    def tick_twinkles(self):
+        """Fade twinkles, randomly add new ones, and brighten each twinkle
+        over TWINKLE_STEPS frames."""
+        white = self.frame[:, 0]
+        self.white_math.scale(white, TWINKLE_FADE_BRIGHTNESS)
+        if self.rng.rand() > 0.3:
+            for _ in range(2):
+                self.twinkle_steps[self.rng.randint(self.frame.shape[0])] = 0
+        # Keep twinkles that haven't finished growing, and grow them
+        np.greater_equal(self.twinkle_steps, 0, out=self.twinkle_mask)
+        np.less(self.twinkle_steps, TWINKLE_STEPS, out=self.twinkle_buffer_mask)
+        np.logical_and(self.twinkle_mask, self.twinkle_buffer_mask, out=self.twinkle_mask)
+        np.add(self.twinkle_steps, 1, out=self.twinkle_steps, where=self.twinkle_mask)
+        np.logical_not(self.twinkle_mask, out=self.twinkle_buffer_mask)
+        np.copyto(self.twinkle_steps, -1, where=self.twinkle_buffer_mask)
+        self.white_math.add(white, TWINKLE_STEP_VALUE, where=self.twinkle_mask)
 
     def tick_frame(self):
-        self.frame = self.frame.astype(float)
-
-        components = [
-            self.get_frame_component(
-                presence_map=self.local_presence_map,
-                colour=self.local_colour,
-            ),
-        ]
+        # Maps without any presence add nothing, so skip them.
+        presence_maps = []
+        colours = []
+        if self.local_presence_map.any():
+            presence_maps.append(self.local_presence_map)
+            colours.append(self.local_colour)
         for remote_presence in self.remote_id_to_presence.values():
             try:
                 presence_map = remote_presence.presence_maps.popleft()
             except IndexError:
                 pass
             else:
-                components.append(self.get_frame_component(
-                    presence_map=presence_map,
-                    colour=remote_presence.colour,
-                ))
-
-        # Fade-out any light+colour that isn't being added to.
-        fadeout_mask = np.full(self.frame[:, RGB].shape, True)
-        for component in components:
-            fadeout_mask = fadeout_mask & (component == 0)
-        fadeout = 1 - (fadeout_mask * self.presence_fadeout_factor)
-        self.frame[:, RGB] = self.frame[:, RGB] * fadeout
-
-        # Add motion to lights
-        for component in components:
-            self.frame[:, RGB] += component
-
-        # Fade last twinkles
-        self.frame[:, W] = self.frame[:, W] * 0.85
-        # Randomly add new twinkles
-        if np.random.rand() > 0.3:
-            for _ in range(2):
-                self.twinkles[np.random.randint(self.frame.shape[0])] = 0
-        # Grow each twinkle to max brightness over `twinkle_steps` steps
-        twinkle_steps = 15
-        self.twinkles = {
-            twinkle_idx: twinkle_step + 1
-            for twinkle_idx, twinkle_step in self.twinkles.items()
-            if twinkle_step < twinkle_steps
-        }
-        for twinkle_idx, twinkle_step in self.twinkles.items():
-            self.frame[twinkle_idx, W] += int((1.1 / twinkle_steps) * 255)
-
-        self.frame = np.clip(self.frame, 0, 255).astype(FRAME_DTYPE)
-
-
-def run_presence(*, device, presence_sub):
-    next_time = monotonic()
+                if presence_map.any():
+                    presence_maps.append(presence_map)
+                    colours.append(remote_presence.colour)
+
+        rgb = self.frame[:, RGB]
+        if len(presence_maps) > 0:
+            self.add_presences(presence_maps=presence_maps, colours=colours)
+            # Fade-out any light+colour that isn't being added to.
+            np.equal(self.added_rgb, 0, out=self.fadeout_mask)
+            self.rgb_math.scale(rgb, self.presence_fadeout_brightness, where=self.fadeout_mask)
+            # Add motion to lights, dropping fractions as the frame can
+            # only hold whole values
+            np.minimum(self.added_rgb, MAX_VALUE, out=self.added_rgb)
+            np.copyto(self.added_values, self.added_rgb, casting='unsafe')
+            self.rgb_math.add(rgb, self.added_values)
+        elif self.rgb_lit:
+            # Idle: nothing is being added to, so fade out every light
+            # until they are all off.
+            self.rgb_math.scale(rgb, self.presence_fadeout_brightness)
+
+        self.tick_twinkles()
+
+        self.rgb_lit = rgb.any()
+
+
+def run_presence(*, device, presence_sub, capture_size=CAPTURE_SIZE, working_size=None,
+                 clock=REAL_CLOCK, rng=np.random, capture=None):
+    next_time = clock.monotonic()
 
     while not presence_sub.ready:
-        sleep(1)
+        clock.sleep(1)
     local_config_promise = presence_sub.call('presence.getConfig', [presence_sub.token])
     local_config = local_config_promise.await_result()
 
@@ -219,7 +587,7 @@ def run_presence(*, device, presence_sub):
             layout = device.get_layout()
             break
         logging.info('Waiting for layout')
-        sleep(1)
+        clock.sleep(1)
 
     # Keep only 2 dimensions
     light_positions = np.array([
@@ -233,34 +601,52 @@ def run_presence(*, device, presence_sub):
     max_tick = 1_000 * frames_between_send
     tick = 0
 
-    with PresenceState(light_positions=light_positions, local_config=local_config) as presence_state:
+    with PresenceState(
+            light_positions=light_positions,
+            local_config=local_config,
+            capture_size=capture_size,
+            working_size=working_size,
+            capture=capture,
+            rng=rng,
+    ) as presence_state:
         while True:
             tick = (tick + 1) % max_tick
             next_time = next_time + frame_delay_seconds
-            sleep(max(0, next_time - monotonic()))
-            frame_start_time = monotonic()
+            if (clock.monotonic() - next_time) > frame_delay_seconds:
+                metrics.increment('dropped_frames', activity='presence')
+            clock.sleep(max(0, next_time - clock.monotonic()))
+            frame_start_time = clock.monotonic()
 
             # Update remote presence_maps
             if presence_sub.state:
-                remote_presences = list(presence_sub.state.values())
-                presence_state.update_remote_presences(remote_presences)
+                with metrics.stage('ingest', activity='presence'):
+                    remote_presences = list(presence_sub.state.values())
+                    presence_state.update_remote_presences(remote_presences)
 
             # Get local presence_map from webcam and send to server
             local_presence_map = presence_state.update_local_presence_map()
             if local_presence_map is not None and local_presence_map.sum() > 0.0 and (tick % frames_between_send == 0):
                 try:
-                    presence_sub.call('presence.sendPresence', [
-                        presence_sub.token,
-                        local_presence_map.tolist(),
-                    ])
+                    with metrics.stage('publish', activity='presence'):
+                        presence_sub.call('presence.sendPresence', [
+                            presence_sub.token,
+                            local_presence_map.tolist(),
+                        ])
                 except Exception as ex:
                     logging.warning(f'sendPresence failed: {ex}')
 
             # Animate a frame of animation
-            presence_state.tick_frame()
+            with metrics.stage('render', activity='presence'):
+                presence_state.tick_frame()
 
             try:
                 device.set_frame_array(presence_state.frame)
             except DeviceDisconnected:
                 logging.warning(f'Device disconnected')
-            logging.info(f'Frame render time: {monotonic() - frame_start_time}')
+            metrics.set_gauge('queue_depth', sum(
+                len(presence.presence_maps)
+                for presence in presence_state.remote_id_to_presence.values()
+            ), queue='presence_scheduled_maps')
+            metrics.set_gauge('container_size', len(presence_state.remote_id_to_presence),
+                              container='presence_remotes')
+            metrics.observe('frame', clock.monotonic() - frame_start_time, activity='presence')
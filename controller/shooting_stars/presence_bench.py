@@ -0,0 +1,138 @@
+from argparse import ArgumentParser
+import json
+from time import perf_counter
+
+import cv2 as cv
+import numpy as np
+
+from .presence import CAPTURE_SIZE, MotionPipeline
+from .utils import parse_size
+
+parser = ArgumentParser(prog='shooting_stars.presence_bench',
+                        description=('Compares the speed and output of the presence motion detection '
+                                     'pipeline against the original full-resolution pipeline'))
+parser.add_argument('--video', type=str,
+                    help='Video file to read frames from instead of the camera')
+parser.add_argument('--frames', type=int, default=200,
+                    help='Number of frames to compare')
+parser.add_argument('--map-size', dest='map_size', type=parse_size, default=(30, 30),
+                    help='WIDTHxHEIGHT of presence maps')
+parser.add_argument('--capture-size', dest='capture_size', type=parse_size, default=CAPTURE_SIZE,
+                    help='WIDTHxHEIGHT the camera would be asked for (frames are downscaled to this first)')
+parser.add_argument('--working-size', dest='working_size', type=parse_size,
+                    help='WIDTHxHEIGHT to detect motion at (defaults to the map size)')
+parser.add_argument('--json', action='store_true',
+                    help='Print the report as JSON')
+
+
+class LegacyMotionPipeline:
+    """The original presence pipeline, which blurs at 500x500 before
+    downscaling to the presence map size."""
+
+    def __init__(self, *, presence_map_size):
+        self.presence_map_size = tuple(presence_map_size)
+        self.last_image = None
+
+    def process(self, image):
+        image = cv.resize(image, (500, 500))
+        image = cv.GaussianBlur(image, (19, 19), 0)
+        image = cv.resize(image, self.presence_map_size)
+        image = cv.flip(image, -1)
+
+        presence_map = None
+        if self.last_image is not None:
+            image_delta = cv.absdiff(self.last_image, image)
+            image_delta = cv.cvtColor(image_delta, cv.COLOR_BGR2GRAY)
+            _, image_delta = cv.threshold(image_delta, 10, 255, cv.THRESH_BINARY)
+            image_delta = cv.dilate(image_delta, None, iterations=2)
+            image_delta = cv.GaussianBlur(image_delta, (21, 21), 0)
+            presence_map = image_delta
+
+        if self.last_image is None:
+            self.last_image = image
+        else:
+            self.last_image = cv.addWeighted(self.last_image, 0.5, image, 0.5, 0)
+
+        return presence_map
+
+
+def read_frames(*, video_path, frame_count):
+    """Read frames from a video file or the camera into memory, so that
+    both pipelines are timed without capture overhead."""
+    cap = cv.VideoCapture(video_path if video_path else -1)
+    if not cap.isOpened():
+        raise RuntimeError(f'Failed to open {video_path or "camera"}')
+    frames = []
+    try:
+        while len(frames) < frame_count:
+            ret, image = cap.read()
+            if not ret:
+                break
+            frames.append(image)
+    finally:
+        cap.release()
+    return frames
+
+
+def compare_maps(legacy_maps, maps):
+    """Return stats on how closely presence maps match the legacy
+    pipeline's maps."""
+    legacy_maps = np.array(legacy_maps, dtype=float)
+    maps = np.array(maps, dtype=float)
+    legacy_active = legacy_maps > 0
+    active = maps > 0
+    union = (legacy_active | active).sum()
+    return {
+        'mean_abs_diff': np.abs(legacy_maps - maps).mean(),
+        # Agreement on which parts of the map have any presence
+        'active_iou': ((legacy_active & active).sum() / union) if union > 0 else 1.0,
+        'legacy_active_fraction': legacy_active.mean(),
+        'active_fraction': active.mean(),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    frames = read_frames(video_path=args.video, frame_count=args.frames)
+    if len(frames) < 2:
+        raise RuntimeError('Need at least 2 frames to detect motion')
+    capture_frames = [
+        cv.resize(image, args.capture_size, interpolation=cv.INTER_AREA)
+        for image in frames
+    ]
+
+    legacy_pipeline = LegacyMotionPipeline(presence_map_size=args.map_size)
+    start_time = perf_counter()
+    legacy_maps = [legacy_pipeline.process(image) for image in frames]
+    legacy_seconds = perf_counter() - start_time
+
+    pipeline = MotionPipeline(presence_map_size=args.map_size, working_size=args.working_size)
+    start_time = perf_counter()
+    maps = [pipeline.process(image) for image in capture_frames]
+    seconds = perf_counter() - start_time
+
+    report = {
+        'frames': len(frames),
+        'source_size': f'{frames[0].shape[1]}x{frames[0].shape[0]}',
+        'legacy_ms_per_frame': legacy_seconds / len(frames) * 1000,
+        'ms_per_frame': seconds / len(frames) * 1000,
+        'speedup': legacy_seconds / seconds,
+        **{
+            f'{stage}_ms': stage_seconds * 1000
+            for stage, stage_seconds in pipeline.get_mean_stage_seconds().items()
+        },
+        # The first frame of each has no map
+        **compare_maps(legacy_maps[1:], maps[1:]),
+    }
+    report = {key: (value.item() if isinstance(value, np.generic) else value)
+              for key, value in report.items()}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from collections import Counter
+from datetime import datetime
+import math
+from pathlib import Path
+import os
+import signal
+import sys
+from threading import Thread, Lock, current_thread, enumerate as enumerate_threads
+from time import sleep, monotonic
+import logging
+from typing import Optional
+
+# Seconds between samples of every thread's stack.
+SAMPLE_INTERVAL_SECONDS = 0.005
+# Default number of seconds to profile for when triggered.
+DEFAULT_PROFILE_SECONDS = 10
+# Maximum number of seconds a profile can run for (longer requests are
+# shortened), as only one profile can run at a time.
+MAX_PROFILE_SECONDS = 120
+
+
+class ProfileRunning(Exception):
+    pass
+
+
+def get_frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """Profiles every thread of the running process by periodically
+    sampling their stacks, without needing to restart under a profiler.
+
+    Profiles are in collapsed-stack format: one line per distinct stack
+    with frames separated by semicolons (starting with the thread name)
+    followed by the number of samples, as read by flamegraph.pl,
+    speedscope and similar tools.
+    """
+
+    def __init__(self, *, output_dir, interval_seconds=SAMPLE_INTERVAL_SECONDS):
+        self.output_dir = Path(output_dir)
+        self.interval_seconds = interval_seconds
+        # Only one profile runs at a time
+        self.profile_lock = Lock()
+
+    def sample(self, stack_counts):
+        """Add the current stack of every other thread to stack_counts."""
+        thread_names = {thread.ident: thread.name for thread in enumerate_threads()}
+        own_ident = current_thread().ident
+        for thread_ident, frame in sys._current_frames().items():
+            if thread_ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(get_frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread_names.get(thread_ident, f'thread-{thread_ident}'))
+            stack_counts[';'.join(reversed(labels))] += 1
+
+    def profile(self, seconds) -> str:
+        """Sample all threads for a number of seconds (at most
+        MAX_PROFILE_SECONDS), returning the profile in collapsed-stack
+        format. Raises ProfileRunning if a profile is already running."""
+        if not math.isfinite(seconds) or seconds < 0:
+            raise ValueError(f'Invalid number of seconds to profile for: {seconds}')
+        if seconds > MAX_PROFILE_SECONDS:
+            logging.warning(f'Limiting profile to {MAX_PROFILE_SECONDS} seconds')
+            seconds = MAX_PROFILE_SECONDS
+        if not self.profile_lock.acquire(blocking=False):
+            raise ProfileRunning()
+        try:
+            stack_counts = Counter()
+            end_time = monotonic() + seconds
+            next_time = monotonic()
+            while monotonic() < end_time:
+                self.sample(stack_counts)
+                next_time = max(next_time + self.interval_seconds, monotonic())
+                sleep(max(0, next_time - monotonic()))
+        finally:
+            self.profile_lock.release()
+        return ''.join(
+            f'{stack} {count}\n'
+            for stack, count in stack_counts.most_common()
+        )
+
+    def profile_to_file(self, seconds) -> Optional[Path]:
+        """Profile for a number of seconds, saving the result to a new file
+        in output_dir (unless a profile is already running)."""
+        logging.warning(f'Profiling for {seconds} seconds')
+        try:
+            folded = self.profile(seconds)
+        except ProfileRunning:
+            logging.warning('Profile already running')
+            return None
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = self.output_dir / f'shooting_stars-{os.getpid()}-{timestamp}.folded'
+        path.write_text(folded)
+        logging.warning(f'Saved profile to {path}')
+        return path
+
+    def start_profile(self, seconds=DEFAULT_PROFILE_SECONDS):
+        """Profile to a file in a new thread, ignoring the request if a
+        profile is already running."""
+        if self.profile_lock.locked():
+            logging.warning('Profile already running')
+            return
+        profile_thread = Thread(target=self.profile_to_file, args=(seconds,), name='profiler', daemon=True)
+        profile_thread.start()
+
+    def install_signal_handler(self, *, seconds=DEFAULT_PROFILE_SECONDS, signum=signal.SIGUSR1):
+        """Start a profile whenever the process receives signum (e.g. with
+        `kill -USR1 <pid>`)."""
+        signal.signal(signum, lambda _signum, _frame: self.start_profile(seconds))
+        logging.info(f'Send signal {signal.Signals(signum).name} to process {os.getpid()} '
+                     f'to profile for {seconds} seconds')
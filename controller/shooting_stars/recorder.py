@@ -0,0 +1,222 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import json
+import logging
+import mmap
+import os
+import struct
+from threading import Lock
+from typing import Iterator, Optional
+
+import numpy as np
+
+from .clock import REAL_CLOCK
+from .device import FRAME_DTYPE
+
+# Identifies recording files (and the version of their layout).
+RECORDING_MAGIC = b'SSREC001'
+# Each record starts with its kind, payload length and the seconds
+# since the recording started.
+RECORD_HEADER = struct.Struct('<BxxxId')
+# Message payloads start with the length of the subscription name.
+MESSAGE_HEADER = struct.Struct('<H')
+# Frame payloads start with the frame's shape.
+FRAME_HEADER = struct.Struct('<II')
+# Records are padded to a multiple of this many bytes, so that every
+# header is aligned when the file is memory-mapped.
+RECORD_ALIGNMENT = 8
+# Seconds between flushes of the recording file to disk.
+FLUSH_INTERVAL_SECONDS = 1
+
+# Record kinds
+RECEIVED_MESSAGE = 1
+SENT_MESSAGE = 2
+FRAME = 3
+METADATA = 4
+# Written at the start of each recording session, as a restarted
+# controller appends to the same file with a new timeline.
+SESSION = 5
+RECORD_KINDS = {RECEIVED_MESSAGE, SENT_MESSAGE, FRAME, METADATA, SESSION}
+
+
+@dataclass
+class Record:
+    kind: int
+    seconds: float
+    # Index of the session the record belongs to (seconds are relative
+    # to the start of the session)
+    session: int = 0
+    # Subscription name (for messages) or metadata key
+    name: Optional[str] = None
+    # Raw JSON text of a message or metadata value
+    text: Optional[str] = None
+    # Read-only view of the recording for frames
+    frame: Optional[np.ndarray] = None
+
+
+class Recorder:
+    """Appends timestamped subscription messages (in both directions) and
+    device frames to a recording file, for replaying with
+    shooting_stars.replay.
+
+    Each record is a fixed-size header followed by a length-prefixed
+    payload, padded to RECORD_ALIGNMENT. Frames are stored as raw
+    FRAME_DTYPE bytes, so that read_records() can return them as views
+    of a memory-mapped file without copying.
+
+    Records are written from multiple threads (subscriptions, the
+    activity loop and the device), so writes are serialised with a
+    lock.
+
+    An existing recording is appended to as a new session, after
+    dropping any record left partly written by a previous session that
+    didn't exit cleanly.
+    """
+
+    def __init__(self, *, path, clock=REAL_CLOCK):
+        self.path = path
+        self.clock = clock
+        self.start_time = clock.monotonic()
+        self.lock = Lock()
+        end_offset = get_recording_end(path)
+        self.file = open(path, 'r+b' if end_offset else 'wb')
+        if end_offset:
+            self.file.seek(end_offset)
+            self.file.truncate()
+        else:
+            self.file.write(RECORDING_MAGIC)
+        self.next_flush_time = self.start_time + FLUSH_INTERVAL_SECONDS
+        self.write_named_text(SESSION, 'session', json.dumps({
+            'started': datetime.now(timezone.utc).isoformat(),
+        }))
+        logging.info(f'Recording to: {path}')
+
+    def write_record(self, kind, *payload_parts):
+        payload_length = sum(memoryview(part).nbytes for part in payload_parts)
+        padding = -(RECORD_HEADER.size + payload_length) % RECORD_ALIGNMENT
+        now = self.clock.monotonic()
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD_HEADER.pack(kind, payload_length, now - self.start_time))
+            for part in payload_parts:
+                self.file.write(part)
+            self.file.write(b'\0' * padding)
+            if now >= self.next_flush_time:
+                self.file.flush()
+                self.next_flush_time = now + FLUSH_INTERVAL_SECONDS
+
+    def write_named_text(self, kind, name, text):
+        name_bytes = name.encode()
+        self.write_record(kind, MESSAGE_HEADER.pack(len(name_bytes)), name_bytes, text.encode())
+
+    def record_received(self, subscription_name, message):
+        """Record a raw message received by a subscription."""
+        self.write_named_text(RECEIVED_MESSAGE, subscription_name, message)
+
+    def record_sent(self, subscription_name, data):
+        """Record a message sent by a subscription."""
+        self.write_named_text(SENT_MESSAGE, subscription_name, json.dumps(data))
+
+    def record_frame(self, array: np.ndarray):
+        """Record a frame sent to the device."""
+        self.write_record(FRAME, FRAME_HEADER.pack(*array.shape), np.ascontiguousarray(array).data)
+
+    def record_metadata(self, key, value):
+        """Record something needed to replay the recording, such as the
+        activity or device layout."""
+        self.write_named_text(METADATA, key, json.dumps(value))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def scan_records(buffer, path, *, strict=True) -> Iterator[tuple[int, int, int, float]]:
+    """Yield the (offset, kind, payload length, seconds) of every complete
+    record in a memory-mapped recording, stopping at any partly written
+    record at the end. A record of an unknown kind means the recording
+    is corrupt, so raises a ValueError if strict (or otherwise stops
+    there)."""
+    offset = len(RECORDING_MAGIC)
+    while offset + RECORD_HEADER.size <= len(buffer):
+        kind, payload_length, seconds = RECORD_HEADER.unpack_from(buffer, offset)
+        if kind not in RECORD_KINDS:
+            if strict:
+                raise ValueError(f'Unknown record kind {kind} at byte {offset} of {path}')
+            logging.warning(f'Ignoring unknown record kind {kind} at byte {offset} of {path}')
+            break
+        payload_offset = offset + RECORD_HEADER.size
+        if payload_offset + payload_length > len(buffer):
+            logging.warning(f'Ignoring truncated record at byte {offset} of {path}')
+            break
+        yield offset, kind, payload_length, seconds
+        offset = payload_offset + payload_length
+        offset += -(RECORD_HEADER.size + payload_length) % RECORD_ALIGNMENT
+
+
+def open_recording(path) -> Optional[mmap.mmap]:
+    """Memory-map a recording, or return None if it has no records."""
+    with open(path, 'rb') as recording_file:
+        if recording_file.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f'Not a recording: {path}')
+        recording_file.seek(0, 2)
+        if recording_file.tell() == len(RECORDING_MAGIC):
+            return None
+        return mmap.mmap(recording_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def get_recording_end(path) -> int:
+    """Return the offset just after the last complete record of an
+    existing recording (or 0 if there is no recording to append to)."""
+    if not os.path.exists(path):
+        return 0
+    if os.path.getsize(path) < len(RECORDING_MAGIC):
+        # Only start again if the file is a recording that was cut off
+        # while writing the magic
+        with open(path, 'rb') as recording_file:
+            if not RECORDING_MAGIC.startswith(recording_file.read()):
+                raise ValueError(f'Not a recording: {path}')
+        return 0
+    buffer = open_recording(path)
+    if buffer is None:
+        return len(RECORDING_MAGIC)
+    end_offset = len(RECORDING_MAGIC)
+    with buffer:
+        for offset, kind, payload_length, _ in scan_records(buffer, path, strict=False):
+            end_offset = offset + RECORD_HEADER.size + payload_length
+            end_offset += -end_offset % RECORD_ALIGNMENT
+    return end_offset
+
+
+def read_records(path) -> Iterator[Record]:
+    """Yield every complete record in a recording (ignoring any partly
+    written record at the end). Frames are views of the memory-mapped
+    file, so they are only valid while the iterator is referenced."""
+    buffer = open_recording(path)
+    if buffer is None:
+        return
+
+    # Recordings made before sessions were recorded are one session
+    session = -1
+    for offset, kind, payload_length, seconds in scan_records(buffer, path):
+        payload_offset = offset + RECORD_HEADER.size
+        if kind == SESSION:
+            session += 1
+        if kind == FRAME:
+            light_count, component_count = FRAME_HEADER.unpack_from(buffer, payload_offset)
+            frame = np.frombuffer(buffer, dtype=FRAME_DTYPE, count=(light_count * component_count),
+                                  offset=(payload_offset + FRAME_HEADER.size))
+            yield Record(kind=kind, seconds=seconds, session=max(session, 0),
+                         frame=frame.reshape(light_count, component_count))
+        else:
+            (name_length,) = MESSAGE_HEADER.unpack_from(buffer, payload_offset)
+            name_offset = payload_offset + MESSAGE_HEADER.size
+            text_offset = name_offset + name_length
+            yield Record(
+                kind=kind,
+                seconds=seconds,
+                session=max(session, 0),
+                name=buffer[name_offset:text_offset].decode(),
+                text=buffer[text_offset:(payload_offset + payload_length)].decode(),
+            )
@@ -0,0 +1,191 @@
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+import json
+import logging
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from .blocks import AI_SEARCH_DEPTH
+from .clock import SimulatedClock
+from .device import CaptureDevice
+from .recorder import FRAME, METADATA, RECEIVED_MESSAGE, SENT_MESSAGE, SESSION, read_records
+from .simulate import ACTIVITIES, LAYOUT_PATH, run_simulation
+
+# Simulated seconds to keep running after the last recorded record.
+REPLAY_TAIL_SECONDS = 1
+
+parser = ArgumentParser(prog='shooting_stars.replay',
+                        description=('Replays the subscription messages in a recording made with --record '
+                                     'through an activity, and compares the frames it produces with the '
+                                     'recorded frames'))
+parser.add_argument('recording', type=str)
+parser.add_argument('--session', type=int, default=-1,
+                    help=('Session of the recording to replay, counting from 0 (a restarted controller '
+                          'appends a new session), or negative to count from the last session'))
+parser.add_argument('--speed', type=str, default='max',
+                    help='Multiple of real time to replay at (e.g. 1), or "max" to replay as fast as possible')
+parser.add_argument('--activity', choices=ACTIVITIES,
+                    help='Activity to replay through (defaults to the recorded activity)')
+parser.add_argument('--layout', type=str,
+                    help='Twinkly layout JSON to use if the recording has no layout')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for all randomness in the activity')
+parser.add_argument('--blocks-search-depth', dest='blocks_search_depth', default=AI_SEARCH_DEPTH, type=int,
+                    help='Number of upcoming pieces the blocks AI plans for')
+parser.add_argument('--max-mismatch-fraction', dest='max_mismatch_fraction', type=float,
+                    help='Exit with an error if more than this fraction of recorded frames differ')
+parser.add_argument('--json', action='store_true',
+                    help='Print the report as JSON')
+parser.add_argument('--log-level', dest='log_level', default='warning', type=str)
+
+
+def get_session_count(path):
+    return 1 + max((record.session for record in read_records(path) if record.kind == SESSION), default=0)
+
+
+def load_replay(path, session=-1):
+    """Return the metadata, received messages of each subscription,
+    method results, and (seconds, frame) list of a session of a
+    recording (each session has its own timeline)."""
+    session_count = get_session_count(path)
+    if session < 0:
+        session += session_count
+    if not 0 <= session < session_count:
+        raise ValueError(f'The recording only has {session_count} sessions')
+    metadata = {}
+    subscription_to_messages = {}
+    call_id_to_method = {}
+    method_to_result = {}
+    recorded_frames = []
+    end_seconds = 0
+    for record in read_records(path):
+        if record.session != session:
+            continue
+        end_seconds = max(end_seconds, record.seconds)
+        if record.kind == FRAME:
+            recorded_frames.append((record.seconds, record.frame))
+        elif record.kind == METADATA:
+            metadata[record.name] = json.loads(record.text)
+        elif record.kind == SENT_MESSAGE:
+            data = json.loads(record.text)
+            if data.get('msg') == 'method':
+                call_id_to_method[(record.name, data['id'])] = data['method']
+        elif record.kind == RECEIVED_MESSAGE:
+            data = json.loads(record.text)
+            if data.get('msg') == 'result':
+                # Replayed calls complete immediately with the first
+                # recorded result for their method
+                method = call_id_to_method.get((record.name, data['id']))
+                if method is not None and method not in method_to_result:
+                    method_to_result[method] = data.get('result')
+                continue
+            subscription_to_messages.setdefault(record.name, []).append((record.seconds, data))
+    return metadata, subscription_to_messages, method_to_result, recorded_frames, end_seconds
+
+
+def compare_recorded_frames(recorded_frames, frame_seconds, frames):
+    """Compare each recorded frame with the latest replayed frame produced
+    at or before the same time, returning a report of the
+    differences.
+
+    Frames produced at the same time (such as when catching up on
+    dropped frames) are paired up in order.
+    """
+    compared_count = 0
+    mismatch_count = 0
+    abs_diff_sum = 0.0
+    max_abs_diff = 0
+    first_mismatch_seconds = None
+    last_seconds = None
+    same_seconds_count = 0
+    for seconds, recorded_frame in recorded_frames:
+        same_seconds_count = (same_seconds_count + 1) if seconds == last_seconds else 0
+        last_seconds = seconds
+        end_idx = bisect_right(frame_seconds, seconds)
+        frame_idx = min(bisect_left(frame_seconds, seconds) + same_seconds_count, end_idx - 1)
+        if frame_idx < 0:
+            continue
+        frame = frames[frame_idx]
+        compared_count += 1
+        if frame.shape != recorded_frame.shape:
+            abs_diff = np.full(recorded_frame.shape, 255)
+        else:
+            abs_diff = np.abs(frame.astype(int) - recorded_frame)
+        abs_diff_sum += abs_diff.mean()
+        max_abs_diff = max(max_abs_diff, int(abs_diff.max()))
+        if abs_diff.any():
+            mismatch_count += 1
+            if first_mismatch_seconds is None:
+                first_mismatch_seconds = seconds
+    return {
+        'recorded_frames': len(recorded_frames),
+        'replayed_frames': len(frames),
+        'compared_frames': compared_count,
+        'mismatched_frames': mismatch_count,
+        'mismatch_fraction': (mismatch_count / compared_count) if compared_count else 0.0,
+        'mean_abs_diff': (abs_diff_sum / compared_count) if compared_count else 0.0,
+        'max_abs_diff': max_abs_diff,
+        'first_mismatch_seconds': first_mismatch_seconds,
+    }
+
+
+def main():
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+    )
+
+    metadata, subscription_to_messages, method_to_result, recorded_frames, end_seconds = load_replay(
+        args.recording, session=args.session)
+    activity_name = args.activity or metadata.get('activity')
+    if activity_name is None:
+        raise ValueError('The recording has no activity, so --activity is required')
+    layout = metadata.get('layout')
+    if layout is None:
+        with open(args.layout or LAYOUT_PATH) as layout_file:
+            layout = json.load(layout_file)
+
+    clock = SimulatedClock(
+        end_seconds=(end_seconds + REPLAY_TAIL_SECONDS),
+        speed=(None if args.speed == 'max' else float(args.speed)),
+    )
+    device = CaptureDevice(layout=layout, keep_frames=True, clock=clock)
+
+    start_time = perf_counter()
+    run_simulation(
+        activity_name=activity_name,
+        clock=clock,
+        device=device,
+        rng=np.random.RandomState(args.seed),
+        subscription_to_messages=subscription_to_messages,
+        method_to_result=method_to_result,
+        # Recordings include the 'connected' messages
+        connect=False,
+        blocks_search_depth=args.blocks_search_depth,
+    )
+    wall_seconds = perf_counter() - start_time
+
+    report = {
+        'activity': activity_name,
+        'replayed_messages': sum(len(messages) for messages in subscription_to_messages.values()),
+        'recorded_seconds': end_seconds,
+        'wall_seconds': wall_seconds,
+        'speedup': clock.monotonic() / wall_seconds,
+        **compare_recorded_frames(recorded_frames, device.frame_seconds, device.frames),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+
+    if args.max_mismatch_fraction is not None and report['mismatch_fraction'] > args.max_mismatch_fraction:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from argparse import ArgumentParser
+import logging
+
+from .clock import REAL_CLOCK
+from .device import Device, DeviceDisconnected
+from .framebus import (
+    DEFAULT_MAX_LIGHT_COUNT, DEFAULT_SLOT_COUNT, FrameBus, get_bus_name,
+)
+from .metrics import metrics
+
+# Default number of times a second to check for (and send) new frames.
+DEFAULT_SEND_FRAMES_PER_SECOND = 40
+# Seconds after which the latest frame is sent again if the renderer
+# hasn't written a new one, so the device stays in realtime mode.
+REPEAT_FRAME_SECONDS = 1
+
+parser = ArgumentParser(prog='shooting_stars.sender',
+                        description=('Creates a shared-memory frame bus for each device, and sends the latest '
+                                     'frame renderers (run with --frame-bus) write to it to the device'))
+parser.add_argument('twinkly_device_id', type=str, nargs='+',
+                    help='Devices to send frames to')
+parser.add_argument('--fps', type=float, default=DEFAULT_SEND_FRAMES_PER_SECOND,
+                    help='Number of times a second to check for new frames to send')
+parser.add_argument('--max-lights', dest='max_lights', type=int, default=DEFAULT_MAX_LIGHT_COUNT,
+                    help='Maximum number of lights in a frame')
+parser.add_argument('--slots', type=int, default=DEFAULT_SLOT_COUNT,
+                    help='Number of frames in each frame bus')
+parser.add_argument('--log-level', dest='log_level', default='info', type=str)
+parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                    help='Serve frame latency and counters in Prometheus format on http://127.0.0.1:PORT/metrics')
+
+
+class BusSender:
+    """Sends the frames written to a frame bus to its device, sharing the
+    device's layout and connection status with the renderer."""
+
+    def __init__(self, *, bus, device):
+        self.bus = bus
+        self.device = device
+        self.has_layout = False
+        self.last_sequence = 0
+        self.last_send_time = None
+        # Reused for every frame read from the bus
+        self.frame = None
+
+    def tick(self, now):
+        if not self.device.connected:
+            # The device may have a different layout when it reconnects
+            self.has_layout = False
+        elif not self.has_layout:
+            try:
+                self.bus.set_layout(self.device.get_layout())
+                self.has_layout = True
+            except:
+                logging.exception(f'Failed to share layout of {self.device.device_id}')
+        # The renderer only sees the device as connected once it can get
+        # the layout
+        self.bus.set_status(devices_connected=(self.device.connected and self.has_layout))
+
+        latest = self.bus.read_latest(out=self.frame)
+        if latest is None:
+            return
+        sequence, seconds, self.frame = latest
+        is_new = sequence != self.last_sequence
+        if not is_new and (now - self.last_send_time) < REPEAT_FRAME_SECONDS:
+            return
+        if is_new and self.last_sequence and sequence > (self.last_sequence + 1):
+            metrics.increment('skipped_frames', device=self.device.device_id,
+                              amount=(sequence - self.last_sequence - 1))
+        self.last_sequence = sequence
+        self.last_send_time = now
+        if not self.device.connected:
+            return
+        try:
+            self.device.set_frame_array(self.frame)
+            if is_new:
+                # Time from the renderer writing the frame to sending it
+                metrics.observe('bus_latency', now - seconds, device=self.device.device_id)
+        except DeviceDisconnected:
+            logging.info('Device disconnected')
+
+
+def run_sender(*, bus_senders, frames_per_second, clock=REAL_CLOCK):
+    """Send frames from every bus in a continuous loop, at a steady pace
+    regardless of when renderers write frames."""
+    frame_delay_seconds = 1 / frames_per_second
+    next_time = clock.monotonic()
+    while True:
+        next_time = next_time + frame_delay_seconds
+        if (clock.monotonic() - next_time) > frame_delay_seconds:
+            metrics.increment('dropped_frames', activity='sender')
+            next_time = clock.monotonic()
+        clock.sleep(max(0, next_time - clock.monotonic()))
+        now = clock.monotonic()
+        for bus_sender in bus_senders:
+            bus_sender.tick(now)
+
+
+def main():
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+    )
+
+    if args.metrics_port is not None:
+        metrics.start_server(args.metrics_port)
+
+    bus_senders = []
+    try:
+        for device_id in args.twinkly_device_id:
+            bus = FrameBus.create(get_bus_name(device_id), slot_count=args.slots, max_light_count=args.max_lights)
+            logging.info(f'Created frame bus: {bus.name}')
+            device = Device(device_id=device_id)
+            device.start_monitor()
+            bus_senders.append(BusSender(bus=bus, device=device))
+        run_sender(bus_senders=bus_senders, frames_per_second=args.fps)
+    finally:
+        # Clean up threads and shared memory
+        for bus_sender in bus_senders:
+            bus_sender.device.stop_monitor()
+            bus_sender.bus.close()
+
+
+if __name__ == '__main__':
+    main()
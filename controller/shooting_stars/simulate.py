@@ -0,0 +1,271 @@
+from argparse import ArgumentParser
+import json
+import logging
+from pathlib import Path
+import sys
+from time import perf_counter
+
+import cv2 as cv
+import numpy as np
+
+from .animation import AnimationState, run_animation
+from .blocks import AI_SEARCH_DEPTH, BlocksTrainer, run_blocks
+from .clock import SimulatedClock, SimulationFinished
+from .cone import run_cone
+from .device import CaptureDevice
+from .presence import MotionPipeline, run_presence
+from .subscription import Subscription
+
+ACTIVITIES = ['lights', 'blocks', 'cone', 'presence']
+LAYOUT_PATH = Path(__file__).resolve().parents[2] / 'assets' / 'cone-layout-backup.json'
+# Default number of simulated seconds to run for.
+DEFAULT_SIMULATED_SECONDS = 60
+
+parser = ArgumentParser(prog='shooting_stars.simulate',
+                        description=('Runs an activity against recorded subscription messages on a simulated '
+                                     'clock, as fast as frames can be computed and with the same frames on '
+                                     'every run'))
+parser.add_argument('activity', choices=ACTIVITIES)
+parser.add_argument('--recording', type=str,
+                    help=('JSON lines file of {"seconds", "subscription", "message"} DDP messages to deliver, '
+                          'and {"call", "result"} results to return from method calls'))
+parser.add_argument('--seconds', type=float, default=DEFAULT_SIMULATED_SECONDS,
+                    help='Number of simulated seconds to run for')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for all randomness in the activity')
+parser.add_argument('--layout', type=str, default=str(LAYOUT_PATH),
+                    help='Twinkly layout JSON for the cone and presence activities')
+parser.add_argument('--presence-video', dest='presence_video', type=str,
+                    help='Video file to detect local presence from, one video frame per activity frame '
+                         '(defaults to no local presence)')
+parser.add_argument('--blocks-search-depth', dest='blocks_search_depth', default=AI_SEARCH_DEPTH, type=int,
+                    help='Number of upcoming pieces the blocks AI plans for')
+parser.add_argument('--save-frames', dest='save_frames', type=str,
+                    help='Save every frame sent to the device to this .npy file')
+parser.add_argument('--golden', type=str,
+                    help='Compare frames against a .npy file saved with --save-frames, exiting with an error '
+                         'if they differ')
+parser.add_argument('--log-level', dest='log_level', default='warning', type=str)
+
+
+def load_recording(path):
+    """Return the recorded messages of each subscription as (seconds,
+    message) lists, and the result to return for each method."""
+    subscription_to_messages = {}
+    method_to_result = {}
+    if path is None:
+        return subscription_to_messages, method_to_result
+    with open(path) as recording_file:
+        for line in recording_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'call' in record:
+                method_to_result[record['call']] = record.get('result')
+            else:
+                subscription_to_messages.setdefault(record['subscription'], []).append(
+                    (record['seconds'], record['message']))
+    return subscription_to_messages, method_to_result
+
+
+class SimulatedSubscription(Subscription):
+    """A Subscription that receives recorded messages at their recorded
+    (simulated) times instead of connecting to a server. Sent messages
+    are kept in sent, and method calls complete immediately with the
+    recorded result for the method (or None)."""
+
+    def __init__(self, *, clock, name, messages=(), method_to_result=None, sub_param_list=None,
+                 connect=True):
+        super().__init__(url=None, name=name, token='simulated', sub_param_list=sub_param_list)
+        self.clock = clock
+        self.messages = messages
+        self.method_to_result = method_to_result or {}
+        # Whether to receive a 'connected' message on start (recordings
+        # of live traffic already include one)
+        self.connect = connect
+        self.sent = []
+
+    def start(self):
+        self.stopped = False
+        if self.connect:
+            self.clock.call_at(self.clock.monotonic(), lambda: self.receive({'msg': 'connected'}))
+        for seconds, message in self.messages:
+            self.clock.call_at(seconds, (lambda message=message: self.receive(message)))
+
+    def stop(self):
+        self.stopped = True
+
+    def receive(self, message):
+        self.on_message(None, json.dumps(message))
+
+    def send(self, ws, data):
+        self.sent.append(data)
+
+    def call(self, method, params):
+        promise = super().call(method, params)
+        self.receive({
+            'msg': 'result',
+            'id': self.sent[-1]['id'],
+            'result': self.method_to_result.get(method),
+        })
+        return promise
+
+
+class SimulatedCapture:
+    """Stands in for PresenceCapture, detecting presence from the next
+    frame of a video each time a presence map is requested (or always
+    returning an empty map without a video)."""
+
+    def __init__(self, *, presence_map_size, video_path=None):
+        self.presence_map = np.zeros(presence_map_size)
+        self.pipeline = MotionPipeline(presence_map_size=presence_map_size)
+        self.cap = None
+        if video_path is not None:
+            self.cap = cv.VideoCapture(video_path)
+            if not self.cap.isOpened():
+                raise RuntimeError(f'Failed to open {video_path}')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if self.cap is not None:
+            self.cap.release()
+
+    def get_presence_map(self):
+        if self.cap is None:
+            return self.presence_map
+        ret, image = self.cap.read()
+        if not ret:
+            return self.presence_map
+        presence_map = self.pipeline.process(image)
+        if presence_map is not None:
+            self.presence_map = presence_map
+        return self.presence_map
+
+
+def run_simulation(*, activity_name, clock, device, rng, subscription_to_messages, method_to_result,
+                   connect=True, blocks_search_depth=AI_SEARCH_DEPTH, presence_video=None):
+    """Run the activity until the clock reaches the end of the
+    simulation, returning the subscriptions it used."""
+
+    def get_subscription(name, **kwargs):
+        subscription = SimulatedSubscription(
+            clock=clock,
+            name=name,
+            messages=subscription_to_messages.get(name, []),
+            method_to_result=method_to_result,
+            connect=connect,
+            **kwargs,
+        )
+        subscription.start()
+        return subscription
+
+    if activity_name == 'lights':
+        subscriptions = [get_subscription('lights')]
+        activity = lambda: run_animation(
+            device=device,
+            lights=subscriptions[0].state,
+            animation_state=AnimationState(rng=rng),
+            clock=clock,
+        )
+    elif activity_name == 'blocks':
+        subscriptions = [get_subscription('blocksInputs'), get_subscription('pictures')]
+        trainer = BlocksTrainer(search_depth=blocks_search_depth, clock=clock, rng=rng)
+        # The trainer catches up whenever the activity waits, rather
+        # than racing it in a thread
+        clock.add_background_task(trainer.drain)
+        activity = lambda: run_blocks(
+            device=device,
+            inputs_sub=subscriptions[0],
+            pictures_sub=subscriptions[1],
+            trainer=trainer,
+            clock=clock,
+            rng=rng,
+        )
+    elif activity_name == 'cone':
+        subscriptions = [get_subscription('paint')]
+        activity = lambda: run_cone(device=device, paint_sub=subscriptions[0], clock=clock)
+    elif activity_name == 'presence':
+        local_config = method_to_result.get('presence.getConfig')
+        if local_config is None:
+            raise ValueError('The recording needs a result for presence.getConfig')
+        subscriptions = [get_subscription('presence', sub_param_list=['simulated'])]
+        capture = SimulatedCapture(presence_map_size=tuple(local_config['presenceMapSize']),
+                                   video_path=presence_video)
+        activity = lambda: run_presence(
+            device=device,
+            presence_sub=subscriptions[0],
+            clock=clock,
+            rng=rng,
+            capture=capture,
+        )
+    else:
+        raise ValueError(f'Unrecognised activity: {activity_name}')
+
+    try:
+        activity()
+    except SimulationFinished:
+        pass
+    return subscriptions
+
+
+def compare_frames(frames, golden_frames):
+    """Return a description of the first difference between frames and
+    golden_frames, or None if they match."""
+    if frames.shape != golden_frames.shape:
+        return f'Expected frames of shape {golden_frames.shape}, but got {frames.shape}'
+    mismatched_indexes = np.flatnonzero((frames != golden_frames).reshape(len(frames), -1).any(axis=1))
+    if len(mismatched_indexes) > 0:
+        return f'{len(mismatched_indexes)} frames differ, starting at frame {mismatched_indexes[0]}'
+    return None
+
+
+def main():
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+    )
+
+    with open(args.layout) as layout_file:
+        layout = json.load(layout_file)
+    clock = SimulatedClock(end_seconds=args.seconds)
+    device = CaptureDevice(layout=layout, keep_frames=True)
+    rng = np.random.RandomState(args.seed)
+    subscription_to_messages, method_to_result = load_recording(args.recording)
+
+    start_time = perf_counter()
+    subscriptions = run_simulation(
+        activity_name=args.activity,
+        clock=clock,
+        device=device,
+        rng=rng,
+        subscription_to_messages=subscription_to_messages,
+        method_to_result=method_to_result,
+        blocks_search_depth=args.blocks_search_depth,
+        presence_video=args.presence_video,
+    )
+    wall_seconds = perf_counter() - start_time
+
+    frames = np.array(device.frames)
+    print(f'frames: {len(frames)}')
+    print(f'simulated_seconds: {clock.monotonic():.3f}')
+    print(f'wall_seconds: {wall_seconds:.3f}')
+    print(f'speedup: {clock.monotonic() / wall_seconds:.1f}x')
+    for subscription in subscriptions:
+        print(f'{subscription.name}_sent_messages: {len(subscription.sent)}')
+
+    if args.save_frames:
+        np.save(args.save_frames, frames)
+
+    if args.golden:
+        difference = compare_frames(frames, np.load(args.golden))
+        if difference is not None:
+            print(difference, file=sys.stderr)
+            sys.exit(1)
+        print('Frames match golden frames')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,17 @@ import websocket
 import json
 import logging
 from time import monotonic, sleep
-from threading import Thread
+from threading import Thread, Event, Lock
+
+from .metrics import metrics
 
 # Useful for debugging:
 # websocket.enableTrace(True)
 
 IMMEDIATE_FAILURE_SECONDS = 10
+# Maximum number of method calls to wait for results of, beyond which
+# the oldest calls are given up on.
+MAX_CALL_PROMISES = 100
 
 
 def del_if_exists(dictionary, key):
@@ -47,38 +52,83 @@ class Promise:
         return self.result
 
 
-class Subscription:
-    """Subscribe to lights data via Meteor's DDP protocol:
-    https://github.com/meteor/meteor/blob/devel/packages/ddp/DDP.md
-    and based on https://github.com/hharnisc/python-ddp/blob/master/DDPClient.py
+class Connection:
+    """A websocket connection to a Meteor server that any number of
+    Subscriptions can share. Reconnects with exponential backoff, and
+    passes every message to each of its subscriptions.
+
+    The server only sends each document once per connection (however
+    many subscriptions include it), so the connection keeps its own copy
+    of the documents in each collection, which subscriptions added later
+    (e.g. an activity restarted after a crash) start from.
     """
 
-    def __init__(self, *, url, name, token, sub_param_list=None):
+    def __init__(self, *, url, name='connection'):
         self.url = url
         self.name = name
-        self.ready = False
-        self.state = {}
+        self.subscriptions = []
+        # Guards subscriptions, started and connected
+        self.subscriptions_lock = Lock()
+        self.started = False
+        # Whether the server has accepted the current connection, so
+        # new subscriptions can subscribe straight away
+        self.connected = False
         self.stopped = True
         self.ws = None
+        # Collection name -> document id -> fields
+        self.collection_to_documents = {}
+        # Held while documents are updated and passed to subscriptions,
+        # so that a new subscription starts from a consistent copy of
+        # them
+        self.documents_lock = Lock()
         self._uniq_id = 0
-        self.connection_attempts = 0
-        self.token = token
-        self.sub_param_list = sub_param_list
-        self.call_promises = {}
+        # Ids are requested by subscriptions on different threads
+        self.id_lock = Lock()
 
-    def _next_id(self):
+    def next_id(self):
         """Get the next id that will be sent to the server"""
-        self._uniq_id += 1
-        return str(self._uniq_id)
+        with self.id_lock:
+            self._uniq_id += 1
+            return str(self._uniq_id)
+
+    def add_subscription(self, subscription):
+        """Start passing messages to a subscription, subscribing it
+        immediately if already connected (otherwise it subscribes when
+        the connection is accepted)."""
+        with self.documents_lock:
+            # Pass on the documents the server has already sent for the
+            # subscription's collection, as it won't send them again
+            for document_id, fields in self.collection_to_documents.get(subscription.name, {}).items():
+                data = {'msg': 'added', 'collection': subscription.name, 'id': document_id, 'fields': dict(fields)}
+                subscription.handle_message(self.ws, json.dumps(data), data)
+            with self.subscriptions_lock:
+                # Replaced rather than appended to, so that the websocket
+                # thread can iterate over subscriptions without the lock
+                self.subscriptions = [*self.subscriptions, subscription]
+                connected = self.connected
+        if connected:
+            subscription.subscribe(self.ws)
+
+    def remove_subscription(self, subscription):
+        with self.subscriptions_lock:
+            self.subscriptions = [sub for sub in self.subscriptions if sub is not subscription]
+            connected = self.connected
+        if connected:
+            subscription.unsubscribe(self.ws)
 
     def start(self):
-        """Run the subscription in a new thread"""
-        sub_thread = Thread(target=self.run)
-        sub_thread.start()
-        return datetime.now()
+        """Run the connection in a new thread (if it isn't already
+        running)"""
+        with self.subscriptions_lock:
+            if self.started:
+                return
+            self.started = True
+        self.stopped = False
+        connection_thread = Thread(target=self.run, name=f'subscription-{self.name}')
+        connection_thread.start()
 
     def stop(self):
-        """Can be called to stop the subscription."""
+        """Can be called to stop the connection."""
         self.stopped = True
         if self.ws:
             self.ws.close()
@@ -86,7 +136,6 @@ class Subscription:
     def run(self):
         """Run the websocket listener, restarting with exponential backoff if
         the websocket closes."""
-        self.stopped = False
         retry_delay_seconds = 1
         while True:
             attempt_start = monotonic()
@@ -114,44 +163,202 @@ class Subscription:
                 retry_delay_seconds = 1
 
             logging.warning('Restarting websocket')
-
-    def send(self, ws, data):
-        ws.send(json.dumps(data))
+            metrics.increment('reconnects', source='subscription', subscription=self.name)
 
     def on_open(self, ws):
         """Send initial message to connect to Meteor."""
-        self.send(ws, {
+        with self.subscriptions_lock:
+            self.connected = False
+        for subscription in self.subscriptions:
+            subscription.on_open(ws)
+        ws.send(json.dumps({
             'msg': 'connect',
             'version': '1',
             'support': ['1'],
-        })
+        }))
 
     def on_message(self, ws, message):
         """Handle incoming messages from the server."""
         data = json.loads(message)
+        if data.get('msg') == 'ping':
+            pong = {'msg': 'pong'}
+            if 'id' in data:
+                pong['id'] = data['id']
+            ws.send(json.dumps(pong))
+            return
+        with self.documents_lock:
+            self.update_documents(data)
+            subscriptions = self.subscriptions
+            if data.get('msg') == 'connected':
+                with self.subscriptions_lock:
+                    self.connected = True
+                    subscriptions = self.subscriptions
+            for subscription in subscriptions:
+                subscription.handle_message(ws, message, data)
+
+    def update_documents(self, data):
+        """Apply a message to the connection's copy of the documents."""
         msg = data.get('msg')
+        if msg == 'connected':
+            # The server sends every document again on a new connection
+            self.collection_to_documents.clear()
+        elif msg == 'added':
+            documents = self.collection_to_documents.setdefault(data['collection'], {})
+            documents[data['id']] = dict(data.get('fields', {}))
+        elif msg == 'changed':
+            fields = self.collection_to_documents.get(data['collection'], {}).get(data['id'])
+            if fields is not None:
+                fields.update(data.get('fields', {}))
+                for field in data.get('cleared', []):
+                    del_if_exists(fields, field)
+        elif msg == 'removed':
+            del_if_exists(self.collection_to_documents.get(data['collection'], {}), data['id'])
+
+    def on_error(self, ws, error):
+        """Log errors and close the websocket to restart."""
+        logging.error(f'Subscription error: {error}')
+        ws.close()
+
+    def on_close(self, ws, close_status_code, close_message):
+        """Log closures. This is not guaranteed to be called on every close
+        (see: https://websocket-client.readthedocs.io/en/latest/threading.html)"""
+        logging.error(f'Subscription closed: code: {close_status_code}, message: {close_message}')
+
+
+class Subscription:
+    """Subscribe to lights data via Meteor's DDP protocol:
+    https://github.com/meteor/meteor/blob/devel/packages/ddp/DDP.md
+    and based on https://github.com/hharnisc/python-ddp/blob/master/DDPClient.py
+
+    Subscriptions can share a Connection (e.g. when hosting several
+    activities in one process), otherwise each opens its own.
+    """
+
+    def __init__(self, *, url, name, token, sub_param_list=None, max_call_promises=MAX_CALL_PROMISES,
+                 recorder=None, connection=None):
+        self.name = name
+        self.ready = False
+        self.state = {}
+        # Set whenever the state changes, so that consumers can wait
+        # for changes instead of polling (consumers are responsible
+        # for clearing it).
+        self.updated = Event()
+        self.stopped = True
+        self.token = token
+        self.sub_param_list = sub_param_list
+        self.call_promises = {}
+        # Calls are made from other threads than the one that handles
+        # their results
+        self.call_promises_lock = Lock()
+        self.max_call_promises = max_call_promises
+        # Optional Recorder of every message sent and received
+        self.recorder = recorder
+        # Subscriptions without a shared connection open their own
+        self.owns_connection = connection is None
+        self.connection = connection or Connection(url=url, name=name)
+        self.sub_id = None
+
+    def _next_id(self):
+        """Get the next id that will be sent to the server"""
+        return self.connection.next_id()
+
+    def start(self):
+        """Subscribe, starting the connection if it isn't already
+        running"""
+        self.stopped = False
+        self.connection.add_subscription(self)
+        self.connection.start()
+        return datetime.now()
+
+    def stop(self):
+        """Can be called to stop the subscription."""
+        self.stopped = True
+        self.connection.remove_subscription(self)
+        if self.owns_connection:
+            self.connection.stop()
+
+    def subscribe(self, ws):
+        param_config = {}
+        if self.sub_param_list is not None:
+            param_config = {'params': self.sub_param_list}
+        self.sub_id = self._next_id()
+        self.send(ws, {
+            'msg': 'sub',
+            'id': self.sub_id,
+            'name': self.name,
+            **param_config,
+        })
+        self.ready = True
+
+    def unsubscribe(self, ws):
+        """Stop the server sending documents to a shared connection that
+        is staying open."""
+        if self.sub_id is None or self.owns_connection:
+            return
+        try:
+            self.send(ws, {'msg': 'unsub', 'id': self.sub_id})
+        except Exception as ex:
+            logging.warning(f'Unsubscribe failed: {ex}')
+        # The server confirms with a nosub for this id, which is ignored
+        self.sub_id = None
+
+    def send(self, ws, data):
+        if self.recorder is not None:
+            self.recorder.record_sent(self.name, data)
+        ws.send(json.dumps(data))
+
+    def on_open(self, ws):
+        """Called when the connection (re)opens."""
+        # Results of calls made on a previous connection will never
+        # arrive.
+        self.fail_call_promises('Disconnected')
+
+    def on_message(self, ws, message):
+        """Handle an incoming message from the server."""
+        self.handle_message(ws, message, json.loads(message))
+
+    def handle_message(self, ws, message, data):
+        """Handle an incoming message (already parsed into data), which may
+        be meant for another subscription on the same connection."""
+        collection = data.get('collection')
+        if collection is not None and collection != self.name:
+            return
+        msg = data.get('msg')
+        # Subscription status messages name the subscriptions they are
+        # for, which may be another subscription on the same connection
+        # (or one we have unsubscribed from).
+        if msg == 'nosub' and (self.sub_id is None or data.get('id') != self.sub_id):
+            return
+        if msg == 'ready' and self.sub_id not in data.get('subs', []):
+            return
+        if self.recorder is not None:
+            self.recorder.record_received(self.name, message)
 
         if msg == 'failed':
             logging.error(f'Subscription connection failure')
         elif msg == 'connected':
-            param_config = {}
-            if self.sub_param_list is not None:
-                param_config = {'params': self.sub_param_list}
-            self.send(ws, {
-                'msg': 'sub',
-                'id': self._next_id(),
-                'name': self.name,
-                **param_config,
-            })
-            self.ready = True
+            # The server sends every document again when we
+            # re-subscribe, so drop any documents from a previous
+            # connection that may have since been removed.
+            if self.state:
+                self.state.clear()
+                self.updated.set()
+            self.subscribe(ws)
         elif msg == 'nosub':
-            # Handle error and close the websocket to restart
-            logging.error(f'Subscription error: {data["error"]}')
-            ws.close()
+            error = data.get('error')
+            if error is None:
+                # The server ended the subscription without an error
+                logging.warning(f'Subscription {self.name} stopped by the server')
+                self.sub_id = None
+            else:
+                # Handle error and close the websocket to restart
+                logging.error(f'Subscription error: {error}')
+                ws.close()
         elif msg == 'added':
             if data['collection'] == self.name:
                 item_id = data['id']
                 self.state[item_id] = data['fields']
+                self.updated.set()
         elif msg == 'changed':
             if data['collection'] == self.name:
                 item_id = data['id']
@@ -159,17 +366,18 @@ class Subscription:
                     self.state[item_id].update(data.get('fields', {}))
                     for field in data.get('cleared', []):
                         del_if_exists(self.state[item_id], field)
+                    self.updated.set()
         elif msg == 'removed':
             if data['collection'] == self.name:
                 del_if_exists(self.state, data['id'])
-        elif msg == 'ping':
-            pong = {'msg': 'pong'}
-            if 'id' in data:
-                pong['id'] = data['id']
-            self.send(ws, pong)
+                self.updated.set()
         elif msg == 'result':
             call_id = data['id']
-            promise = self.call_promises[call_id]
+            with self.call_promises_lock:
+                promise = self.call_promises.pop(call_id, None)
+            if promise is None:
+                # We have already given up on this call
+                return
             error = data.get('error')
             if error is not None:
                 promise.set_error(error)
@@ -180,25 +388,33 @@ class Subscription:
             # Ignore other msg types, which are either unrecognised or
             # we don't need to handle them.
             pass
+        self.update_container_metrics()
 
-    def on_error(self, ws, error):
-        """Log errors and close the websocket to restart."""
-        logging.error(f'Subscription error: {error}')
-        ws.close()
+    def update_container_metrics(self):
+        metrics.set_gauge('container_size', len(self.state),
+                          container='subscription_state', subscription=self.name)
+        metrics.set_gauge('container_size', len(self.call_promises),
+                          container='subscription_call_promises', subscription=self.name)
 
-    def on_close(self, ws, close_status_code, close_message):
-        """Log closures. This is not guaranteed to be called on every close
-        (see: https://websocket-client.readthedocs.io/en/latest/threading.html)"""
-        logging.error(f'Subscription closed: code: {close_status_code}, message: {close_message}')
+    def fail_call_promises(self, error, keep_count=0):
+        """Give up on all but the keep_count most recent calls, failing
+        their promises so that nothing waits on them forever."""
+        with self.call_promises_lock:
+            while len(self.call_promises) > keep_count:
+                oldest_call_id = next(iter(self.call_promises))
+                self.call_promises.pop(oldest_call_id).set_error(error)
 
     def call(self, method, params):
         """Call a Meteor method on the server."""
         call_id = self._next_id()
-        self.call_promises[call_id] = Promise()
-        self.send(self.ws, {
+        promise = Promise()
+        with self.call_promises_lock:
+            self.call_promises[call_id] = promise
+        self.fail_call_promises('Too many pending calls', keep_count=self.max_call_promises)
+        self.send(self.connection.ws, {
             'msg': 'method',
             'id': call_id,
             'method': method,
             'params': params,
         })
-        return self.call_promises[call_id]
+        return promise
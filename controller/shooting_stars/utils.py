@@ -1,3 +1,7 @@
+import os
+import resource
+import sys
+from pathlib import Path
 import numpy as np
 import colorsys
 
@@ -17,6 +21,34 @@ def hsv_to_rgb(h, s, v):
     return (rgb * 255).round().astype(FRAME_DTYPE)
 
 
+# For each sector of the hue circle, the (value, t, p, q) term used by
+# colorsys.hsv_to_rgb for each of red, green and blue.
+HSV_SECTOR_TERMS = np.array([
+    [0, 1, 2],
+    [3, 0, 2],
+    [2, 0, 1],
+    [2, 3, 0],
+    [1, 2, 0],
+    [0, 2, 3],
+])
+
+
+def hue_saturation_to_rgb(hues, saturations):
+    """Vectorised hsv_to_rgb for arrays of hues and saturations in range
+    [0, 1] (at max value), returning a 3 column array of RGB values
+    identical to calling hsv_to_rgb for each."""
+    sectors = (hues * 6.0).astype(int)
+    fractions = (hues * 6.0) - sectors
+    terms = np.stack([
+        np.ones_like(fractions),
+        1.0 - saturations * (1.0 - fractions),
+        1.0 - saturations,
+        1.0 - saturations * fractions,
+    ])
+    rgb = terms[HSV_SECTOR_TERMS[sectors % 6], np.arange(len(hues))[:, np.newaxis]]
+    return (rgb * 255).round().astype(FRAME_DTYPE)
+
+
 def hue_to_rgb(hues):
     """Takes a vector array of hues in range [0, 1], and returns a 3
     column array of RGB values (for max saturation and value). Based
@@ -68,3 +100,40 @@ def indexes_to_mask(indexes, shape):
     mask = np.zeros(shape, dtype=bool)
     mask[indexes] = True
     return mask
+
+
+def save_npz_atomic(path, **arrays):
+    """Save arrays to an .npz file, replacing any existing file at path
+    atomically so that a crash mid-write never leaves a corrupt
+    file."""
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, 'wb') as tmp_file:
+        np.savez(tmp_file, **arrays)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def parse_size(size_string):
+    """Parse a WIDTHxHEIGHT string (e.g. '320x240') into a tuple."""
+    width, height = size_string.lower().split('x')
+    return (int(width), int(height))
+
+
+def get_max_rss_mib():
+    """Return the peak resident memory of this process in MiB."""
+    # Prefer Linux's VmHWM, as ru_maxrss is kept across exec (so it
+    # includes the peak of the process a subprocess was forked from).
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024